@@ -1,6 +1,7 @@
-import mypy
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Set
 from enum import Enum, auto
+from threading import Lock
+from weakref import WeakValueDictionary
 
 from rdflib import Graph
 from rdflib.term import URIRef, Literal, BNode, Identifier
@@ -8,6 +9,8 @@ from rdflib.namespace import SH, RDF, RDFS
 from rdflib.collection import Collection
 
 import pathalg
+import trampoline
+from rewrite import RuleSet
 
 
 class Op(Enum):
@@ -35,23 +38,47 @@ class Op(Enum):
     '''
 
 
+_ONE = Literal(1)
+
+
 class SANode:  # Shape Algebra Node
-    def __init__(self, op: Op, children: List):
-        self.op = op
-        self.children = children
+    """Ordered tree representing a shape expression
+
+    Like pathalg.PANode, nodes are immutable and hash-consed: equal subtrees
+    are the same object, so nodes can be compared by identity and used as
+    set members or dict keys (e.g. to memoize a pass per subtree).
+    """
+    __slots__ = ('op', 'children', '_hash', '__weakref__')
+
+    _interned = WeakValueDictionary()
+    _intern_lock = Lock()
 
-    def __eq__(self, other):
-        """ Overwrite the '==' operator """
-        if len(self.children) != len(other.children):
-            return False
+    def __new__(cls, op: Op, children: List):
+        children = pathalg._freeze(children)
+        key = (op, children)
+        node = cls._interned.get(key)
+        if node is not None:
+            return node
 
-        same_children = True
-        for child_self, child_other in zip(self.children, other.children):
-            if type(child_self) == BNode and type(child_other) == BNode:
-                continue
-            same_children = same_children and child_self == child_other
+        node = object.__new__(cls)
+        object.__setattr__(node, 'op', op)
+        object.__setattr__(node, 'children', children)
+        object.__setattr__(node, '_hash', hash((cls, op, children)))
+        with cls._intern_lock:
+            return cls._interned.setdefault(key, node)
 
-        return (self.op == other.op) and same_children
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        # unpickling and copying go through __new__ and are interned again
+        return type(self), (self.op, self.children)
 
     def __repr__(self):
         """ Pretty representation of the SANode tree """
@@ -64,70 +91,257 @@ class SANode:  # Shape Algebra Node
         return out
 
 
+class RecursiveShapeError(ValueError):
+    """A shape refers to itself, directly or through other shapes"""
+
+
+def shape_dependencies(definitions: Dict, names=None) -> Dict[Identifier, List[Identifier]]:
+    """
+    The shape reference graph: maps every shape name to the names it refers
+    to with Op.HASSHAPE. Only names that are defined are kept. If names is
+    given, only the shapes reachable from those names are included.
+    """
+    graph = {}
+    todo = list(definitions if names is None else names)
+    while todo:
+        name = todo.pop()
+        if name in graph or name not in definitions:
+            continue
+        graph[name] = _shape_references(definitions, definitions[name])
+        todo.extend(graph[name])
+    return graph
+
+
+def dependent_shapes(definitions: Dict, names) -> Set[Identifier]:
+    """The names and every shape that refers to one of them, transitively"""
+    dependents = {}
+    for name, references in shape_dependencies(definitions).items():
+        for reference in references:
+            dependents.setdefault(reference, []).append(name)
+    result = set(names)
+    todo = list(result)
+    while todo:
+        for dependent in dependents.get(todo.pop(), ()):
+            if dependent not in result:
+                result.add(dependent)
+                todo.append(dependent)
+    return result
+
+
+def _shape_references(definitions: Dict, node: SANode) -> List[Identifier]:
+    references = {}  # ordered set
+    seen = set()  # subtrees may be shared, visit every node once
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        if node.op == Op.HASSHAPE:
+            if node.children[0] in definitions:
+                references[node.children[0]] = None
+            continue
+        nodes.extend(c for c in node.children if type(c) == SANode)
+    return list(references)
+
+
+def strongly_connected_components(graph: Dict) -> List[List]:
+    """
+    Tarjan's algorithm with an explicit stack. Components are returned in
+    topological order: a component comes after every component it depends on.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            vertex, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(graph.get(successor, ()))))
+                    break
+                if successor in on_stack:
+                    lowlink[vertex] = min(lowlink[vertex], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[vertex])
+                if lowlink[vertex] == index[vertex]:
+                    component = []
+                    member = None
+                    while member != vertex:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                    components.append(component)
+    return components
+
+
+def expand_schema(definitions: Dict, names=None, expanded: Optional[Dict] = None) -> Dict:
+    """
+    Expands every shape (or the shapes reachable from names) exactly once.
+    Shapes are expanded in topological order of the shape reference graph,
+    so every reference is replaced by an already expanded definition.
+    Raises RecursiveShapeError as soon as a recursive shape is found.
+    expanded holds shapes that are already expanded: they are not expanded
+    again, and the newly expanded shapes are added to it.
+    """
+    graph = shape_dependencies(definitions, names)
+    if expanded is None:
+        expanded = {}
+    memo = {}  # expansion per subtree, subtrees are shared between shapes
+    for component in strongly_connected_components(graph):
+        name = component[0]
+        if name in expanded:
+            continue
+        if len(component) > 1 or name in graph[name]:
+            cycle = ', '.join(str(member) for member in reversed(component))
+            raise RecursiveShapeError(f'Recursive shapes are not supported: {cycle}')
+        expanded[name] = _inline_shapes(expanded, definitions[name], memo)
+    return expanded
+
+
+def normalize_schema(definitions: Dict, names=None, expanded: Optional[Dict] = None) -> Dict:
+    """
+    Per shape, the expanded definition in negation normal form and
+    optimized. A definition that optimizes away entirely becomes Op.TOP.
+    expanded is passed on to expand_schema.
+    """
+    expanded = expand_schema(definitions, names, expanded)
+    nnf_memo = {}
+    normalized = {}
+    for name in (expanded if names is None else names):
+        if name not in expanded:
+            continue
+        nnf = negation_normal_form(expanded[name], nnf_memo)
+        normalized[name] = optimize_tree(nnf) or SANode(Op.TOP, [])
+    return normalized
+
+
+def shape_signatures(definitions: Dict) -> Dict:
+    """
+    Per shape with an IRI, its definition with the blank node shapes it
+    refers to inlined. Blank node labels differ between two parses of the
+    same shapes graph, signatures do not (unless blank node shapes are
+    recursive, those are not inlined).
+    """
+    graph = shape_dependencies(definitions)
+    inlined = {name: SANode(Op.HASSHAPE, [name]) for name in definitions}
+    memo = {}
+    for component in strongly_connected_components(graph):
+        name = component[0]
+        if type(name) != BNode or len(component) > 1 or name in graph[name]:
+            continue
+        inlined[name] = _inline_shapes(inlined, definitions[name], memo)
+    return {name: _inline_shapes(inlined, definition, memo)
+            for name, definition in definitions.items() if type(name) != BNode}
+
+
 def expand_shape(definitions: Dict, node: SANode) -> SANode:
     '''Removes all hasshape references and replaces them with shapes'''
+    names = _shape_references(definitions, node)
+    return _inline_shapes(expand_schema(definitions, names), node, {})
+
+
+def _inline_shapes(expanded: Dict, node: SANode, memo: Dict) -> SANode:
+    return trampoline.run(_inline(expanded, node, memo))
+
+
+def _inline(expanded: Dict, node: SANode, memo: Dict):
+    # generator, see trampoline.run
+    if node in memo:
+        return memo[node]
 
     if node.op == Op.HASSHAPE:
-        if node.children[0] not in definitions:
+        if node.children[0] not in expanded:
             return SANode(Op.TOP, [])  # mimics real SHACL semantics
-        return expand_shape(definitions, definitions[node.children[0]])
+        return expanded[node.children[0]]
 
     new_children = []
     for child in node.children:
         new_child = child
         if type(child) == SANode:
-            new_child = expand_shape(definitions, child)
+            new_child = yield _inline(expanded, child, memo)
         new_children.append(new_child)
-    return SANode(node.op, new_children)
+    memo[node] = SANode(node.op, new_children)
+    return memo[node]
 
 
-def negation_normal_form(node: SANode) -> SANode:
+def negation_normal_form(node: SANode, memo: Optional[Dict] = None) -> SANode:
     # The input should be a node without hasshape constructor (expanded)
+    # memo maps already normalized subtrees to their negation normal form
+    if memo is None:
+        memo = {}
+    return trampoline.run(_negation_normal_form(node, memo))
+
+
+def _negation_normal_form(node: SANode, memo: Dict):
+    # generator, see trampoline.run
+    if node in memo:
+        return memo[node]
+
     if node.op != Op.NOT:
         new_children = []
         for child in node.children:
             if type(child) != SANode:
                 new_children.append(child)
             else:
-                new_children.append(negation_normal_form(child))
-        return SANode(node.op, new_children)
-
-    nnode = node.children[0]
-    if nnode.op == Op.AND:
-        new_children = []
-        for child in nnode.children:
-            new_children.append(
-                negation_normal_form(SANode(Op.NOT, [child])))
-        return SANode(Op.OR, new_children)
+                new_children.append((yield _negation_normal_form(child, memo)))
+        result = SANode(node.op, new_children)
+    else:
+        nnode = node.children[0]
+        if nnode.op == Op.AND:
+            new_children = []
+            for child in nnode.children:
+                new_children.append((yield _negation_normal_form(
+                    SANode(Op.NOT, [child]), memo)))
+            result = SANode(Op.OR, new_children)
+
+        elif nnode.op == Op.OR:
+            new_children = []
+            for child in nnode.children:
+                new_children.append((yield _negation_normal_form(
+                    SANode(Op.NOT, [child]), memo)))
+            result = SANode(Op.AND, new_children)
+
+        elif nnode.op == Op.NOT:
+            result = nnode.children[0]
+
+        elif nnode.op == Op.GEQ:
+            result = SANode(Op.LEQ, [Literal(int(nnode.children[0]) - 1),
+                                     nnode.children[1],
+                                     (yield _negation_normal_form(
+                                         SANode(Op.NOT, [nnode.children[2]]), memo))])
+
+        elif nnode.op == Op.LEQ:
+            result = SANode(Op.GEQ, [Literal(int(nnode.children[0]) + 1),
+                                     nnode.children[1],
+                                     (yield _negation_normal_form(
+                                         SANode(Op.NOT, [nnode.children[2]]), memo))])
+
+        elif nnode.op == Op.FORALL:
+            result = SANode(Op.GEQ, [_ONE, nnode.children[0],
+                                     (yield _negation_normal_form(
+                                         SANode(Op.NOT, [nnode.children[1]]), memo))])
+        else:
+            # We do not consider HASSHAPE as this function works on expanded shapes
+            result = node
 
-    if nnode.op == Op.OR:
-        new_children = []
-        for child in nnode.children:
-            new_children.append(
-                negation_normal_form(SANode(Op.NOT, [child])))
-        return SANode(Op.AND, new_children)
-
-    if nnode.op == Op.NOT:
-        return nnode.children[0]
-
-    if nnode.op == Op.GEQ:
-        return SANode(Op.LEQ, [Literal(int(nnode.children[0]) - 1),
-                               nnode.children[1],
-                               negation_normal_form(
-                                   SANode(Op.NOT, [nnode.children[2]]))])
-
-    if nnode.op == Op.LEQ:
-        return SANode(Op.GEQ, [Literal(int(nnode.children[0]) + 1),
-                               nnode.children[1],
-                               negation_normal_form(
-                                   SANode(Op.NOT, [nnode.children[2]]))])
-
-    if nnode.op == Op.FORALL:
-        return SANode(Op.GEQ, [Literal(1), nnode.children[0],
-                               negation_normal_form(
-                                   SANode(Op.NOT, [nnode.children[1]]))])
-    # We do not consider HASSHAPE as this function works on expanded shapes
-    return node
+    memo[node] = result
+    return result
 
 
 def _extract_nodeshapes(graph: Graph) -> List[Identifier]:
@@ -150,69 +364,135 @@ def _extract_nodeshapes(graph: Graph) -> List[Identifier]:
 
     return nodeshapes
 
+class ShapesIndex:
+    """
+    Read-only view of a shapes graph used while parsing. The first time a
+    subject is looked up, all of its triples are read from the graph in a
+    single pass and kept per predicate; every later parameter lookup of that
+    subject is a dictionary lookup. Only the part of the Graph interface used
+    by the parsers (and rdflib.collection.Collection) is provided. Lookups
+    without a subject go to the underlying graph.
+    """
+
+    def __init__(self, graph: Graph):
+        self.graph = graph
+        self._parameters = {}  # subject -> predicate -> ordered set of objects
+
+    def parameters(self, subject: Identifier) -> Dict:
+        parameters = self._parameters.get(subject)
+        if parameters is None:
+            parameters = {}
+            for predicate, obj in self.graph.predicate_objects(subject):
+                parameters.setdefault(predicate, {})[obj] = None
+            self._parameters[subject] = parameters
+        return parameters
+
+    def objects(self, subject=None, predicate=None):
+        if subject is None or predicate is None:
+            return self.graph.objects(subject, predicate)
+        return iter(self.parameters(subject).get(predicate, ()))
+
+    def subjects(self, predicate=None, obj=None):
+        return self.graph.subjects(predicate, obj)
+
+    def predicates(self, subject=None, obj=None):
+        if subject is None or obj is not None:
+            return self.graph.predicates(subject, obj)
+        return iter(self.parameters(subject))
+
+    def value(self, subject, predicate):
+        return next(self.objects(subject, predicate), None)
+
+    def items(self, head):
+        # same walk over an rdf:List as Graph.items
+        seen = set()
+        while head is not None and head != RDF.nil:
+            if head in seen:
+                raise ValueError('List contains a recursive rdf:rest reference')
+            seen.add(head)
+            item = self.value(head, RDF.first)
+            if item is not None:
+                yield item
+            head = self.value(head, RDF.rest)
+
+    def __contains__(self, triple) -> bool:
+        subject, predicate, obj = triple
+        if subject is None or predicate is None:
+            return triple in self.graph
+        objects = self.parameters(subject).get(predicate, ())
+        return bool(objects) if obj is None else obj in objects
+
+
 def parse(graph: Graph, ignore_tests=False):
+    return _parse_schema(ShapesIndex(graph), ignore_tests=ignore_tests)
+
+
+def _parse_schema(graph, ignore_tests=False):
+    # graph is a ShapesIndex, or any Graph (e.g. to compare against)
     definitions = {}  # a mapping: shapename, SANode
     target = {}  # a mapping: shapename, target shape
 
     nodeshapes = _extract_nodeshapes(graph)
 
-    for nodeshape in nodeshapes:
-        definitions[nodeshape] = _nodeshape_parse(graph, nodeshape, ignore_tests=ignore_tests)
-        target[nodeshape] = _target_parse(graph, nodeshape)
-
     # this defines what propertyshapes are parsed, should follow the spec on
     # what a propertyshape is. (of type sh:property, subjects of sh:path, object of sh:property)
     propertyshapes = list(graph.subjects(RDF.type, SH.PropertyShape)) + \
                      list(graph.objects(predicate = SH.property)) + \
                      list(graph.subjects(SH.path))
-
-    for propertyshape in propertyshapes:
-        path = _extract_parameter_values(graph, propertyshape, SH.path)[0]
-        parsed_path = pathalg.parse(graph, path)
-        definitions[propertyshape] = _propertyshape_parse(graph, parsed_path,
-                                                          propertyshape, ignore_tests=ignore_tests)
-        target[propertyshape] = _target_parse(graph, propertyshape)
+    is_propertyshape = set(propertyshapes)
+
+    # every shape is parsed once, a shape that is both a node shape and a
+    # property shape is parsed as a property shape
+    for shapename in dict.fromkeys(nodeshapes + propertyshapes):
+        if shapename in is_propertyshape:
+            path = _extract_parameter_values(graph, shapename, SH.path)[0]
+            parsed_path = pathalg.parse(graph, path)
+            definitions[shapename] = _propertyshape_parse(graph, parsed_path,
+                                                          shapename, ignore_tests=ignore_tests)
+        else:
+            definitions[shapename] = _nodeshape_parse(graph, shapename, ignore_tests=ignore_tests)
+        target[shapename] = _target_parse(graph, shapename)
 
     return definitions, target
 
 
 def _target_parse(graph: Graph, shapename: Identifier) -> SANode:
     # TODO in paper: target parse in loop/ what if more targets?
-    out = SANode(Op.OR, [])
+    out = []
     for tnode in _extract_parameter_values(graph, shapename, SH.targetNode):
-        out.children.append(SANode(Op.HASVALUE, [tnode]))
+        out.append(SANode(Op.HASVALUE, [tnode]))
 
     for tclass in _extract_parameter_values(graph, shapename, SH.targetClass):
-        out.children.append(SANode(Op.GEQ, [
-            Literal(1),
+        out.append(SANode(Op.GEQ, [
+            _ONE,
             pathalg.PANode(pathalg.POp.PROP, [RDF.type]),
             SANode(Op.HASVALUE, [tclass])]))
 
     if (shapename, RDF.type, RDFS.Class) in graph:
-        out.children.append(SANode(Op.GEQ, [
-            Literal(1),
+        out.append(SANode(Op.GEQ, [
+            _ONE,
             pathalg.PANode(pathalg.POp.PROP, [RDF.type]),
             SANode(Op.HASVALUE, [shapename])]))
 
     for tsub in _extract_parameter_values(graph, shapename,
                                           SH.targetSubjectsOf):
-        out.children.append(SANode(Op.GEQ, [
-            Literal(1),
+        out.append(SANode(Op.GEQ, [
+            _ONE,
             pathalg.PANode(pathalg.POp.PROP, [tsub]),
             SANode(Op.TOP, [])]))
 
     for tobj in _extract_parameter_values(graph, shapename,
                                           SH.targetObjectsOf):
-        out.children.append(SANode(Op.GEQ, [
-            Literal(1),
+        out.append(SANode(Op.GEQ, [
+            _ONE,
             pathalg.PANode(pathalg.POp.INV, [
                 pathalg.PANode(pathalg.POp.PROP, [tobj])]),
             SANode(Op.TOP, [])]))
 
-    if not out.children:
-        out = SANode(Op.NOT, [SANode(Op.TOP, [])])
+    if not out:
+        return SANode(Op.NOT, [SANode(Op.TOP, [])])
 
-    return out
+    return SANode(Op.OR, out)
 
 
 def _nodeshape_parse(graph: Graph, shapename: Identifier, ignore_tests=False) -> SANode:
@@ -250,85 +530,85 @@ def _shape_parse(graph: Graph, shapename: Identifier) -> SANode:
 def _logic_parse(graph: Graph, shapename: Identifier) -> SANode:
     # TODO: RDFlib does not like empty lists. It cannot parse an empty
     # rdf list
-    out = SANode(Op.AND, [])
+    out = []
 
     for nshape in _extract_parameter_values(graph, shapename, SH['not']):
-        out.children.append(SANode(Op.NOT, [SANode(Op.HASSHAPE, [nshape])]))
+        out.append(SANode(Op.NOT, [SANode(Op.HASSHAPE, [nshape])]))
 
     for ashape in _extract_parameter_values(graph, shapename, SH['and']):
         shacl_list = Collection(graph, ashape)
         conj_list = [SANode(Op.HASSHAPE, [s]) for s in shacl_list]
-        out.children.append(SANode(Op.AND, conj_list))
+        out.append(SANode(Op.AND, conj_list))
 
     for oshape in _extract_parameter_values(graph, shapename, SH['or']):
         shacl_list = Collection(graph, oshape)
         disj_list = [SANode(Op.HASSHAPE, [s]) for s in shacl_list]
-        out.children.append(SANode(Op.OR, disj_list))
+        out.append(SANode(Op.OR, disj_list))
 
     for xshape in _extract_parameter_values(graph, shapename, SH.xone):
         shacl_list = Collection(graph, xshape)
-        _out = SANode(Op.OR, [])
+        _out = []
         for s in shacl_list:
-            single_xone = SANode(Op.AND, [SANode(Op.HASSHAPE, [s])])
+            single_xone = [SANode(Op.HASSHAPE, [s])]
             for not_s in shacl_list:
                 if s != not_s:
-                    single_xone.children.append(
+                    single_xone.append(
                         SANode(Op.NOT, [SANode(Op.HASSHAPE, [not_s])]))
-            _out.children.append(single_xone)
-        out.children.append(_out)
+            _out.append(SANode(Op.AND, single_xone))
+        out.append(SANode(Op.OR, _out))
 
-    return out
+    return SANode(Op.AND, out)
 
 
 def _tests_parse(graph: Graph, shapename: Identifier) -> SANode:
     # TODO: for now, sh:class only works naively
-    out = SANode(Op.AND, [])
+    out = []
 
     # sh:class
     for sh_class in _extract_parameter_values(graph, shapename, SH['class']):
-        out.children.append(
-            SANode(Op.GEQ, [Literal(1), pathalg.PANode(pathalg.POp.PROP,
+        out.append(
+            SANode(Op.GEQ, [_ONE, pathalg.PANode(pathalg.POp.PROP,
                                                        [RDF.type]),
                             SANode(Op.HASVALUE, [sh_class])]))
 
     # sh:datatype
     for sh_datatype in _extract_parameter_values(graph, shapename,
                                                  SH.datatype):
-        out.children.append(SANode(Op.TEST, ['datatype', sh_datatype]))
+        out.append(SANode(Op.TEST, ['datatype', sh_datatype]))
 
     # sh:nodeKind
     for sh_nodekind in _extract_parameter_values(graph, shapename,
                                                  SH.nodeKind):
-        out.children.append(SANode(Op.TEST, ['nodekind', sh_nodekind]))
+        out.append(SANode(Op.TEST, ['nodekind', sh_nodekind]))
 
     # TODO: in paper we forgot minInclusive and maxInclusive
     # sh:minInclusive
     for sh_minincl in _extract_parameter_values(graph, shapename,
                                                 SH.minInclusive):
-        out.children.append(SANode(Op.TEST, ['min_inclusive', sh_minincl]))
+        out.append(SANode(Op.TEST, ['min_inclusive', sh_minincl]))
 
     # sh:maxInclusive
     for sh_maxincl in _extract_parameter_values(graph, shapename,
                                                 SH.maxInclusive):
-        out.children.append(SANode(Op.TEST, ['max_inclusive', sh_maxincl]))
+        out.append(SANode(Op.TEST, ['max_inclusive', sh_maxincl]))
 
     # sh:minExclusive
     for sh_minexcl in _extract_parameter_values(graph, shapename,
                                                 SH.minExclusive):
-        out.children.append(SANode(Op.TEST, ['min_exclusive', sh_minexcl]))
+        out.append(SANode(Op.TEST, ['min_exclusive', sh_minexcl]))
 
     # sh:maxExclusive
     for sh_maxexcl in _extract_parameter_values(graph, shapename,
                                                 SH.maxExclusive):
-        out.children.append(SANode(Op.TEST, ['max_exclusive', sh_maxexcl]))
+        out.append(SANode(Op.TEST, ['max_exclusive', sh_maxexcl]))
 
     # sh:minLength
     for sh_minlen in _extract_parameter_values(graph, shapename, SH.minLength):
-        out.children.append(SANode(Op.TEST, ['min_length', sh_minlen]))
+        out.append(SANode(Op.TEST, ['min_length', sh_minlen]))
 
     # sh:maxLength
     for sh_maxlen in _extract_parameter_values(graph, shapename, SH.maxLength):
-        out.children.append(SANode(Op.TEST, ['max_length', sh_maxlen]))
+        out.append(SANode(Op.TEST, ['max_length', sh_maxlen]))
 
     # sh:pattern
     flags = [sh_flags for sh_flags in _extract_parameter_values(graph,
@@ -339,27 +619,27 @@ def _tests_parse(graph: Graph, shapename: Identifier) -> SANode:
         # something strange is going on with character escapes
         # if a pattern contains a double backslash 'hello\\w' for example
         # it will be read by the rdflib parser as 'hello\w'
-        out.children.append(SANode(Op.TEST, ['pattern', escaped_pattern, flags]))
+        out.append(SANode(Op.TEST, ['pattern', escaped_pattern, flags]))
 
-    return out
+    return SANode(Op.AND, out)
 
 
 def _value_parse(graph: Graph, shapename: Identifier) -> SANode:
-    out = SANode(Op.AND, [])
+    out = []
     for sh_value in _extract_parameter_values(graph, shapename, SH.hasValue):
-        out.children.append(SANode(Op.HASVALUE, [sh_value]))
-    return out
+        out.append(SANode(Op.HASVALUE, [sh_value]))
+    return SANode(Op.AND, out)
 
 
 def _in_parse(graph: Graph, shapename: Identifier) -> SANode:
-    out = SANode(Op.AND, [])
+    out = []
     for sh_in in _extract_parameter_values(graph, shapename, SH['in']):
         shacl_list = Collection(graph, sh_in)
-        disj = SANode(Op.OR, [])
+        disj = []
         for val in shacl_list:
-            disj.children.append(SANode(Op.HASVALUE, [val]))
-        out.children.append(disj)
-    return out
+            disj.append(SANode(Op.HASVALUE, [val]))
+        out.append(SANode(Op.OR, disj))
+    return SANode(Op.AND, out)
 
 
 def _closed_parse(graph: Graph, shapename: Identifier) -> SANode:
@@ -385,43 +665,43 @@ def _closed_parse(graph: Graph, shapename: Identifier) -> SANode:
 
 
 def _card_parse(graph: Graph, path: pathalg.PANode, shapename: Identifier) -> SANode:
-    out = SANode(Op.AND, [])
+    out = []
     for min_card in _extract_parameter_values(graph, shapename, SH.minCount):
-        out.children.append(SANode(Op.GEQ, [min_card, path,
+        out.append(SANode(Op.GEQ, [min_card, path,
                                             SANode(Op.TOP, [])]))
 
     for max_card in _extract_parameter_values(graph, shapename, SH.maxCount):
-        out.children.append(SANode(Op.LEQ, [max_card, path,
+        out.append(SANode(Op.LEQ, [max_card, path,
                                             SANode(Op.TOP, [])]))
 
-    return out
+    return SANode(Op.AND, out)
 
 
 def _pair_parse(graph: Graph, path: pathalg.PANode, shapename: Identifier) -> SANode:
-    out = SANode(Op.AND, [])
+    out = []
 
     # sh:equals
     for eq in _extract_parameter_values(graph, shapename, SH.equals):
-        out.children.append(SANode(Op.EQ, [path,
+        out.append(SANode(Op.EQ, [path,
                                            pathalg.parse(graph, eq)]))
 
     # sh:disjoint
     for disj in _extract_parameter_values(graph, shapename, SH.disjoint):
-        out.children.append(SANode(Op.DISJ, [path,
+        out.append(SANode(Op.DISJ, [path,
                                              pathalg.parse(graph, disj)]))
 
     # sh:lessThan
     for lt in _extract_parameter_values(graph, shapename, SH.lessThan):
-        out.children.append(SANode(Op.LESSTHAN, [path,
+        out.append(SANode(Op.LESSTHAN, [path,
                                                  pathalg.parse(graph, lt)]))
 
     # sh:lessThanEq
     for lte in _extract_parameter_values(graph, shapename,
                                          SH.lessThanOrEquals):
-        out.children.append(SANode(Op.LESSTHANEQ, [path,
+        out.append(SANode(Op.LESSTHANEQ, [path,
                                                    pathalg.parse(graph, lte)]))
 
-    return out
+    return SANode(Op.AND, out)
 
 
 def _qual_parse(graph: Graph, path: pathalg.PANode, shapename: Identifier) -> SANode:
@@ -439,25 +719,24 @@ def _qual_parse(graph: Graph, path: pathalg.PANode, shapename: Identifier) -> SA
             for propshape in graph.objects(parent, SH.property):
                 sibl += list(graph.objects(propshape, SH.qualifiedValueShape))
 
-    out = SANode(Op.AND, [])
+    out = []
     for qvs in qual:
         result_qvs = SANode(Op.HASSHAPE, [qvs])  # normal qualifiedvalueshape
 
         if len(sibl) > 0:  # if there is a sibling, wrap it in an Op.AND
-            result_qvs = SANode(Op.AND, [result_qvs])
-
-        # for every sibling, add its negation, unless it is itself
-        for s in sibl:
-            if s == qvs:  # TODO: in paper, I forgot this
-                continue
-            result_qvs.children.append(SANode(Op.NOT, [
-                SANode(Op.HASSHAPE, [s])]))
+            conj = [result_qvs]
+            # for every sibling, add its negation, unless it is itself
+            for s in sibl:
+                if s == qvs:  # TODO: in paper, I forgot this
+                    continue
+                conj.append(SANode(Op.NOT, [SANode(Op.HASSHAPE, [s])]))
+            result_qvs = SANode(Op.AND, conj)
 
         for count in qual_min:
-            out.children.append(SANode(Op.GEQ, [count, path, result_qvs]))
+            out.append(SANode(Op.GEQ, [count, path, result_qvs]))
         for count in qual_max:
-            out.children.append(SANode(Op.LEQ, [count, path, result_qvs]))
-    return out
+            out.append(SANode(Op.LEQ, [count, path, result_qvs]))
+    return SANode(Op.AND, out)
 
 
 def _all_parse(graph: Graph, path: pathalg.PANode, shapename: Identifier, ignore_tests=False) -> SANode:
@@ -468,7 +747,7 @@ def _all_parse(graph: Graph, path: pathalg.PANode, shapename: Identifier, ignore
                                                _logic_parse(graph, shapename),
                                                _in_parse(graph, shapename),
                                                _closed_parse(graph, shapename)])]),
-            SANode(Op.GEQ, [Literal(1), path, _value_parse(graph, shapename)])])
+            SANode(Op.GEQ, [_ONE, path, _value_parse(graph, shapename)])])
     return SANode(Op.AND, [
         SANode(Op.FORALL, [path,
                            SANode(Op.AND, [_shape_parse(graph, shapename),
@@ -476,37 +755,43 @@ def _all_parse(graph: Graph, path: pathalg.PANode, shapename: Identifier, ignore
                                            _tests_parse(graph, shapename),
                                            _in_parse(graph, shapename),
                                            _closed_parse(graph, shapename)])]),
-        SANode(Op.GEQ, [Literal(1), path, _value_parse(graph, shapename)])])
+        SANode(Op.GEQ, [_ONE, path, _value_parse(graph, shapename)])])
 
 
 def _lang_parse(graph: Graph, path: pathalg.PANode, shapename: Identifier) -> SANode:
-    out = SANode(Op.AND, [])
+    out = []
 
     # sh:languageIn
     for langin in _extract_parameter_values(graph, shapename, SH.languageIn):
-        _out = SANode(Op.OR, [])
+        _out = []
         shacl_list = Collection(graph, langin)
         for lang in shacl_list:
-            _out.children.append(SANode(Op.TEST, ['languageIn', lang]))
-        out.children.append(SANode(Op.FORALL, [path, _out]))
+            _out.append(SANode(Op.TEST, ['languageIn', lang]))
+        out.append(SANode(Op.FORALL, [path, SANode(Op.OR, _out)]))
 
     # sh:uniqueLang
     if (shapename, SH.uniqueLang, Literal(True)) in graph:
-        out.children.append(SANode(Op.UNIQUELANG, [path]))
+        out.append(SANode(Op.UNIQUELANG, [path]))
 
-    return out
+    return SANode(Op.AND, out)
 
 
 def _extract_parameter_values(graph: Graph, shapename: Identifier, parameter: URIRef):
     return list(graph.objects(shapename, parameter))
 
 
-def optimize_tree(tree: SANode) -> Optional[SANode]:
+OPTIMIZE = RuleSet('optimize')
+
+
+def optimize_tree(tree: SANode, memo: Optional[Dict] = None) -> Optional[SANode]:
     """
     go through tree in post-order
     remove empty conjunctions,
     replace singleton conjunctions with self,
     remove top from conjunction
+
+    The optimizations are the rules of OPTIMIZE. Returns None if the
+    whole tree is removed. memo can be shared between calls.
     """
     # TODO: fout in paper: vertaling parse_all: we verplichten per
     # ongeluk geq_1 E. true, we moeten net zoals in deze functie het
@@ -520,61 +805,65 @@ def optimize_tree(tree: SANode) -> Optional[SANode]:
     # Op.GEQ /LEQ without a third child.  However, some things just
     # make sense: collapsing "AND" with an "AND" child. Same with
     # OR. Or removing TOP from conjunctions.
+    return OPTIMIZE.rewrite(tree, memo)
 
-    new_children = []
-    for child in tree.children:
-        if type(child) == SANode:
-            new_child = optimize_tree(child)
-            if new_child:  # if it is not removed
-                new_children.append(new_child)
-        else:
-            new_children.append(child)
-
-    tree = SANode(tree.op, new_children)
 
+@OPTIMIZE.rule(Op.AND)
+def remove_top_from_conjunction(tree: SANode) -> SANode:
     # if there is a TOP, filter it out
-    if tree.op == Op.AND and any(map(lambda c: c.op == Op.TOP, tree.children)):
-        tree.children = list(filter(lambda c: c.op != Op.TOP, tree.children))
-        return optimize_tree(tree)
+    if any(map(lambda c: c.op == Op.TOP, tree.children)):
+        return SANode(Op.AND, list(filter(lambda c: c.op != Op.TOP, tree.children)))
+    return tree
 
+
+@OPTIMIZE.rule(Op.AND, Op.OR)
+def flatten_nested(tree: SANode) -> SANode:
     # if there is an AND node with AND children, merge them to one AND
-    if tree.op == Op.AND and any(map(lambda c: c.op == Op.AND, tree.children)):
+    # same for an OR node with OR children
+    if any(map(lambda c: c.op == tree.op, tree.children)):
         new_children = []
         for child in tree.children:
-            if child.op == Op.AND:
+            if child.op == tree.op:
                 new_children.extend(child.children)
             else:
                 new_children.append(child)
-        tree.children = new_children
-        return optimize_tree(tree)
+        return SANode(tree.op, new_children)
+    return tree
 
-    # if there is an OR node with OR children, merge them to one OR
-    if tree.op == Op.OR and any(map(lambda c: c.op == Op.OR, tree.children)):
-        new_children = []
-        for child in tree.children:
-            if child.op == Op.OR:
-                new_children.extend(child.children)
-            else:
-                new_children.append(child)
-        tree.children = new_children
-        return optimize_tree(tree)
 
+@OPTIMIZE.rule(Op.OR)
+def remove_top_disjunction(tree: SANode) -> Optional[SANode]:
     # remove a disjunction between TOPs
-    if tree.op == Op.OR and all(map(lambda c: c.op == Op.TOP, tree.children)):
+    if all(map(lambda c: c.op == Op.TOP, tree.children)):
         return None
+    return tree
 
-    if tree.op == Op.FORALL and len(tree.children) == 1:
+
+@OPTIMIZE.rule(Op.FORALL)
+def remove_incomplete_forall(tree: SANode) -> Optional[SANode]:
+    if len(tree.children) == 1:
         return None
+    return tree
 
-    if tree.op == Op.GEQ and len(tree.children) == 2:
+
+@OPTIMIZE.rule(Op.GEQ)
+def remove_incomplete_geq(tree: SANode) -> Optional[SANode]:
+    if len(tree.children) == 2:
         return None
+    return tree
 
-    if tree.op in [Op.AND, Op.OR] and not tree.children:
+
+@OPTIMIZE.rule(Op.AND, Op.OR)
+def remove_empty(tree: SANode) -> Optional[SANode]:
+    if not tree.children:
         return None
+    return tree
 
-    if tree.op in [Op.AND, Op.OR] and len(tree.children) == 1:
-        return optimize_tree(tree.children[0])
 
+@OPTIMIZE.rule(Op.AND, Op.OR)
+def collapse_singleton(tree: SANode) -> SANode:
+    if len(tree.children) == 1:
+        return tree.children[0]
     return tree
 
 
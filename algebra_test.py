@@ -1,10 +1,13 @@
+import os
+import pickle
 import pytest
 
 from rdflib.namespace import RDF, XSD, SH
 from pytest import mark
 from rdflib import Graph, Namespace, Literal
 
-from algebra import parse, Op, SANode, optimize_tree, expand_shape
+from algebra import parse, Op, SANode, optimize_tree, expand_shape, \
+    expand_schema, normalize_schema, RecursiveShapeError, _parse_schema, dependent_shapes
 from pathalg import PANode, POp
 
 
@@ -170,6 +173,52 @@ def test_shape_expansion(graph_file, expected):
     assert expanded == expected
 
 
+def test_schema_expansion():
+    leaf = SANode(Op.GEQ, [Literal(1), PANode(POp.PROP, [EX.p]), SANode(Op.TOP, [])])
+    definitions = {
+        EX.shape1: SANode(Op.NOT, [SANode(Op.HASSHAPE, [EX.shared])]),
+        EX.shape2: SANode(Op.AND, [SANode(Op.HASSHAPE, [EX.shared]),
+                                   SANode(Op.HASSHAPE, [EX.undefined])]),
+        EX.shared: SANode(Op.HASSHAPE, [EX.leaf]),
+        EX.leaf: leaf}
+
+    expanded = expand_schema(definitions)
+    assert expanded[EX.shared] is leaf
+    assert expanded[EX.shape1] is SANode(Op.NOT, [leaf])
+    assert expanded[EX.shape2] is SANode(Op.AND, [leaf, SANode(Op.TOP, [])])
+    assert expand_shape(definitions, definitions[EX.shape2]) is expanded[EX.shape2]
+
+    normalized = normalize_schema(definitions, [EX.shape1])
+    assert list(normalized) == [EX.shape1]
+    assert normalized[EX.shape1] is SANode(Op.LEQ, [Literal(0), PANode(POp.PROP, [EX.p]),
+                                                    SANode(Op.NOT, [SANode(Op.TOP, [])])])
+
+
+def test_dependent_shapes():
+    definitions = {
+        EX.shape1: SANode(Op.NOT, [SANode(Op.HASSHAPE, [EX.shared])]),
+        EX.shape2: SANode(Op.HASSHAPE, [EX.shape1]),
+        EX.shared: SANode(Op.TOP, []),
+        EX.other: SANode(Op.HASSHAPE, [EX.undefined])}
+    assert dependent_shapes(definitions, [EX.shared]) == {EX.shared, EX.shape1, EX.shape2}
+    assert dependent_shapes(definitions, [EX.undefined]) == {EX.undefined}
+
+
+def test_recursive_shape():
+    definitions = {
+        EX.shape: SANode(Op.HASSHAPE, [EX.rec1]),
+        EX.rec1: SANode(Op.GEQ, [Literal(1), PANode(POp.PROP, [EX.p]),
+                                 SANode(Op.HASSHAPE, [EX.rec2])]),
+        EX.rec2: SANode(Op.NOT, [SANode(Op.HASSHAPE, [EX.rec1])]),
+        EX.other: SANode(Op.TOP, [])}
+
+    with pytest.raises(RecursiveShapeError):
+        expand_schema(definitions)
+    with pytest.raises(RecursiveShapeError):
+        expand_shape(definitions, definitions[EX.shape])
+    assert expand_schema(definitions, [EX.other]) == {EX.other: SANode(Op.TOP, [])}
+
+
 @mark.parametrize('graph_file, expected', [])
 def test_negation_normal_form(graph_file, expected):
     pass
@@ -185,3 +234,67 @@ def test_parse_targeting(graph_file, expected):
     pass
 
 
+@mark.parametrize('folder', ['tyrol', 'watdiv', 'bsbm'])
+def test_indexed_parsing(folder):
+    folder_path = f'./real_shacl_testfiles/{folder}'
+    for file in sorted(os.listdir(folder_path)):
+        g = Graph()
+        g.parse(f'{folder_path}/{file}', format='ttl')
+
+        definitions, targets = parse(g)
+        graph_definitions, graph_targets = _parse_schema(g)
+
+        assert list(definitions) == list(graph_definitions)
+        for name in definitions:
+            assert definitions[name] is graph_definitions[name]
+            assert targets[name] is graph_targets[name]
+
+
+def test_hash_consing():
+    first = SANode(Op.GEQ, [Literal(1), PANode(POp.PROP, [EX.p]),
+                            SANode(Op.HASVALUE, [EX.v])])
+    second = SANode(Op.GEQ, [Literal(1), PANode(POp.PROP, [EX.p]),
+                             SANode(Op.HASVALUE, [EX.v])])
+    assert first is second
+    assert len({first, second}) == 1
+    assert SANode(Op.TEST, ['pattern', Literal('^B'), [Literal('i')]]).children[2] == (Literal('i'),)
+
+    with pytest.raises(AttributeError):
+        first.children = ()
+
+
+def test_hash_consing_pickle():
+    node = SANode(Op.FORALL, [PANode(POp.PROP, [EX.p]), SANode(Op.TOP, [])])
+    assert pickle.loads(pickle.dumps(node)) is node
+
+
+def _deep_shapes_graph(depth):
+    g = Graph()
+    for i in range(depth):
+        prop = EX[f'prop{i}']
+        g.add((EX[f'shape{i}'], RDF.type, SH.NodeShape))
+        g.add((EX[f'shape{i}'], SH.property, prop))
+        g.add((prop, SH.path, EX.p))
+        g.add((prop, SH.node, EX[f'shape{i + 1}']))
+    g.add((EX[f'shape{depth}'], RDF.type, SH.NodeShape))
+    g.add((EX[f'shape{depth}'], SH.hasValue, EX.v))
+    return g
+
+
+def test_deep_schema():
+    # far deeper than the recursion limit
+    depth = 3000
+    definitions, targets = parse(_deep_shapes_graph(depth))
+    normalized = normalize_schema(definitions, [EX.shape0])
+
+    node, levels = normalized[EX.shape0], 0
+    while node.op == Op.FORALL:
+        node, levels = node.children[1], levels + 1
+    assert levels == depth and node is SANode(Op.HASVALUE, [EX.v])
+
+    negated = normalize_schema({EX.neg: SANode(Op.NOT, [SANode(Op.HASSHAPE, [EX.shape0])]),
+                                **definitions}, [EX.neg])[EX.neg]
+    levels = 0
+    while negated.op == Op.OR and negated.children[0].op == Op.GEQ:
+        negated, levels = negated.children[0].children[2], levels + 1
+    assert levels == depth
@@ -0,0 +1,131 @@
+import glob
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import compiler
+from cache import SchemaCache, DEFAULT_MAX_SIZE
+
+'''
+Batch compilation of shapes graph files
+
+compile_batch compiles the fragment query of every file in a process pool
+and writes it to a file of its own: the path of the shapes graph relative to
+the directory common to all of them, in output_dir, with the extension .rq
+(or next to the shapes graph without output_dir). The workers share the
+on-disk SchemaCache, a file compiled by one worker is a cache hit for every
+other worker and for later batches.
+'''
+
+
+class BatchResult:
+    """The compilation of one file of a batch"""
+
+    def __init__(self, filename: str, output: str, shapes: int, rebuilt: int,
+                 seconds: float, error: Optional[str] = None):
+        self.filename = filename
+        self.output = output  # the file the fragment query is written to
+        self.shapes = shapes  # number of shapes with a target
+        self.rebuilt = rebuilt  # number of those compiled, not taken from the cache
+        self.seconds = seconds
+        self.error = error  # the message when the file could not be compiled
+
+
+def shapes_files(patterns: List[str]) -> List[str]:
+    """
+    The Turtle files given by file names, directories (their .ttl files) and
+    glob patterns, in order and without duplicates. Raises ValueError for a
+    pattern without any file.
+    """
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(os.path.join(pattern, file) for file in os.listdir(pattern)
+                             if file.endswith('.ttl'))
+        elif os.path.isfile(pattern):
+            matches = [pattern]
+        else:
+            matches = sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+        if not matches:
+            raise ValueError(f'Could not find shapes graph files: {pattern}')
+        files += matches
+
+    unique = {}
+    for file in files:
+        unique.setdefault(os.path.abspath(file), file)
+    return list(unique.values())
+
+
+def output_files(files: List[str], output_dir: Optional[str] = None) -> List[str]:
+    """The file the fragment query of each file is written to"""
+    paths = [os.path.splitext(os.path.abspath(file))[0] + '.rq' for file in files]
+    if output_dir is None or not files:
+        return paths
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return [os.path.join(output_dir, os.path.relpath(path, root)) for path in paths]
+
+
+def compile_batch(files: List[str], output_dir: Optional[str] = None, ignore_tests=False,
+                  cache_dir: Optional[str] = None, cache_size: int = DEFAULT_MAX_SIZE,
+                  workers: Optional[int] = None) -> List[BatchResult]:
+    """
+    Compiles every file with workers processes (the number of CPUs by
+    default, one runs in this process) and writes the fragment queries. A
+    file that cannot be compiled has a BatchResult with an error.
+    """
+    outputs = output_files(files, output_dir)
+    if workers == 1:
+        _start_worker(cache_dir, cache_size)
+        return [_compile(file, output, ignore_tests) for file, output in zip(files, outputs)]
+
+    with ProcessPoolExecutor(workers, initializer=_start_worker,
+                             initargs=(cache_dir, cache_size)) as pool:
+        # a few files per task, the results come back in order
+        chunksize = max(1, len(files) // (4 * (workers or os.cpu_count() or 1)))
+        return list(pool.map(_compile, files, outputs, [ignore_tests] * len(files),
+                             chunksize=chunksize))
+
+
+def summary(results: List[BatchResult], seconds: float) -> str:
+    """The throughput of a batch that took seconds"""
+    compiled = [result for result in results if result.error is None]
+    shapes = sum(result.shapes for result in compiled)
+    rebuilt = sum(result.rebuilt for result in compiled)
+    times = sorted(result.seconds for result in results)
+    # nearest rank
+    p95 = times[math.ceil(0.95 * len(times)) - 1] if times else 0.0
+    seconds = max(seconds, 1e-9)
+    return '\n'.join([
+        f'Compiled {len(compiled)} of {len(results)} files, {shapes} shapes '
+        f'({rebuilt} not cached) in {seconds:.2f} s',
+        f'{len(compiled) / seconds:.1f} files/s, {shapes / seconds:.1f} shapes/s, '
+        f'p95 {p95 * 1000:.1f} ms per file',
+    ])
+
+
+# the cache of a worker process
+_cache = None
+
+
+def _start_worker(cache_dir: Optional[str], cache_size: int):
+    global _cache
+    _cache = SchemaCache(cache_dir, cache_size) if cache_dir else None
+
+
+def _compile(filename: str, output: str, ignore_tests: bool) -> BatchResult:
+    start = time.perf_counter()
+    try:
+        compiled = compiler.compile_file(filename, ignore_tests, _cache)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w') as f:
+            compiler.write_fragment_query(compiled, f)
+            f.write('\n')
+    except compiler.ShapesFileError as e:
+        return BatchResult(filename, output, 0, 0, time.perf_counter() - start,
+                           f'Could not parse file: {filename}\n{e}')
+    except (ValueError, OSError) as e:  # including algebra.RecursiveShapeError
+        return BatchResult(filename, output, 0, 0, time.perf_counter() - start, str(e))
+    return BatchResult(filename, output, len(compiled.targeted), len(compiled.rebuilt),
+                       time.perf_counter() - start)
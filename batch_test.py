@@ -0,0 +1,53 @@
+import os
+
+from pytest import raises
+
+import batch
+import compiler
+
+TYROL = './real_shacl_testfiles/tyrol'
+WATDIV = './real_shacl_testfiles/watdiv'
+
+
+def test_shapes_files():
+    files = batch.shapes_files([TYROL, f'{WATDIV}/F*.ttl', f'{TYROL}/wineryshape.ttl'])
+    tyrol = [file for file in sorted(os.listdir(TYROL)) if file.endswith('.ttl')]
+    assert files[:len(tyrol)] == [os.path.join(TYROL, file) for file in tyrol]
+    # wineryshape.ttl is in tyrol already
+    assert files[len(tyrol):] == sorted(os.path.join(WATDIV, file) for file in os.listdir(WATDIV)
+                                        if file.startswith('F') and file.endswith('.ttl'))
+
+    with raises(ValueError):
+        batch.shapes_files(['./missing/*.ttl'])
+
+
+def test_output_files(tmp_path):
+    files = [f'{TYROL}/wineryshape.ttl', f'{WATDIV}/F3.ttl']
+    assert batch.output_files(files, str(tmp_path)) == \
+        [str(tmp_path / 'tyrol' / 'wineryshape.rq'), str(tmp_path / 'watdiv' / 'F3.rq')]
+    assert batch.output_files(files[:1]) == [os.path.abspath(f'{TYROL}/wineryshape.rq')]
+
+
+def test_compile_batch(tmp_path):
+    files = batch.shapes_files([f'{TYROL}/w*.ttl', f'{WATDIV}/F*.ttl'])
+    bad = tmp_path / 'bad.ttl'
+    bad.write_text('not turtle')
+    files.append(str(bad))
+    cache_dir = str(tmp_path / 'cache')
+
+    results = batch.compile_batch(files, str(tmp_path / 'out'), cache_dir=cache_dir, workers=2)
+    assert [result.filename for result in results] == files
+    for result in results[:-1]:
+        assert result.error is None
+        assert result.rebuilt == result.shapes
+        with open(result.output) as f:
+            assert f.read() == compiler.fragment_query(compiler.compile_file(result.filename)) + '\n'
+    assert results[-1].error.startswith(f'Could not parse file: {bad}')
+    assert not os.path.exists(results[-1].output)
+
+    # the cache is shared by the workers and the batches
+    results = batch.compile_batch(files, str(tmp_path / 'out'), cache_dir=cache_dir, workers=1)
+    assert sum(result.rebuilt for result in results) == 0
+    assert batch.summary(results, 1.0).startswith(
+        f'Compiled {len(files) - 1} of {len(files)} files, '
+        f'{sum(result.shapes for result in results)} shapes (0 not cached) in 1.00 s')
@@ -0,0 +1,550 @@
+import sys
+import os
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from rdflib import BNode, Graph, Literal, Namespace, URIRef
+from rdflib.collection import Collection
+from rdflib.namespace import RDF, SH
+
+import algebra
+import compiler
+import conformance
+import pathalg
+import patheval
+import sfquery
+import unaryquery
+from algebra import SANode, Op
+from cache import SchemaCache
+from pathalg import PANode, POp
+from testsupport import RECTANGLE_SHAPES, SPLIT_SHAPES, rectangles
+
+'''
+Benchmarks for the SHACL to SPARQL translation
+
+Run a benchmark with:
+    python benchmark.py parse [folder ...]
+    python benchmark.py optimize [folder ...]
+    python benchmark.py deep [depth]
+    python benchmark.py cache [folder ...]
+    python benchmark.py imports [file]
+    python benchmark.py emit [depth]
+    python benchmark.py evaluate [size]
+    python benchmark.py prepared [count]
+    python benchmark.py focus [size ...]
+    python benchmark.py parallel [size] [sparql] [folder ...]
+    python benchmark.py encoded [size]
+    python benchmark.py closure [size]
+    python benchmark.py extract [size]
+
+Every benchmark prints one line per measurement, times are the best of a
+number of repetitions.
+'''
+
+REPEAT = 5
+
+
+def _best_time(function, *args, repeat=REPEAT):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _shapes_graphs(folders):
+    graphs = []
+    for folder in folders:
+        for file in sorted(os.listdir(folder)):
+            if file.endswith('.ttl'):
+                graph = Graph()
+                graph.parse(os.path.join(folder, file), format='ttl')
+                graphs.append(graph)
+    return graphs
+
+
+def bench_parse(folders):
+    '''algebra.parse (indexed) against the same parser on plain Graph lookups'''
+    graphs = _shapes_graphs(folders or ['./real_shacl_testfiles/tyrol'])
+
+    def parse_all(parse_function):
+        for graph in graphs:
+            parse_function(graph)
+
+    graph_lookups = _best_time(parse_all, algebra._parse_schema)
+    indexed = _best_time(parse_all, algebra.parse)
+
+    print(f'parse: {len(graphs)} shapes graphs')
+    print(f'graph lookups  {graph_lookups * 1000:9.2f} ms')
+    print(f'indexed        {indexed * 1000:9.2f} ms')
+    print(f'speedup        {graph_lookups / indexed:9.2f} x')
+
+
+def _wide_conjunction(width):
+    ex = Namespace('http://ex.tt/')
+    top = SANode(Op.TOP, [])
+    children = []
+    for i in range(width):
+        geq = SANode(Op.GEQ, [Literal(1), PANode(POp.PROP, [ex[f'p{i}']]), top])
+        children.append(SANode(Op.AND, [geq, top]))
+        children.append(top)
+    return SANode(Op.AND, children)
+
+
+def bench_optimize(folders):
+    '''optimize_tree on wide conjunctions, and rule counts on real schemas'''
+    print('optimize: width of the conjunction')
+    for width in [500, 1000, 2000, 4000]:
+        tree = _wide_conjunction(width)
+        elapsed = _best_time(algebra.optimize_tree, tree)
+        print(f'{width:6d}  {elapsed * 1000:9.2f} ms')
+
+    graphs = _shapes_graphs(folders or ['./real_shacl_testfiles/tyrol'])
+    algebra.OPTIMIZE.fired.clear()
+    start = time.perf_counter()
+    for graph in graphs:
+        definitions, targets = algebra.parse(graph)
+        algebra.normalize_schema(definitions)
+    elapsed = time.perf_counter() - start
+    print(f'\nnormalize: {len(graphs)} shapes graphs in {elapsed * 1000:.2f} ms')
+    for line in algebra.OPTIMIZE.report():
+        print(line)
+
+
+def _deep_shapes_graph(depth):
+    # shape{i} has a property shape with sh:node shape{i + 1}, the last
+    # shape has a sh:alternativePath with depth alternatives
+    ex = Namespace('http://ex.tt/')
+    g = Graph()
+    for i in range(depth):
+        prop = ex[f'prop{i}']
+        g.add((ex[f'shape{i}'], RDF.type, SH.NodeShape))
+        g.add((ex[f'shape{i}'], SH.property, prop))
+        g.add((prop, SH.path, ex.p))
+        g.add((prop, SH.node, ex[f'shape{i + 1}']))
+
+    alternatives = BNode()
+    Collection(g, alternatives, [ex[f'p{i}'] for i in range(depth)])
+    path = BNode()
+    g.add((path, SH.alternativePath, alternatives))
+    g.add((ex[f'shape{depth}'], RDF.type, SH.NodeShape))
+    g.add((ex[f'shape{depth}'], SH.property, ex.last))
+    g.add((ex.last, SH.path, path))
+    g.add((ex.last, SH.minCount, Literal(1)))
+    return g, path
+
+
+def _chain_end(chain, depth, length):
+    for _ in range(depth - min(depth, length)):
+        chain = chain.children[1]
+    return chain
+
+
+def bench_deep(args):
+    '''the tree passes on a chain of nested shapes, 10000 deep by default'''
+    depth = int(args[0]) if args else 10000
+    ex = Namespace('http://ex.tt/')
+    g, alternative_path = _deep_shapes_graph(depth)
+    print(f'deep: {depth} nested shapes, {depth} alternative paths')
+
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        print(f'{name:16s} {(time.perf_counter() - start) * 1000:9.2f} ms')
+        return result
+
+    definitions, targets = timed('parse', algebra.parse, g)
+    expanded = timed('expand', algebra.expand_schema, definitions, [ex.shape0])[ex.shape0]
+    nnf = timed('nnf', algebra.negation_normal_form, SANode(Op.NOT, [expanded]))
+    timed('optimize', algebra.optimize_tree, nnf)
+    nnf = algebra.negation_normal_form(expanded)
+    normalized = algebra.optimize_tree(nnf)
+    path = timed('path parse', pathalg.parse, g, alternative_path)
+    timed('to_path', unaryquery.to_path, path)
+    timed('graph_paths', sfquery.graph_paths, path)
+    # the queries grow with the depth, emit them for the end of the chain
+    timed('to_uq', unaryquery.to_uq, _chain_end(normalized, depth, 1000))
+    timed('to_sfquery', sfquery.to_sfquery, _chain_end(normalized, depth, 100))
+
+
+def bench_cache(folders):
+    '''compile_file without cache, with an empty cache and with a warm cache'''
+    files = []
+    for folder in folders or ['./real_shacl_testfiles/tyrol']:
+        files += [os.path.join(folder, file) for file in sorted(os.listdir(folder))
+                  if file.endswith('.ttl')]
+
+    def compile_all(cache):
+        for file in files:
+            compiler.compile_file(file, False, cache)
+
+    with tempfile.TemporaryDirectory() as directory:
+        uncached = _best_time(compile_all, None, repeat=1)
+        cold = _best_time(compile_all, SchemaCache(directory), repeat=1)
+        warm = _best_time(compile_all, SchemaCache(directory))
+
+    print(f'cache: {len(files)} shapes graphs')
+    print(f'no cache       {uncached * 1000:9.2f} ms')
+    print(f'cold cache     {cold * 1000:9.2f} ms')
+    print(f'warm cache     {warm * 1000:9.2f} ms')
+
+
+IMPORTED_MODULES = ['rdflib', 'algebra', 'compiler', 'cache', 'conformance', 'ssf']
+
+
+def _import_time(module):
+    # the cumulative import time reported by the interpreter, in a fresh process
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    return int(result.stderr.strip().splitlines()[-1].split('|')[1]) / 1e6
+
+
+def _command_time(*args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'ssf.py', *args], capture_output=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    return time.perf_counter() - start
+
+
+def bench_imports(args):
+    '''start-up of ssf.py: import time of the modules and run time of --help and --info'''
+    file = os.path.abspath(args[0] if args else './algebra_testfiles/shape_basic.ttl')
+    print('imports: cumulative import time')
+    for module in IMPORTED_MODULES:
+        best = min(_import_time(module) for _ in range(REPEAT))
+        print(f'{module:14s} {best * 1000:9.2f} ms')
+
+    print('\nssf.py: run time')
+    print(f'--help         {_best_time(_command_time, "--help") * 1000:9.2f} ms')
+    print(f'--info         {_best_time(_command_time, "--info", file) * 1000:9.2f} ms')
+
+
+def _disjunction_chain(depth):
+    ex = Namespace('http://ex.tt/')
+    shape = SANode(Op.HASVALUE, [ex.v])
+    for i in range(depth):
+        shape = SANode(Op.OR, [SANode(Op.EXACTLY1, [PANode(POp.PROP, [ex[f'p{i}']])]), shape])
+    return shape
+
+
+def _peak_memory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _peak_rss(cache_dir, *args):
+    # the maximum resident set size of ssf.py, in KB on Linux
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen([sys.executable, 'ssf.py', *args], stdout=devnull,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   env={**os.environ, 'SSF_CACHE_DIR': cache_dir})
+        _, _, usage = os.wait4(process.pid, 0)
+        process.returncode = 0  # reaped by wait4
+    return usage.ru_maxrss
+
+
+def bench_emit(args):
+    '''query emission on a chain of 8000 disjunctions (or the depth given), and ssf.py --frag'''
+    depth = int(args[0]) if args else 8000
+    shape = _disjunction_chain(depth)
+    rope = sfquery.to_sfquery_rope(shape)
+    print(f'emit: {depth} nested disjunctions, {len(str(rope)) / 1e6:.1f} MB of query')
+    with open(os.devnull, 'w') as devnull:
+        for name, function, argument in [('translate', sfquery.to_sfquery_rope, shape),
+                                         ('join', str, rope),
+                                         ('write', rope.write, devnull)]:
+            elapsed = _best_time(function, argument)
+            peak = _peak_memory(function, argument)
+            print(f'{name:10s} {elapsed * 1000:9.2f} ms {peak / 1e6:9.2f} MB peak')
+
+    file = './real_shacl_testfiles/tyrol/hotelshape.ttl'
+    with tempfile.TemporaryDirectory() as directory:
+        rss = [_peak_rss(directory, '--frag', file) for _ in range(2)]
+    print(f'\nssf.py --frag {os.path.basename(file)}: peak RSS {rss[0] / 1024:.1f} MB, '
+          f'{rss[1] / 1024:.1f} MB cached')
+
+
+def bench_evaluate(args):
+    '''conformance.conforms on 1000 rectangles (or the size given), as SPARQL and native'''
+    size = int(args[0]) if args else 1000
+    data = rectangles(size)
+    shapes = Graph()
+    shapes.parse(data=RECTANGLE_SHAPES, format='ttl')
+    print(f'evaluate: {size} rectangles, {len(data)} triples')
+    sparql = _best_time(conformance.conforms, data, shapes, False, repeat=1)
+    native = _best_time(conformance.conforms, data, shapes, True)
+    assert conformance.conforms(data, shapes, True) == conformance.conforms(data, shapes, False)
+    print(f'sparql         {sparql * 1000:9.2f} ms')
+    print(f'native         {native * 1000:9.2f} ms {sparql / native:9.1f}x')
+
+
+def bench_focus(args):
+    '''conformance.conforms for 10 target nodes among 1000 to 20000 rectangles (or the sizes given), with and without focus'''
+    sizes = [int(arg) for arg in args] or [1000, 5000, 20000]
+    targets = ', '.join(f'ex:r{i}' for i in range(10))
+    shapes = Graph()
+    shapes.parse(data=RECTANGLE_SHAPES.replace('sh:targetClass ex:Rectangle', f'sh:targetNode {targets}'),
+                 format='ttl')
+    schema = conformance.PreparedSchema(shapes)
+    for size in sizes:
+        data = rectangles(size)
+        print(f'focus: {size} rectangles, {len(data)} triples')
+        results = {}
+        for name, focus in [('all nodes', False), ('focus', True)]:
+            results[name] = schema.conforms(data, True, focus)
+            elapsed = _best_time(schema.conforms, data, True, focus)
+            peak = _peak_memory(schema.conforms, data, True, focus)
+            print(f'{name:14} {elapsed * 1000:9.2f} ms {peak / 2 ** 20:9.2f} MB')
+        assert results['all nodes'] == results['focus']
+
+
+def _synthetic(schema, size):
+    # size nodes of the classes of the shapes, with values for their properties
+    classes = set()
+    properties = set()
+    seen = set()
+    todo = list(schema.shapes.values()) + list(schema.targets.values())
+    while todo:
+        node = todo.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        if isinstance(node, SANode) and node.op == Op.HASVALUE and isinstance(node.children[0], URIRef):
+            classes.add(node.children[0])
+        if isinstance(node, PANode) and node.pop == POp.PROP:
+            properties.add(node.children[0])
+        todo += [child for child in node.children if isinstance(child, (SANode, PANode))]
+    classes = sorted(classes)
+    properties = sorted(properties - {RDF.type})
+    ex = Namespace('http://ex.tt/')
+    choice = random.Random(0)
+    g = Graph()
+    for i in range(size):
+        subject = ex[f'n{i}']
+        if classes:
+            g.add((subject, RDF.type, classes[i % len(classes)]))
+        for p in choice.sample(properties, min(4, len(properties))):
+            g.add((subject, p, choice.choice([ex[f'n{choice.randrange(size)}'], Literal(i % 10),
+                                              Literal(f'value {i}')])))
+    return g
+
+
+def bench_parallel(args):
+    '''parallel.validate of 5000 synthetic nodes (or the number given) against the tyrol shapes (or the folders given), in 1 to N processes'''
+    import parallel
+    size = int(args[0]) if args and args[0].isdigit() else 5000
+    native = 'sparql' not in args
+    folders = [arg for arg in args if not arg.isdigit() and arg != 'sparql'] or ['real_shacl_testfiles/tyrol']
+    shapes = Graph()
+    for graph in _shapes_graphs(folders):
+        shapes += graph
+    schema = conformance.PreparedSchema(shapes)
+    data = _synthetic(schema, size)
+    print(f'parallel: {len(schema.shape_names)} shapes, {size} nodes, {len(data)} triples, '
+          f'{"native" if native else "sparql"}')
+    expected = None
+    for workers in range(1, (os.cpu_count() or 1) + 1):
+        start = time.perf_counter()
+        # every shape evaluated for all the nodes, the jobs are not trivial
+        results = parallel.validate(data, schema, native, workers, focus=False)
+        elapsed = time.perf_counter() - start
+        if expected is None:
+            expected = parallel.merge(results)
+            single = elapsed
+            slowest = sorted(results, key=lambda result: result.seconds, reverse=True)
+        assert parallel.merge(results) == expected
+        print(f'{workers:3} processes  {elapsed * 1000:9.2f} ms {single / elapsed:9.1f}x')
+    for result in slowest[:5]:
+        print(f'{str(result.shape_name)[-40:]:40} {result.seconds * 1000:9.2f} ms')
+
+
+def bench_prepared(args):
+    '''conformance queries validating 200 graphs of 5 rectangles (or the number given), prepared each time and once'''
+    count = int(args[0]) if args else 200
+    graphs = [rectangles(5) for _ in range(count)]
+    shapes = Graph()
+    shapes.parse(data=RECTANGLE_SHAPES, format='ttl')
+    print(f'prepared: {count} graphs of {len(graphs[0])} triples')
+    results = {}
+    for name, max_size in [('every time', 0), ('once', conformance.DEFAULT_MAX_QUERIES)]:
+        queries = conformance.QueryCache(max_size)
+        schema = conformance.PreparedSchema(shapes, queries)
+        start = time.perf_counter()
+        results[name] = [schema.conforms(graph, native=False) for graph in graphs]
+        elapsed = time.perf_counter() - start
+        stats = queries.stats()
+        print(f'{name:14} {elapsed * 1000:9.2f} ms {stats["hit_rate"] * 100:9.1f}% hits '
+              f'{stats["prepare_time"] * 1000:9.2f} ms preparing {stats["saved_time"] * 1000:9.2f} ms saved')
+    assert results['every time'] == results['once']
+
+
+def bench_encoded(args):
+    '''conformance.conforms on an EncodedGraph of 100000 rectangles (or the size given), and its memory'''
+    import encoded
+    size = int(args[0]) if args else 100000
+    data = rectangles(size)
+    shapes = Graph()
+    shapes.parse(data=RECTANGLE_SHAPES, format='ttl')
+    print(f'encoded: {size} rectangles, {len(data)} triples')
+    encoding = _best_time(encoded.EncodedGraph.from_triples, data, repeat=1)
+    graph = encoded.EncodedGraph.from_triples(data)
+    native = _best_time(conformance.conforms, data, shapes, True, repeat=1)
+    masks = _best_time(conformance.conforms, graph, shapes)
+    assert conformance.conforms(graph, shapes) == conformance.conforms(data, shapes)
+    print(f'encoding       {encoding * 1000:9.2f} ms')
+    print(f'native         {native * 1000:9.2f} ms')
+    print(f'masks          {masks * 1000:9.2f} ms {native / masks:9.1f}x')
+    evaluator = encoded.MaskEvaluator(graph)
+    parsed, targets = algebra.parse(shapes)
+    for shape in algebra.expand_schema(parsed, list(targets)).values():
+        evaluator.mask(shape)
+    for structure, nbytes in {**graph.memory(), **evaluator.memory()}.items():
+        print(f'{structure:14} {nbytes / 2 ** 20:9.2f} MB')
+
+
+def _searches(step, nodes):
+    # the nodes reached from every node, with a search from each
+    index = {}
+    for v in nodes:
+        reached = {v}
+        todo = [v]
+        while todo:
+            for value in step.get(todo.pop(), ()):
+                if value not in reached:
+                    reached.add(value)
+                    todo.append(value)
+        index[v] = reached
+    return index
+
+
+def bench_closure(args):
+    '''KLEENE paths on a hierarchy and a cycle of 2000 nodes (or the size given), with and without components'''
+    size = int(args[0]) if args else 2000
+    ex = Namespace('http://ex.tt/')
+    broader = PANode(POp.PROP, [ex.broader])
+    data = Graph()
+    for i in range(1, size):
+        data.add((ex[f'n{i}'], ex.broader, ex[f'n{i // 2}']))
+        data.add((ex[f'c{i}'], ex.next, ex[f'c{(i + 1) % size}']))
+    data.add((ex.c0, ex.next, ex.c1))
+    for name, path in [('hierarchy', broader), ('cycle', PANode(POp.PROP, [ex.next]))]:
+        paths = patheval.PathEvaluator(data)
+        step = paths.values(path)
+
+        def closure():
+            paths.invalidate()
+            return paths.values(PANode(POp.KLEENE, [path]))
+
+        components = _best_time(closure)
+        searches = _best_time(_searches, step, paths.universe, repeat=1)
+        print(f'{name:14} {components * 1000:9.2f} ms {searches * 1000:9.2f} ms searches '
+              f'{searches / components:9.1f}x')
+
+
+def bench_extract(args):
+    '''shape fragments of 300 rectangles (or the size given), native and encoded against the fragment query'''
+    import encoded
+    import fragment
+    import pipeline
+    from rdflib import Dataset
+    size = int(args[0]) if args else 300
+    data = rectangles(size)
+    dataset = Dataset()
+    for triple in data:
+        dataset.add(triple)
+    shapes = Graph()
+    shapes.parse(data=RECTANGLE_SHAPES, format='ttl')
+    compiled = compiler.compile_schema(shapes)
+    graph = encoded.EncodedGraph.from_triples(data)
+    print(f'extract: {size} rectangles, {len(data)} triples')
+
+    def sparql():
+        return {row[1:] for row in pipeline.run_fragment_query(compiled, dataset) if row[1] is not None}
+
+    def native(graph):
+        with open(os.devnull, 'w') as sink:
+            return fragment.write_ntriples(fragment.extract(compiled, graph), sink)
+
+    expected = sparql()
+    assert set(fragment.extract(compiled, data)) == expected
+    assert set(fragment.extract(compiled, graph)) == expected
+    print(f'fragment       {len(expected):9} triples')
+    reference = _best_time(sparql, repeat=1)
+    print(f'sparql         {reference * 1000:9.2f} ms {_peak_memory(sparql) / 2 ** 20:9.2f} MB')
+    for name, target in [('native', data), ('encoded', graph)]:
+        elapsed = _best_time(native, target)
+        print(f'{name:14} {elapsed * 1000:9.2f} ms {_peak_memory(native, target) / 2 ** 20:9.2f} MB '
+              f'{reference / elapsed:9.1f}x')
+
+
+def bench_split(args):
+    '''the fragment query of 40 rectangles (or the size given) as one UNION and as a query per shape, in 1 and 4 threads'''
+    import split
+    size = int(args[0]) if args else 40
+    data = rectangles(size)
+    shapes = Graph()
+    shapes.parse(data=SPLIT_SHAPES, format='ttl')
+    compiled = compiler.compile_schema(shapes)
+    print(f'split: {len(compiled.targeted)} shapes, {size} rectangles, {len(data)} triples')
+
+    def union():
+        first = None
+        rows = set()
+        for row in data.query(compiler.fragment_query(compiled)):
+            first = first or time.perf_counter()
+            rows.add(tuple(row))
+        return rows, first
+
+    def per_shape(workers):
+        first = []
+        sink = split.RowSink(lambda row: first or first.append(time.perf_counter()))
+        split.run_local(compiled, data, sink, workers)
+        return sink.rows, first[0]
+
+    start = time.perf_counter()
+    expected, first = union()
+    reference = time.perf_counter() - start
+    print(f'union          {reference * 1000:9.2f} ms, first row {(first - start) * 1000:9.2f} ms, '
+          f'{len(expected)} rows')
+    for workers in [1, 4]:
+        start = time.perf_counter()
+        rows, first = per_shape(workers)
+        elapsed = time.perf_counter() - start
+        assert rows == expected
+        print(f'{workers} threads      {elapsed * 1000:9.2f} ms, first row {(first - start) * 1000:9.2f} ms '
+              f'{reference / elapsed:9.1f}x')
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'optimize': bench_optimize,
+    'deep': bench_deep,
+    'cache': bench_cache,
+    'imports': bench_imports,
+    'emit': bench_emit,
+    'evaluate': bench_evaluate,
+    'prepared': bench_prepared,
+    'focus': bench_focus,
+    'parallel': bench_parallel,
+    'encoded': bench_encoded,
+    'closure': bench_closure,
+    'extract': bench_extract,
+    'split': bench_split,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f'{sys.argv[0]} {{{" | ".join(BENCHMARKS)}}} [arguments]')
+        exit(1)
+    BENCHMARKS[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from typing import Optional
+
+from rdflib import Graph
+from rdflib.compare import to_isomorphic
+
+'''
+On-disk cache of compiled shapes graphs
+
+A compiled schema is stored under the graph key: a hash of the canonical form
+of the shapes graph (blank node labels and Turtle formatting do not matter)
+and the compiler options. Computing it needs the parsed graph, so every file
+the schema was compiled from gets an alias: a hash of the bytes of the file
+and the options, pointing to the graph key. A file that was compiled before
+is found through its alias, without parsing it. An alias of the path of a
+file points to the schema last compiled from it, the starting point of an
+incremental compilation.
+
+The cache holds at most max_size bytes. When it grows larger, the least
+recently used entries are removed; using an entry updates its mtime.
+'''
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+_SCHEMA = '.schema'
+_ALIAS = '.alias'
+
+
+class SchemaCache:
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        # compilations found in the cache and not, counted by compiler.compile_file
+        self.hits = 0
+        self.misses = 0
+
+    def file_key(self, contents: bytes, options: str) -> str:
+        return _hash(contents, options)
+
+    def graph_key(self, graph: Graph, options: str) -> str:
+        digest = to_isomorphic(graph).graph_digest()
+        return _hash(str(digest).encode(), options)
+
+    def alias(self, key: str) -> Optional[str]:
+        """The graph key an alias (like a file key) points to, or None"""
+        graph_key = self._read(key + _ALIAS)
+        return graph_key.decode() if graph_key is not None else None
+
+    def get(self, graph_key: Optional[str]):
+        """The compiled schema of a shapes graph, or None"""
+        if graph_key is None:
+            return None
+        data = self._read(graph_key + _SCHEMA)
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:  # an entry of an older version, or damaged
+            self._remove(graph_key + _SCHEMA)
+            return None
+
+    def put(self, graph_key: str, compiled):
+        """
+        Stores a compiled schema. Caching is best effort: when the schema
+        cannot be stored, nothing is stored.
+        """
+        try:
+            data = pickle.dumps(compiled, protocol=pickle.HIGHEST_PROTOCOL)
+        except (RecursionError, pickle.PicklingError):  # a very deep schema
+            return
+        self._write(graph_key + _SCHEMA, data)
+        self.evict()
+
+    def put_alias(self, key: str, graph_key: str):
+        self._write(key + _ALIAS, graph_key.encode())
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits max_size"""
+        try:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith((_SCHEMA, _ALIAS)):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.name))
+        except OSError:
+            return
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            self._remove(name)
+            size -= entry_size
+
+    def _read(self, name: str) -> Optional[bytes]:
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # recently used
+        except OSError:
+            return None
+        return data
+
+    def _write(self, name: str, data: bytes) -> bool:
+        # written to a temporary file first, readers never see half an entry
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        except OSError:
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, os.path.join(self.directory, name))
+        except OSError:
+            self._remove(os.path.basename(temporary))
+            return False
+        return True
+
+    def _remove(self, name: str):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+
+def _hash(data: bytes, options: str) -> str:
+    digest = hashlib.sha256(data)
+    digest.update(b'\0' + options.encode())
+    return digest.hexdigest()
@@ -0,0 +1,60 @@
+import os
+
+from pytest import mark
+from rdflib import Graph
+
+import compiler
+from cache import SchemaCache
+
+SHAPES = './real_shacl_testfiles/tyrol/wineryshape.ttl'
+
+
+def _no_parsing(filename):
+    raise AssertionError(f'{filename} is parsed')
+
+
+@mark.parametrize('ignore_tests', [False, True])
+def test_cached_compilation(tmp_path, monkeypatch, ignore_tests):
+    cache = SchemaCache(str(tmp_path / 'cache'))
+    compiled = compiler.compile_file(SHAPES, ignore_tests, cache)
+    assert (cache.hits, cache.misses) == (0, 1)
+    expected = compiler.compile_file(SHAPES, ignore_tests)
+    assert compiler.fragment_query(compiled) == compiler.fragment_query(expected)
+
+    monkeypatch.setattr(compiler, 'parse_file', _no_parsing)
+    cached = compiler.compile_file(SHAPES, ignore_tests, cache)
+    assert cache.hits == 1
+    assert cached.queries == compiled.queries
+    for name in compiled.targeted:
+        assert cached.shapes[name] is compiled.shapes[name]
+
+
+def test_isomorphic_graph(tmp_path):
+    cache = SchemaCache(str(tmp_path / 'cache'))
+    compiler.compile_file(SHAPES, False, cache)
+    compiler.compile_file(SHAPES, True, cache)
+    assert cache.misses == 2
+
+    # the same shapes graph, in another format with other blank node labels
+    g = Graph()
+    g.parse(SHAPES, format='ttl')
+    reformatted = tmp_path / 'reformatted.ttl'
+    g.serialize(str(reformatted), format='nt', encoding='utf-8')
+    compiler.compile_file(str(reformatted), False, cache)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # two schemas, and an alias of the contents and of the path per file and option
+    entries = sorted(name.rsplit('.')[-1] for name in os.listdir(cache.directory))
+    assert entries == ['alias'] * 6 + ['schema'] * 2
+
+
+def test_eviction(tmp_path):
+    cache = SchemaCache(str(tmp_path))
+    for i in range(3):
+        cache.put(f'key{i}', list(range(1000)))
+        os.utime(tmp_path / f'key{i}.schema', (i, i))
+    assert cache.get('key0') is not None  # now the most recently used
+
+    cache.max_size = 2 * os.path.getsize(tmp_path / 'key0.schema')
+    cache.evict()
+    assert sorted(os.listdir(tmp_path)) == ['key0.schema', 'key2.schema']
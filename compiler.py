@@ -0,0 +1,325 @@
+import hashlib
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Set
+
+from rdflib import Graph, BNode
+
+import algebra
+import plan
+from algebra import SANode, Op
+from emit import Rope
+from rewrite import RuleSet
+from sfquery import to_sfquery_plan
+from unaryquery import ConformanceQueries
+
+'''
+Compilation of a shapes graph to its shape fragment query
+
+compile_schema runs the whole pipeline of ssf --frag on a parsed shapes
+graph and keeps the intermediate results in a CompiledSchema. Given the
+CompiledSchema of a previous version of the shapes graph, it only compiles
+the shapes whose definition changed, and the shapes that refer to those.
+
+compile_file does the same for a Turtle file, going through a SchemaCache
+(cache.py) when one is given: a cached schema is returned without parsing
+the file, and a changed file is compiled incrementally from the schema last
+compiled for the same path.
+'''
+
+# modules whose code determines the compiled queries
+_COMPILER_MODULES = ['algebra', 'pathalg', 'rewrite', 'trampoline', 'emit', 'plan',
+                     'unaryquery', 'sfquery', 'compiler']
+
+
+class ShapesFileError(ValueError):
+    """A shapes graph file that cannot be read or parsed"""
+
+
+class CompiledSchema:
+    """The compiled form of a shapes graph"""
+
+    def __init__(self, definitions: Dict, targets: Dict, targeted: List, expanded: Dict,
+                 normalized: Dict, shapes: Dict, queries: Dict, ignore_tests: bool,
+                 rebuilt: List, universe: Dict):
+        self.definitions = definitions  # shape name -> parsed definition
+        self.targets = targets  # shape name -> target definition
+        self.targeted = targeted  # names of the shapes with a target, in order
+        self.expanded = expanded  # shape name -> expanded definition
+        self.normalized = normalized  # shape name -> expanded definition in nnf, optimized
+        self.shapes = shapes  # shape name -> normalized definition and target, as translated
+        self.queries = queries  # shape name -> shape fragment query
+        self.ignore_tests = ignore_tests
+        self.rebuilt = rebuilt  # names of the targeted shapes compiled by the last compilation
+        # shape name -> the constructs of its query that scan all the nodes of the graph
+        self.universe = universe
+
+
+# Optimizations for when we know we want to ignore tests
+IGNORE_TESTS = RuleSet('ignore_tests')
+
+
+@IGNORE_TESTS.rule(Op.TEST)
+def replace_test_with_top(tree: SANode) -> SANode:
+    return SANode(Op.TOP, [])
+
+
+@IGNORE_TESTS.rule(Op.AND)
+def remove_top_from_conjunction(tree: SANode) -> SANode:
+    # handle TOP children
+    if any(map(lambda c: c.op == Op.TOP, tree.children)):
+        new_children = list(filter(lambda c: c.op != Op.TOP, tree.children))
+        if len(new_children) == 0:
+            return SANode(Op.TOP, [])
+        elif len(new_children) == 1:
+            return new_children[0]
+        return SANode(Op.AND, new_children)
+    return tree
+
+
+@IGNORE_TESTS.rule(Op.AND)
+def conjunction_with_bottom(tree: SANode) -> SANode:
+    # handle NOT TOP children
+    if any(map(lambda c: c.op == Op.NOT and c.children[0].op == Op.TOP, tree.children)):
+        return SANode(Op.NOT, [SANode(Op.TOP, [])])
+    return tree
+
+
+@IGNORE_TESTS.rule(Op.AND)
+def merge_exactly1(tree: SANode) -> SANode:
+    # Optimization: if there is a GEQ 1 E TOP and LEQ 1 E TOP in its children, replace both with EXACTLY 1
+    is_geq_one_top = lambda c: c.op == Op.GEQ and \
+                            int(c.children[0]) == 1 and \
+                            c.children[2].op == Op.TOP
+    is_leq_one_top = lambda c: c.op == Op.LEQ and \
+                            int(c.children[0]) == 1 and \
+                            c.children[2].op == Op.TOP
+
+    children = list(tree.children)
+    leq_one_tops = list(filter(is_leq_one_top, children))
+    for geq_one in filter(is_geq_one_top, tree.children):
+        for leq_one in leq_one_tops:
+            if geq_one.children[1] == leq_one.children[1]:
+                children.append(SANode(Op.EXACTLY1, [geq_one.children[1]]))
+                children.remove(geq_one)
+                children.remove(leq_one)
+                leq_one_tops.remove(leq_one)
+                break
+    return SANode(Op.AND, children)
+
+
+@IGNORE_TESTS.rule(Op.OR)
+def remove_bottom_from_disjunction(tree: SANode) -> SANode:
+    # handle NOT TOP children
+    if any(map(lambda c: c.op == Op.NOT and c.children[0].op == Op.TOP, tree.children)):
+        new_children = list(filter(lambda c: not (c.op == Op.NOT and c.children[0].op == Op.TOP), tree.children))
+        if len(new_children) == 0:
+            return SANode(Op.NOT, [SANode(Op.TOP, [])])
+        elif len(new_children) == 1:
+            return new_children[0]
+        return SANode(Op.OR, new_children)
+    return tree
+
+
+@IGNORE_TESTS.rule(Op.OR)
+def keep_one_top_in_disjunction(tree: SANode) -> SANode:
+    # handle multiple TOP
+    if any(map(lambda c: c.op == Op.TOP, tree.children)):
+        new_children = list(filter(lambda c: c.op != Op.TOP, tree.children))
+        if len(new_children) == 0:  # they were all TOP
+            return SANode(Op.TOP, [])
+        # they were not all TOP, but we need one to keep conformance semantics
+        new_children.append(SANode(Op.TOP, []))
+        return SANode(Op.OR, new_children)
+    return tree
+
+
+@IGNORE_TESTS.rule(Op.NOT)
+def remove_double_negation_of_top(tree: SANode) -> SANode:
+    if tree.children[0].op == Op.NOT and \
+            tree.children[0].children[0].op == Op.TOP:
+        return SANode(Op.TOP, [])
+    return tree
+
+
+def compile_schema(shapesgraph: Graph, ignore_tests=False,
+                   previous: Optional[CompiledSchema] = None) -> CompiledSchema:
+    """
+    Compiles every shape with a target. With previous, the compiled form of
+    an earlier version of the shapes graph, the results of the shapes that
+    are not affected by the changes are reused.
+    Raises algebra.RecursiveShapeError for a recursive schema.
+    """
+    definitions, targets = algebra.parse(shapesgraph, ignore_tests=False)
+
+    # we ignore the shapes that do not have any targets
+    targeted = [shape_name for shape_name in definitions
+                if shape_name in targets and
+                targets[shape_name] != SANode(Op.NOT, [SANode(Op.TOP, [])])]
+
+    expanded = {}
+    reused = set()
+    if previous is not None and previous.ignore_tests == ignore_tests:
+        changed = changed_shapes(previous.definitions, definitions)
+        # blank node labels are not the same in both versions
+        expanded = {shape_name: shape for shape_name, shape in previous.expanded.items()
+                    if shape_name in definitions and shape_name not in changed and
+                    type(shape_name) != BNode}
+        reused = {shape_name for shape_name in targeted
+                  if shape_name in previous.queries and shape_name not in changed and
+                  type(shape_name) != BNode and
+                  targets[shape_name] is previous.targets[shape_name]}
+    rebuilt = [shape_name for shape_name in targeted if shape_name not in reused]
+
+    # expand every targeted shape, each referenced shape only once
+    # put the shape in negation normal form and optimize it
+    normalized = algebra.normalize_schema(definitions, rebuilt, expanded)
+
+    # add its target statement as a conjunction
+    # optimize this expression (remove redundancies from algebra)
+    memo = {}
+    shapes = {}
+    for shape_name in rebuilt:
+        shapes[shape_name] = algebra.optimize_tree(
+            SANode(Op.AND, [normalized[shape_name], targets[shape_name]]), memo)
+
+    # Until now, everything is processed nicely as usual.
+    # However, when we know we want to ignore tests we can do some nice alterations
+    # on the syntax tree:
+    # 1. Replace every occurrence of a test-node to a top-node
+    # 2. Apply optimizations:
+    #    - remove tops from conjunction
+    #    - remove tops from disjunction (shapefragment-semantically the same BUT not a good optimization!!
+    #      because the tree must be correct wrt conformance at any time...)
+    #    - replace disjunction with only TOPs with TOP
+    #    - replace conjunctions with == 0 children with TOP
+    #    - replace conjunctions with == 1 child with the child
+    #    - search and replace "exactly one pattern"
+    if ignore_tests:
+        memo = {}
+        shapes = {shape_name: IGNORE_TESTS.rewrite(shape, memo)
+                  for shape_name, shape in shapes.items()}
+
+    # translate every shape to a shape fragment query
+    # here, the ignore_tests works only at translation time
+    # the shapes share the conformance queries of their common subshapes
+    conformance = ConformanceQueries()
+    plans = {shape_name: to_sfquery_plan(shape, False, conformance)
+             for shape_name, shape in shapes.items()}
+    queries = {shape_name: str(conformance.sparql(query)) for shape_name, query in plans.items()}
+    universe = {shape_name: sorted(plan.universe(query)) for shape_name, query in plans.items()}
+
+    for shape_name in reused:
+        normalized[shape_name] = previous.normalized[shape_name]
+        shapes[shape_name] = previous.shapes[shape_name]
+        queries[shape_name] = previous.queries[shape_name]
+        universe[shape_name] = previous.universe[shape_name]
+
+    return CompiledSchema(definitions, targets, targeted, expanded, normalized,
+                          shapes, queries, ignore_tests, rebuilt, universe)
+
+
+def changed_shapes(old_definitions: Dict, new_definitions: Dict) -> Set:
+    """
+    The shapes that are added, removed or defined differently, and the shapes
+    that refer to those, directly or indirectly. Blank node shapes are
+    compared as part of the shapes that refer to them.
+    """
+    old_signatures = algebra.shape_signatures(old_definitions)
+    new_signatures = algebra.shape_signatures(new_definitions)
+    # nodes are hash-consed, an unchanged signature is the same node
+    changed = [shape_name for shape_name in old_signatures.keys() | new_signatures.keys()
+               if old_signatures.get(shape_name) is not new_signatures.get(shape_name)]
+    # removed shapes are included, their references changed meaning
+    return algebra.dependent_shapes({**old_definitions, **new_definitions}, changed)
+
+
+def fragment_query(compiled: CompiledSchema) -> str:
+    """The union of the queries of every shape"""
+    return str(fragment_rope(compiled))
+
+
+def write_fragment_query(compiled: CompiledSchema, sink):
+    """Writes fragment_query to sink, an object with a write(str) method"""
+    fragment_rope(compiled).write(sink)
+
+
+def fragment_rope(compiled: CompiledSchema, queries: Optional[Dict] = None) -> Rope:
+    """fragment_query as an emit.Rope, of queries (shape name -> query) instead of compiled.queries"""
+    queries = queries if queries is not None else compiled.queries
+    parts = ['SELECT ?v ?s ?p ?o WHERE { ']
+    for shape_name in compiled.targeted:
+        parts += ['''
+        # new shape as query
+        { ''', queries[shape_name], ' } UNION ']
+    # without the last 'UNION '
+    parts[-1] = parts[-1][:-6]
+    parts.append('}')
+    return Rope(parts)
+
+
+def compile_file(filename: str, ignore_tests=False, cache=None) -> CompiledSchema:
+    """
+    Compiles the Turtle file filename. With a cache.SchemaCache, a file that
+    was compiled before (or an isomorphic shapes graph) is not compiled again,
+    and a changed file is compiled incrementally.
+    Raises ShapesFileError when the file cannot be read or parsed.
+    """
+    options = compiler_options(ignore_tests)
+    if cache is None:
+        return compile_schema(parse_file(filename), ignore_tests)
+
+    try:
+        with open(filename, 'rb') as f:
+            contents = f.read()
+    except OSError as e:
+        raise ShapesFileError(e) from e
+    file_key = cache.file_key(contents, options)
+    path_key = cache.file_key(os.path.abspath(filename).encode(), 'path ' + options)
+
+    graph_key = cache.alias(file_key)
+    compiled = cache.get(graph_key)
+    if compiled is None:
+        shapesgraph = parse_file(filename)
+        graph_key = cache.graph_key(shapesgraph, options)
+        compiled = cache.get(graph_key)
+        cache.put_alias(file_key, graph_key)
+
+    if compiled is None:
+        # compile incrementally from the last version of the file
+        previous = cache.get(cache.alias(path_key))
+        compiled = compile_schema(shapesgraph, ignore_tests, previous)
+        cache.put(graph_key, compiled)
+        cache.misses += 1
+    else:
+        compiled.rebuilt = []
+        cache.hits += 1
+
+    if cache.alias(path_key) != graph_key:
+        cache.put_alias(path_key, graph_key)
+    return compiled
+
+
+def compiler_options(ignore_tests=False) -> str:
+    """The options of a compilation, and the version of the compiler"""
+    return f'ignore_tests={ignore_tests} compiler={_compiler_version()}'
+
+
+@lru_cache(maxsize=None)
+def _compiler_version() -> str:
+    # the hash of the compiler code, so a changed compiler does not reuse old results
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in _COMPILER_MODULES:
+        with open(os.path.join(directory, module + '.py'), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def parse_file(filename: str) -> Graph:
+    shapesgraph = Graph()
+    try:
+        shapesgraph.parse(filename, format='ttl')
+    except Exception as e:
+        raise ShapesFileError(e) from e
+    return shapesgraph
@@ -0,0 +1,68 @@
+from rdflib import Graph, Namespace
+
+import compiler
+from cache import SchemaCache
+
+EX = Namespace('http://ex.tt/')
+
+SHAPES = '''
+@prefix sh: <http://www.w3.org/ns/shacl#> .
+@prefix ex: <http://ex.tt/> .
+
+ex:a a sh:NodeShape ;
+    sh:targetClass ex:A ;
+    sh:property [ sh:path ex:p ; sh:node ex:b ] .
+
+ex:b a sh:NodeShape ;
+    sh:property [ sh:path ex:q ; sh:minCount {mincount} ] .
+
+ex:c a sh:NodeShape ;
+    sh:targetClass ex:C ;
+    sh:property [ sh:path ex:r ; sh:maxCount 2 ] .
+
+ex:d a sh:NodeShape ;
+    sh:targetNode ex:d1 ;
+    sh:node ex:b ;
+    sh:class ex:{dclass} .
+'''
+
+
+def _graph(mincount=1, dclass='D'):
+    g = Graph()
+    g.parse(data=SHAPES.format(mincount=mincount, dclass=dclass), format='ttl')
+    return g
+
+
+def test_incremental_compilation():
+    previous = compiler.compile_schema(_graph())
+    assert previous.rebuilt == [EX.a, EX.c, EX.d]
+
+    unchanged = compiler.compile_schema(_graph(), previous=previous)
+    assert unchanged.rebuilt == []
+    assert unchanged.queries == previous.queries
+
+    # ex:a and ex:d refer to ex:b
+    changed = compiler.compile_schema(_graph(mincount=2), previous=previous)
+    assert changed.rebuilt == [EX.a, EX.d]
+    assert changed.queries[EX.c] is previous.queries[EX.c]
+    assert compiler.fragment_query(changed) == \
+        compiler.fragment_query(compiler.compile_schema(_graph(mincount=2)))
+
+    changed = compiler.compile_schema(_graph(dclass='E'), previous=previous)
+    assert changed.rebuilt == [EX.d]
+
+    # other options compile everything
+    changed = compiler.compile_schema(_graph(), ignore_tests=True, previous=previous)
+    assert changed.rebuilt == [EX.a, EX.c, EX.d]
+
+
+def test_incremental_file_compilation(tmp_path):
+    cache = SchemaCache(str(tmp_path / 'cache'))
+    shapes_file = tmp_path / 'shapes.ttl'
+    shapes_file.write_text(SHAPES.format(mincount=1, dclass='D'))
+    assert compiler.compile_file(str(shapes_file), cache=cache).rebuilt == [EX.a, EX.c, EX.d]
+    assert compiler.compile_file(str(shapes_file), cache=cache).rebuilt == []
+
+    shapes_file.write_text(SHAPES.format(mincount=1, dclass='E'))
+    assert compiler.compile_file(str(shapes_file), cache=cache).rebuilt == [EX.d]
+    assert (cache.hits, cache.misses) == (1, 2)
@@ -1,44 +1,201 @@
-import mypy
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import TYPE_CHECKING, Optional, Tuple, Union
+
 import rdflib
+from rdflib.term import BNode
+
+from algebra import SANode, parse, expand_schema
+from evaluator import Evaluator
+from unaryquery import ConformanceQueries, to_uq, to_uq_rope
+
+if TYPE_CHECKING:
+    import encoded
+    from rdflib.plugins.sparql.sparql import Query
+
+'''
+Conformance of data graphs to shapes graphs
+
+A PreparedSchema parses and expands a shapes graph once, to validate any
+number of data graphs. Without the native evaluator, the conformance query of
+every shape and target is parsed and translated to the SPARQL algebra once, by
+rdflib's prepareQuery, and kept in a QueryCache: a validation only evaluates
+the prepared queries. The cache is bounded, the least recently used queries
+are dropped, and it is keyed by the shapes (SANodes are hash-consed), so the
+schemas with the same shapes share their queries.
+
+With focus, the shapes are evaluated for the target nodes only, instead of
+computing all the conforming nodes of the graph and keeping the targets among
+them: by Evaluator.focus, or by conformance queries with the target nodes in a
+VALUES block, batch_size nodes per query. Those queries differ for every
+batch, they are not prepared.
+'''
+
+DEFAULT_MAX_QUERIES = 1024
+DEFAULT_BATCH_SIZE = 1000
+
+
+class QueryCache:
+    """The prepared conformance queries of the most recently used shapes"""
+
+    def __init__(self, max_size: int = DEFAULT_MAX_QUERIES):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.prepare_time = 0.0  # seconds spent preparing queries
+        self.saved_time = 0.0  # seconds the hits would have spent preparing them
+        self._queries = OrderedDict()  # SANode -> (prepared query, seconds to prepare)
+        self._lock = Lock()
+
+    def get(self, shape: SANode) -> 'Query':
+        """The prepared conformance query of shape, an expanded shape"""
+        with self._lock:
+            entry = self._queries.get(shape)
+            if entry is not None:
+                self._queries.move_to_end(shape)
+                self.hits += 1
+                self.saved_time += entry[1]
+                return entry[0]
+            self.misses += 1
+
+        # prepared outside the lock, a shape prepared twice at once is stored once
+        from rdflib.plugins.sparql import prepareQuery
+        start = time.perf_counter()
+        query = prepareQuery(to_uq(shape))
+        seconds = time.perf_counter() - start
+
+        with self._lock:
+            self.prepare_time += seconds
+            self._queries[shape] = (query, seconds)
+            self._queries.move_to_end(shape)
+            while len(self._queries) > self.max_size:
+                self._queries.popitem(last=False)
+        return query
 
-from algebra import parse, expand_shape
-from unaryquery import to_uq
+    def stats(self) -> dict:
+        """The hits, misses, hit rate and time spent and saved (in seconds)"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._queries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'prepare_time': self.prepare_time, 'saved_time': self.saved_time}
 
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
 
-def conforms(data_graph: rdflib.Graph, shapes_graph: rdflib.graph):
-    not_conforms = []
-    conforms = []
+    def __len__(self):
+        return len(self._queries)
 
-    schema = parse(shapes_graph)
-    shape_defs = schema[0]
-    target_defs = schema[1]
-    # Reminder: a schema consists out of two dicts
-    # Both dicts: IRI (shape name) -> SANode
-    # In the first dict, the range is the shape definitions
-    # In the second dict, the range is the target definitions if present
 
-    for shape_name in list(shape_defs):
-        if shape_name not in list(target_defs):
-            continue  # if there is no target definition, skip
-        expanded = expand_shape(shape_defs, shape_defs[shape_name])
-        shapedef_uq = to_uq(expanded)
-        targetdef_uq = to_uq(target_defs[shape_name])
+QUERIES = QueryCache()  # shared by conforms and the PreparedSchemas without their own cache
 
-        rhs = _result_to_set(data_graph.query(shapedef_uq))
-        lhs = _result_to_set(data_graph.query(targetdef_uq))
 
-        if not lhs.issubset(rhs):
-            not_conforms.append(lhs.difference(rhs))
+class PreparedSchema:
+    """A shapes graph parsed and expanded once, to validate data graphs"""
+
+    def __init__(self, shapes_graph: 'rdflib.Graph', queries: QueryCache = None):
+        self.queries = queries if queries is not None else QUERIES
+
+        shape_defs, self.targets = parse(shapes_graph)
+        # Reminder: a schema consists out of two dicts
+        # Both dicts: IRI (shape name) -> SANode
+        # In the first dict, the range is the shape definitions
+        # In the second dict, the range is the target definitions if present
+
+        # if there is no target definition, skip
+        self.shape_names = [name for name in shape_defs if name in self.targets]
+        # every shape is expanded once, also when it is referenced by others
+        self.shapes = expand_schema(shape_defs, self.shape_names)
+        self._translations = ConformanceQueries()  # the plans of the focus queries
+
+    def __getstate__(self):
+        # for the workers of parallel.py, they use their own QueryCache
+        return {'targets': self.targets, 'shape_names': self.shape_names, 'shapes': self.shapes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.queries = QUERIES
+        self._translations = ConformanceQueries()
+
+    def conforms(self, data_graph: Union['rdflib.Graph', 'encoded.EncodedGraph'], native=True,
+                 focus: Optional[bool] = None, batch_size: int = DEFAULT_BATCH_SIZE):
+        """See conforms"""
+        not_conforms = []
+        conforms = []
+        # the node sets of the shapes and of their common subshapes are shared
+        evaluator = self.evaluator(data_graph, native)
+        for shape_name in self.shape_names:
+            targets, violations = self.validate(shape_name, data_graph, evaluator, focus, batch_size)
+            if violations:
+                not_conforms.append(violations)
+            else:
+                conforms.append(targets)
+        return conforms, not_conforms
+
+    def evaluator(self, data_graph: Union['rdflib.Graph', 'encoded.EncodedGraph'], native=True):
+        """
+        The evaluator of data_graph for validate, None to evaluate SPARQL
+        queries. An encoded.EncodedGraph is always evaluated natively.
+        """
+        if isinstance(data_graph, rdflib.Graph):
+            return Evaluator(data_graph) if native else None
+        # numpy is only needed for encoded graphs
+        from encoded import MaskEvaluator
+        return MaskEvaluator(data_graph)
+
+    def validate(self, shape_name, data_graph: Union['rdflib.Graph', 'encoded.EncodedGraph'], evaluator,
+                 focus: Optional[bool] = None, batch_size: int = DEFAULT_BATCH_SIZE) -> Tuple[set, set]:
+        """The target nodes of a shape, and the ones that do not conform"""
+        shape = self.shapes[shape_name]
+        if focus is None:
+            focus = evaluator is not None
+        if evaluator is not None:
+            lhs = set(evaluator.conforming(self.targets[shape_name]))
+            if focus and isinstance(evaluator, Evaluator):
+                rhs = set(evaluator.focus(shape, lhs))
+            else:
+                rhs = set(evaluator.conforming(shape))
         else:
-            conforms.append(lhs)
+            lhs = _result_to_set(data_graph.query(self.queries.get(self.targets[shape_name])))
+            if focus:
+                rhs = self._focus_queries(data_graph, shape, lhs, batch_size)
+            else:
+                rhs = _result_to_set(data_graph.query(self.queries.get(shape)))
+        return lhs, lhs - rhs
+
+    def _focus_queries(self, data_graph: 'rdflib.Graph', shape: SANode, nodes: set, batch_size: int) -> set:
+        # the nodes of nodes conforming to shape, batch_size nodes per query
+        named = sorted((node for node in nodes if type(node) != BNode), key=lambda node: node.n3())
+        conforming = set()
+        for start in range(0, len(named), batch_size):
+            query = to_uq_rope(shape, queries=self._translations, focus=named[start:start + batch_size])
+            conforming |= _result_to_set(data_graph.query(str(query)))
+        if len(named) < len(nodes):
+            # a blank node cannot be given in a query
+            conforming |= _result_to_set(data_graph.query(self.queries.get(shape))) & nodes
+        return conforming
+
 
-    return conforms, not_conforms
+def conforms(data_graph: Union['rdflib.Graph', 'encoded.EncodedGraph'], shapes_graph: 'rdflib.Graph',
+             native=True, queries: QueryCache = None, focus: Optional[bool] = None,
+             batch_size: int = DEFAULT_BATCH_SIZE):
+    """
+    The target nodes of every targeted shape that conform, and the ones that
+    do not. The shapes are evaluated on data_graph by an evaluator.Evaluator,
+    or as SPARQL queries when native is False, prepared once in queries (by
+    default QUERIES). An encoded.EncodedGraph is evaluated by an
+    encoded.MaskEvaluator. To validate many data graphs, use a PreparedSchema.
 
+    With focus (by default for the native evaluation), the shapes are only
+    evaluated for their target nodes, batch_size nodes per SPARQL query.
+    """
+    return PreparedSchema(shapes_graph, queries).conforms(data_graph, native, focus, batch_size)
 
-def _result_to_set(result: rdflib.query.Result) -> set:
+
+def _result_to_set(result: 'rdflib.query.Result') -> set:
     out = set()
     for row in result:
         out.add(row.v)  # v is the SELECT variable
     return out
-
-
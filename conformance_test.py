@@ -0,0 +1,52 @@
+from pytest import mark
+
+from algebra import SANode, Op
+from conformance import PreparedSchema, QueryCache, conforms
+from testsupport import P, Q, conformance_files
+
+
+def test_prepared_once():
+    data, shapes = conformance_files('and-001')
+    queries = QueryCache()
+    schema = PreparedSchema(shapes, queries)
+    expected = conforms(data, shapes)
+    assert schema.conforms(data, native=False) == expected
+    # a query per distinct shape and target
+    misses = queries.misses
+    assert misses == len(queries) == len(set(schema.shapes.values()) | set(schema.targets.values()))
+    hits = queries.hits
+    # the second validation only evaluates
+    assert schema.conforms(data, native=False) == expected
+    assert queries.misses == misses
+    assert queries.hits == hits + 2 * len(schema.shape_names)
+    stats = queries.stats()
+    assert stats['hit_rate'] == queries.hits / (queries.hits + misses)
+    assert stats['saved_time'] > 0
+    # the same shapes in another schema
+    PreparedSchema(conformance_files('and-001')[1], queries).conforms(data, native=False)
+    assert queries.misses == misses
+
+
+def test_bounded():
+    queries = QueryCache(max_size=2)
+    first = SANode(Op.EXACTLY1, [P])
+    prepared = queries.get(first)
+    queries.get(SANode(Op.EXACTLY1, [Q]))
+    assert queries.get(first) is prepared
+    queries.get(SANode(Op.EQ, [P, Q]))
+    assert len(queries) == 2
+    # the least recently used was dropped
+    queries.get(SANode(Op.EXACTLY1, [Q]))
+    assert queries.misses == 4
+    assert queries.get(first) is not prepared
+
+
+@mark.parametrize('case', ['and-001', 'rectangles', 'targeted'], indirect=True)
+def test_focus(case):
+    data, shapes = case
+    schema = PreparedSchema(shapes, QueryCache())
+    expected = schema.conforms(data, native=True, focus=False)
+    assert schema.conforms(data, native=True, focus=True) == expected
+    assert schema.conforms(data, native=False, focus=False) == expected
+    # the targets in batches of one node
+    assert schema.conforms(data, native=False, focus=True, batch_size=1) == expected
@@ -0,0 +1,27 @@
+from threading import Thread
+from typing import Tuple
+
+from pytest import fixture
+from rdflib import Graph
+
+import testsupport
+
+'''
+Fixtures shared by the tests, over the data of testsupport.py
+'''
+
+
+@fixture
+def case(request) -> Tuple[Graph, Graph]:
+    """The data and shapes graphs of the case of testsupport.CASES named by the parameter"""
+    return testsupport.CASES[request.param]()
+
+
+@fixture
+def standin():
+    """A testsupport.StandIn endpoint on testsupport.DATA, serving in a thread"""
+    server = testsupport.StandIn(testsupport.graph(testsupport.DATA))
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,75 @@
+from functools import lru_cache
+from string import Formatter
+from typing import Iterator, List, Union
+
+'''
+Query text as a rope
+
+The translations fill the queries of the children into the template of their
+parent. With f-strings every level copies the text of all of its children,
+so emitting a query took time quadratic in its depth. A Rope keeps its parts
+(strings and other ropes) as they are: the text is joined once by str(rope)
+or written part by part to a file-like sink by rope.write(sink), and a
+subquery that is used twice is shared instead of copied.
+
+    template('SELECT ?v WHERE {{ {body} }}', body=body)
+
+is the Rope of the same text as f'SELECT ?v WHERE {{ {body} }}'.
+'''
+
+
+class Rope:
+    __slots__ = ('parts',)
+
+    def __init__(self, parts: List[Union[str, 'Rope']]):
+        self.parts = parts
+
+    def chunks(self) -> Iterator[str]:
+        """The strings of the rope, in order"""
+        # an explicit stack, ropes can be deeper than the recursion limit
+        stack = [iter(self.parts)]
+        while stack:
+            for part in stack[-1]:
+                if isinstance(part, Rope):
+                    stack.append(iter(part.parts))
+                    break
+                yield part
+            else:
+                stack.pop()
+
+    def write(self, sink):
+        """Writes the text to sink, an object with a write(str) method"""
+        for chunk in self.chunks():
+            sink.write(chunk)
+
+    def __str__(self):
+        return ''.join(self.chunks())
+
+    def __repr__(self):
+        return f'Rope({str(self)!r})'
+
+
+def template(text: str, **fields) -> Rope:
+    """
+    The Rope of text.format(**fields), fields that are ropes are not copied.
+    Only plain {name} fields are supported, without conversions or format specs.
+    """
+    parts = []
+    for literal, name in _parse(text):
+        if literal:
+            parts.append(literal)
+        if name is not None:
+            value = fields[name]
+            parts.append(value if isinstance(value, Rope) else str(value))
+    return Rope(parts)
+
+
+@lru_cache(maxsize=None)
+def _parse(text: str):
+    # the templates are constants, each one is parsed once
+    parsed = []
+    for literal, name, spec, conversion in Formatter().parse(text):
+        if spec or conversion:
+            raise ValueError(f'Unsupported field in template: {name}')
+        parsed.append((literal, name))
+    return parsed
@@ -0,0 +1,31 @@
+from io import StringIO
+
+from pytest import raises
+
+from emit import Rope, template
+
+
+def test_template():
+    body = template('?v <{p}> ?o', p='http://ex.tt/p')
+    query = template('SELECT ?v WHERE {{ {body} }} # {body}', body=body)
+    assert str(query) == 'SELECT ?v WHERE { ?v <http://ex.tt/p> ?o } # ?v <http://ex.tt/p> ?o'
+    ropes = [part for part in query.parts if isinstance(part, Rope)]
+    assert ropes == [body, body]  # shared, not copied
+    assert str(template('{n} {{}}', n=3)) == '3 {}'
+
+    with raises(ValueError):
+        template('{n:>3}', n=3)
+
+
+def test_write():
+    rope = Rope(['a', Rope([]), Rope(['b', Rope(['c'])]), 'd'])
+    sink = StringIO()
+    rope.write(sink)
+    assert sink.getvalue() == str(rope) == 'abcd'
+
+
+def test_deep_rope():
+    rope = Rope(['x'])
+    for _ in range(100000):
+        rope = template('({rope})', rope=rope)
+    assert str(rope) == '(' * 100000 + 'x' + ')' * 100000
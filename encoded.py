@@ -0,0 +1,508 @@
+import sys
+from array import array
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+import numpy as np
+from rdflib import Literal
+from rdflib.namespace import SH
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+from rdflib.term import BNode, Node
+
+import trampoline
+from algebra import SANode, Op
+from evaluator import compare, is_test, passes
+from pathalg import PANode, POp
+
+'''
+Integer-encoded graphs
+
+For large data, an EncodedGraph stores a graph as arrays. A TermDictionary
+numbers the nodes of the graph (the subjects and objects), and the triples of
+every predicate are kept as adjacency arrays in both directions: CSR arrays
+over the nodes that have a value for the predicate, so a predicate used by
+few nodes takes little space. It is built once, from an rdflib Graph or
+streamed from an N-Triples file without building a Graph.
+
+A MaskEvaluator evaluates shapes on it with NumPy. A set of nodes is a boolean
+mask over the node ids, so AND, OR and NOT are mask algebra. A path is a
+relation: a sorted array of keys, (subject id << 32) | object id. GEQ and LEQ
+are np.bincount over the subjects of the values in a mask, FORALL counts the
+values outside the mask, EQ and DISJ are set operations on the keys. The
+results are those of evaluator.Evaluator, only tests look at the terms
+themselves, once per test and per literal.
+
+memory() reports the bytes used by every structure.
+'''
+
+_ID = np.uint32  # a node id, at most 2 ** 32 nodes
+_LOW = np.uint64(0xFFFFFFFF)
+_SHIFT = np.uint64(32)
+
+
+def _keys(rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    # the sorted keys of the pairs, without duplicates
+    return np.unique((rows.astype(np.uint64) << _SHIFT) | cols.astype(np.uint64))
+
+
+def _rows(keys: np.ndarray) -> np.ndarray:
+    return (keys >> _SHIFT).astype(np.intp)
+
+
+def _cols(keys: np.ndarray) -> np.ndarray:
+    return (keys & _LOW).astype(np.intp)
+
+
+class TermDictionary:
+    """Numbers RDF terms from 0, in the order they are first encoded"""
+
+    def __init__(self):
+        self.terms = []  # id -> term
+        self.ids = {}  # term -> id
+
+    def __len__(self):
+        return len(self.terms)
+
+    def encode(self, term: Node) -> int:
+        id = self.ids.get(term)
+        if id is None:
+            id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return id
+
+    def lookup(self, term: Node) -> Optional[int]:
+        return self.ids.get(term)
+
+    def decode(self, ids: Iterable[int]) -> List[Node]:
+        return [self.terms[id] for id in ids]
+
+    def memory(self) -> int:
+        # the containers and the terms
+        return sys.getsizeof(self.terms) + sys.getsizeof(self.ids) + \
+            sum(sys.getsizeof(term) for term in self.terms)
+
+
+class Adjacency:
+    """
+    The values of a predicate: the values of subjects[i] are
+    indices[indptr[i]:indptr[i + 1]], the subjects and values sorted
+    """
+    __slots__ = ('subjects', 'indptr', 'indices')
+
+    def __init__(self, rows: np.ndarray, cols: np.ndarray):
+        keys = _keys(rows, cols)
+        self.subjects, counts = np.unique((keys >> _SHIFT).astype(_ID), return_counts=True)
+        self.indptr = np.zeros(len(self.subjects) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.indices = (keys & _LOW).astype(_ID)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def keys(self) -> np.ndarray:
+        """The pairs as sorted keys, see MaskEvaluator"""
+        rows = np.repeat(self.subjects.astype(np.uint64), np.diff(self.indptr))
+        return (rows << _SHIFT) | self.indices.astype(np.uint64)
+
+    def values(self, id: int) -> np.ndarray:
+        i = np.searchsorted(self.subjects, id)
+        if i == len(self.subjects) or self.subjects[i] != id:
+            return self.indices[:0]
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    @property
+    def nbytes(self) -> int:
+        return self.subjects.nbytes + self.indptr.nbytes + self.indices.nbytes
+
+
+class _Builder:
+    # collects encoded triples, also as the sink of the N-Triples parser
+    def __init__(self):
+        self.dictionary = TermDictionary()
+        self.subjects = defaultdict(lambda: array('L'))
+        self.objects = defaultdict(lambda: array('L'))
+
+    def triple(self, s: Node, p: Node, o: Node):
+        self.subjects[p].append(self.dictionary.encode(s))
+        self.objects[p].append(self.dictionary.encode(o))
+
+    def build(self) -> 'EncodedGraph':
+        if len(self.dictionary) > 2 ** 32:
+            raise ValueError('An EncodedGraph holds at most 2 ** 32 nodes')
+        forward = {}
+        inverse = {}
+        for p in list(self.subjects):
+            rows = np.array(self.subjects.pop(p), dtype=_ID)
+            cols = np.array(self.objects.pop(p), dtype=_ID)
+            forward[p] = Adjacency(rows, cols)
+            inverse[p] = Adjacency(cols, rows)
+        return EncodedGraph(self.dictionary, forward, inverse)
+
+
+class EncodedGraph:
+    """A graph as a TermDictionary of its nodes and the Adjacency of every predicate"""
+
+    def __init__(self, dictionary: TermDictionary, forward: Dict[Node, Adjacency],
+                 inverse: Dict[Node, Adjacency]):
+        self.dictionary = dictionary
+        self.forward = forward  # predicate -> subjects to objects
+        self.inverse = inverse  # predicate -> objects to subjects
+
+    @classmethod
+    def from_triples(cls, triples: Iterable) -> 'EncodedGraph':
+        """From triples (s, p, o), like the ones of an rdflib Graph"""
+        builder = _Builder()
+        for s, p, o in triples:
+            builder.triple(s, p, o)
+        return builder.build()
+
+    @classmethod
+    def from_ntriples(cls, filename: str) -> 'EncodedGraph':
+        """From an N-Triples file, parsed line by line"""
+        builder = _Builder()
+        with open(filename, 'rb') as f:
+            W3CNTriplesParser(builder).parse(f)
+        return builder.build()
+
+    def __len__(self):
+        # the number of triples
+        return sum(len(adjacency) for adjacency in self.forward.values())
+
+    @property
+    def size(self) -> int:
+        """The number of nodes"""
+        return len(self.dictionary)
+
+    def memory(self) -> Dict[str, int]:
+        """The bytes used by the dictionary and the adjacency arrays"""
+        return {'dictionary': self.dictionary.memory(),
+                'forward': sum(adjacency.nbytes for adjacency in self.forward.values()),
+                'inverse': sum(adjacency.nbytes for adjacency in self.inverse.values())}
+
+
+class MaskEvaluator:
+    """
+    The conformance of the nodes of an EncodedGraph to shapes, like
+    evaluator.Evaluator, each node of the algebra once
+    """
+
+    def __init__(self, graph: EncodedGraph):
+        self.graph = graph
+        # the values of hasValue that are not nodes of the graph, numbered after them
+        self._extra = TermDictionary()
+        self._encoded = set()  # the shapes whose values are encoded
+        self._masks = {}  # SANode -> mask
+        self._relations = {}  # PANode -> keys
+        self._values = {}  # PANode -> decoded successor index
+        self._tests = {}  # test SANode -> (passing mask, failing mask)
+        self._kinds = None  # node id -> 0 for IRIs, 1 for blank nodes, 2 for literals
+        self._languages = None  # node id -> number of its language tag, or -1
+
+    @property
+    def size(self) -> int:
+        """The length of the masks"""
+        return self.graph.size + len(self._extra)
+
+    def conforming(self, node: SANode) -> FrozenSet[Node]:
+        """The nodes conforming to node; node is expanded"""
+        return frozenset(self.decode(np.flatnonzero(self.mask(node))))
+
+    def mask(self, node: SANode) -> np.ndarray:
+        """The mask of the nodes conforming to node"""
+        self._encode_values(node)
+        return trampoline.run(self._shape(node))
+
+    def values(self, path: PANode) -> Dict[Node, FrozenSet[Node]]:
+        """The successor index of path, decoded, like patheval.PathEvaluator.values"""
+        if path not in self._values:
+            keys = trampoline.run(self._path(path))
+            rows, starts = np.unique(_rows(keys), return_index=True)
+            values = self.decode(_cols(keys))
+            bounds = list(starts[1:]) + [len(values)]
+            self._values[path] = {node: frozenset(values[start:end]) for node, start, end
+                                  in zip(self.decode(rows), starts, bounds)}
+        return self._values[path]
+
+    def decode(self, ids: Iterable[int]) -> List[Node]:
+        terms = self.graph.dictionary.terms
+        extra = self._extra.terms
+        return [terms[id] if id < len(terms) else extra[id - len(terms)] for id in ids]
+
+    def memory(self) -> Dict[str, int]:
+        """The bytes used by the masks and relations kept for the shapes evaluated so far"""
+        return {'masks': sum(mask.nbytes for mask in self._masks.values()),
+                'relations': sum(keys.nbytes for keys in self._relations.values()),
+                'tests': sum(passing.nbytes + failing.nbytes
+                             for passing, failing in self._tests.values())}
+
+    def _encode_values(self, node: SANode):
+        # numbers the values of hasValue that are not nodes of the graph, so the
+        # size of the masks does not change while a shape is evaluated
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            if node in self._encoded:
+                continue
+            self._encoded.add(node)
+            if node.op == Op.HASVALUE:
+                if self.graph.dictionary.lookup(node.children[0]) is None:
+                    self._extra.encode(node.children[0])
+                continue
+            todo += [child for child in node.children if type(child) == SANode]
+
+    def _id(self, term: Node) -> int:
+        id = self.graph.dictionary.lookup(term)
+        return id if id is not None else self.graph.size + self._extra.lookup(term)
+
+    def _fit(self, mask: np.ndarray) -> np.ndarray:
+        # a mask of an earlier, smaller size, padded with the values not in the graph
+        if len(mask) < self.size:
+            return np.concatenate([mask, np.zeros(self.size - len(mask), dtype=bool)])
+        return mask
+
+    def _universe(self) -> np.ndarray:
+        mask = np.zeros(self.size, dtype=bool)
+        mask[:self.graph.size] = True
+        return mask
+
+    def _count(self, keys: np.ndarray, selected: Optional[np.ndarray] = None) -> np.ndarray:
+        # node id -> the number of values of the relation, in selected
+        rows = _rows(keys)
+        if selected is not None:
+            rows = rows[selected[_cols(keys)]]
+        return np.bincount(rows, minlength=self.size)
+
+    def _shape(self, node: SANode):
+        # generator, see trampoline.run
+        if node not in self._masks:
+            self._masks[node] = yield self._evaluate(node)
+        self._masks[node] = self._fit(self._masks[node])
+        return self._masks[node]
+
+    def _evaluate(self, node: SANode):
+        # generator, the mask of the conforming nodes of node
+        if node.op == Op.HASSHAPE:
+            raise ValueError('node must be expanded')
+
+        if node.op == Op.TOP:
+            return self._universe()
+
+        if node.op == Op.HASVALUE:
+            mask = np.zeros(self.size, dtype=bool)
+            mask[self._id(node.children[0])] = True
+            return mask
+
+        if node.op == Op.TEST:
+            return self._test(node)[0]
+
+        if node.op == Op.AND:
+            mask = self._universe()
+            for child in node.children:
+                if child.op == Op.NOT and child.children[0].op != Op.TEST:
+                    mask &= ~(yield self._shape(child.children[0]))
+                else:
+                    mask &= yield self._shape(child)
+            return mask
+
+        if node.op == Op.OR:
+            mask = np.zeros(self.size, dtype=bool)
+            for child in node.children:
+                mask |= yield self._shape(child)
+            return mask
+
+        if node.op == Op.NOT:
+            child = node.children[0]
+            if child.op == Op.TEST:
+                return self._test(child)[1]
+            return self._universe() & ~(yield self._shape(child))
+
+        if node.op == Op.GEQ:
+            keys = yield self._path(node.children[1])
+            selected = None if node.children[2].op == Op.TOP else (yield self._shape(node.children[2]))
+            return self._count(keys, selected) >= max(int(node.children[0]), 1)
+
+        if node.op == Op.LEQ:
+            keys = yield self._path(node.children[1])
+            selected = None if node.children[2].op == Op.TOP else (yield self._shape(node.children[2]))
+            return self._universe() & ~(self._count(keys, selected) > int(node.children[0]))
+
+        if node.op == Op.EXACTLY1:
+            return self._count((yield self._path(node.children[0]))) == 1
+
+        if node.op == Op.FORALL:
+            keys = yield self._path(node.children[0])
+            child = node.children[1]
+            if child.op == Op.TOP:
+                return self._universe()
+            if is_test(child):
+                # the values that fail the test, see Evaluator
+                bad = self._test(child)[1]
+            else:
+                bad = ~(yield self._shape(child))
+            return self._universe() & ~(self._count(keys, bad) > 0)
+
+        if node.op in (Op.EQ, Op.DISJ):
+            keys1 = yield self._path(node.children[0])
+            keys2 = yield self._path(node.children[1])
+            # the pairs of one path without the other, or of both
+            pairs = np.setxor1d(keys1, keys2, assume_unique=True) if node.op == Op.EQ \
+                else np.intersect1d(keys1, keys2, assume_unique=True)
+            mask = self._universe()
+            mask[_rows(pairs)] = False
+            return mask
+
+        if node.op == Op.CLOSED:
+            allowed = {child.children[0] for child in node.children}
+            mask = self._universe()
+            for p, adjacency in self.graph.forward.items():
+                if p not in allowed:
+                    mask[adjacency.subjects] = False
+            return mask
+
+        if node.op in (Op.LESSTHAN, Op.LESSTHANEQ):
+            keys = yield self._path(node.children[0])
+            bounds = yield self._path(node.children[1])
+            # compared term by term, as in Evaluator
+            operator = '>=' if node.op == Op.LESSTHAN else '>'
+            bound_values = defaultdict(list)
+            for row, col in zip(_rows(bounds), self.decode(_cols(bounds))):
+                bound_values[row].append(col)
+            mask = np.zeros(self.size, dtype=bool)
+            for row, value in zip(_rows(keys), self.decode(_cols(keys))):
+                if not mask[row] and \
+                        not any(compare(bound, operator, value) for bound in bound_values[row]):
+                    mask[row] = True
+            return mask
+
+        if node.op == Op.UNIQUELANG:
+            keys = yield self._path(node.children[0])
+            languages = self._language_ids()[_cols(keys)]
+            tagged = languages >= 0
+            pairs, counts = np.unique((_rows(keys)[tagged].astype(np.uint64) << _SHIFT) |
+                                      languages[tagged].astype(np.uint64), return_counts=True)
+            mask = self._universe()
+            mask[_rows(pairs[counts > 1])] = False
+            return mask
+
+        raise ValueError(f'Unknown operator {node.op}')
+
+    def _path(self, path: PANode):
+        # generator, see trampoline.run
+        if path not in self._relations:
+            self._relations[path] = yield self._evaluate_path(path)
+        return self._relations[path]
+
+    def _evaluate_path(self, path: PANode):
+        # generator, the keys of the relation of path
+        if path.pop == POp.PROP:
+            adjacency = self.graph.forward.get(path.children[0])
+            return adjacency.keys() if adjacency is not None else np.zeros(0, dtype=np.uint64)
+
+        if path.pop == POp.INV:
+            child = path.children[0]
+            if child.pop == POp.PROP:
+                adjacency = self.graph.inverse.get(child.children[0])
+                return adjacency.keys() if adjacency is not None else np.zeros(0, dtype=np.uint64)
+            keys = yield self._path(child)
+            return _keys(_cols(keys), _rows(keys))
+
+        if path.pop == POp.ALT:
+            relations = []
+            for child in path.children:
+                relations.append((yield self._path(child)))
+            return np.unique(np.concatenate(relations))
+
+        if path.pop == POp.COMP:
+            keys = yield self._path(path.children[0])
+            for child in path.children[1:]:
+                keys = _compose(keys, (yield self._path(child)))
+            return keys
+
+        if path.pop == POp.ZEROORONE:
+            keys = yield self._path(path.children[0])
+            return np.union1d(keys, self._identity())
+
+        if path.pop == POp.KLEENE:
+            # the nodes reached in n + 1 steps that were not reached in n steps
+            step = yield self._path(path.children[0])
+            keys = self._identity()
+            new = keys
+            while len(new):
+                new = np.setdiff1d(_compose(new, step), keys, assume_unique=True)
+                keys = np.union1d(keys, new)
+            return keys
+
+        raise ValueError(f'Unknown path operator {path.pop}')
+
+    def _identity(self) -> np.ndarray:
+        # the keys of the pairs (v, v) of the nodes of the graph
+        ids = np.arange(self.graph.size, dtype=np.uint64)
+        return (ids << _SHIFT) | ids
+
+    def _test(self, node: SANode):
+        # (passing, failing) masks of a test, the other nodes give an error
+        if node not in self._tests:
+            if node.op == Op.NOT:
+                passing, failing = self._test(node.children[0])
+                self._tests[node] = (failing, passing)
+            elif node.op == Op.AND:
+                passing = self._universe()
+                failing = np.zeros(self.size, dtype=bool)
+                for child in node.children:
+                    child_passing, child_failing = self._test(child)
+                    passing &= child_passing
+                    failing |= child_failing
+                self._tests[node] = (passing, failing)
+            elif node.children[0] == 'nodekind':
+                kinds = {SH.IRI: [0], SH.BlankNode: [1], SH.Literal: [2], SH.BlankNodeOrIRI: [0, 1],
+                         SH.BlankNodeOrLiteral: [1, 2], SH.IRIOrLiteral: [0, 2]}[node.children[1]]
+                passing = np.isin(self._kind_ids(), kinds)
+                passing[self.graph.size:] = False
+                failing = self._universe() & ~passing
+                self._tests[node] = (passing, failing)
+            else:
+                # the other tests give an error on the nodes that are not literals
+                passing = np.zeros(self.size, dtype=bool)
+                failing = np.zeros(self.size, dtype=bool)
+                literals = np.flatnonzero(self._kind_ids()[:self.graph.size] == 2)
+                for id, term in zip(literals, self.decode(literals)):
+                    result = passes(node, term)
+                    if result is True:
+                        passing[id] = True
+                    elif result is False:
+                        failing[id] = True
+                self._tests[node] = (passing, failing)
+        passing, failing = self._tests[node]
+        self._tests[node] = (self._fit(passing), self._fit(failing))
+        return self._tests[node]
+
+    def _kind_ids(self) -> np.ndarray:
+        if self._kinds is None or len(self._kinds) < self.size:
+            self._kinds = np.array([2 if isinstance(term, Literal) else 1 if isinstance(term, BNode) else 0
+                                    for term in self.decode(range(self.size))], dtype=np.int8)
+        return self._kinds
+
+    def _language_ids(self) -> np.ndarray:
+        if self._languages is None or len(self._languages) < self.size:
+            numbers = {}
+            self._languages = np.array(
+                [numbers.setdefault(term.language, len(numbers))
+                 if isinstance(term, Literal) and term.language else -1
+                 for term in self.decode(range(self.size))], dtype=np.int64)
+        return self._languages
+
+
+def _compose(keys1: np.ndarray, keys2: np.ndarray) -> np.ndarray:
+    # the keys of the pairs (a, c) with (a, b) in keys1 and (b, c) in keys2
+    rows2 = keys2 >> _SHIFT
+    middle = keys1 & _LOW
+    start = np.searchsorted(rows2, middle, side='left')
+    counts = np.searchsorted(rows2, middle, side='right') - start
+    total = int(counts.sum())
+    if not total:
+        return np.zeros(0, dtype=np.uint64)
+    # the index in keys2 of every composed pair
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    cols = keys2[np.repeat(start, counts) + offsets] & _LOW
+    rows = np.repeat(keys1 >> _SHIFT, counts)
+    return np.unique((rows << _SHIFT) | cols)
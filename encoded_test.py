@@ -0,0 +1,50 @@
+from pytest import mark
+from rdflib import Literal
+
+from algebra import SANode, Op
+from conformance import conforms
+from encoded import EncodedGraph, MaskEvaluator
+from evaluator import Evaluator
+from testsupport import DATA, EX, Q, SHAPES, conformance_files, graph
+
+
+@mark.parametrize('shape', SHAPES)
+def test_conforming_as_evaluator(shape):
+    data = graph(DATA)
+    assert MaskEvaluator(EncodedGraph.from_triples(data)).conforming(shape) == \
+        Evaluator(data).conforming(shape)
+
+
+def test_adjacency():
+    encoded = EncodedGraph.from_triples(graph(DATA))
+    assert len(encoded) == len(graph(DATA))
+    a = encoded.dictionary.lookup(EX.a)
+    assert set(encoded.dictionary.decode(encoded.forward[EX.p].values(a))) == \
+        {EX.b, EX.c, Literal('Bob'), Literal(5)}
+    assert set(encoded.dictionary.decode(encoded.inverse[EX.q].values(a))) == {EX.c}
+    assert encoded.forward[EX.p].values(encoded.dictionary.lookup(Literal(5))).size == 0
+    assert set(encoded.memory()) == {'dictionary', 'forward', 'inverse'}
+
+
+def test_from_ntriples(tmp_path):
+    filename = str(tmp_path / 'data.nt')
+    graph(DATA).serialize(filename, format='nt', encoding='utf-8')
+    encoded = EncodedGraph.from_ntriples(filename)
+    assert len(encoded) == len(graph(DATA))
+    shape = SANode(Op.EXACTLY1, [Q])
+    assert MaskEvaluator(encoded).conforming(shape) == Evaluator(graph(DATA)).conforming(shape)
+
+
+def test_values_outside_graph():
+    evaluator = MaskEvaluator(EncodedGraph.from_triples(graph(DATA)))
+    known = evaluator.mask(SANode(Op.HASVALUE, [EX.a]))
+    assert evaluator.conforming(SANode(Op.OR, [SANode(Op.HASVALUE, [EX.a]), SANode(Op.HASVALUE, [EX.z])])) == \
+        {EX.a, EX.z}
+    # the masks of earlier shapes grow with the new values
+    assert len(evaluator.mask(SANode(Op.HASVALUE, [EX.a]))) == len(known) + 1
+    assert EX.z not in evaluator.conforming(SANode(Op.NOT, [SANode(Op.HASVALUE, [EX.a])]))
+
+
+def test_conforms():
+    data, shapes = conformance_files('and-001')
+    assert conforms(EncodedGraph.from_triples(data), shapes) == conforms(data, shapes)
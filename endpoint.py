@@ -0,0 +1,299 @@
+import asyncio
+import json
+import ssl
+from typing import AsyncIterator, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+from rdflib.term import BNode, Literal, Node, URIRef
+from rdflib.util import from_n3
+
+from algebra import SANode
+from sfquery import to_sfquery
+from unaryquery import to_uq
+
+'''
+Execution of queries on SPARQL endpoints
+
+An Endpoint sends the queries of to_uq and to_sfquery (or any SELECT query)
+to a SPARQL endpoint over HTTP/1.1, with asyncio:
+
+    endpoint = Endpoint('http://localhost:3030/data/sparql')
+    async for v, s, p, o in endpoint.rows(to_sfquery(shape)):
+        ...
+    await endpoint.close()
+
+The connections are kept alive and reused by the next queries, at most
+max_in_flight queries are sent at once, the others wait for a connection. The
+results are asked as tab-separated values and parsed line by line as they
+arrive, a row is given before the rest of the answer is read (an endpoint
+answering with JSON instead is parsed when the whole answer is read).
+
+A query that cannot be sent, or that is answered with a status 429 or 5xx, is
+sent again, at most retries times, waiting backoff seconds before the first
+retry and twice as long before every next one. Once a row was given it is not
+sent again, the error is raised. A query waits at most timeout seconds for
+the endpoint to connect or to send more of its answer, asyncio.TimeoutError
+is raised otherwise. A query that is cancelled, or whose rows are not all
+read, closes its connection: use contextlib.aclosing to stop reading early,
+or the connection is only released when the generator is collected.
+'''
+
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.1
+DEFAULT_TIMEOUT = 60.0
+TSV = 'text/tab-separated-values'
+JSON = 'application/sparql-results+json'
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class EndpointError(Exception):
+    """A query answered with an error status, or that could not be sent"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class _Retry(Exception):
+    # a query to send again, after the cause
+    pass
+
+
+class Endpoint:
+    """A SPARQL endpoint, queried with asyncio over pooled keep-alive connections"""
+
+    def __init__(self, url: str, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF,
+                 timeout: Optional[float] = DEFAULT_TIMEOUT):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'Not an HTTP endpoint: {url}')
+        self.url = url
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._host = parts.hostname
+        self._port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self._ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self._path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        self._loop = None  # the event loop of the semaphore and the connections
+        self._slots = None
+        self._idle = []  # the open connections (reader, writer) waiting for a query
+        self.queries = 0
+        self.connections = 0  # number of connections opened
+        self.retried = 0  # number of queries sent again
+        self.in_flight = 0
+        self.max_seen_in_flight = 0
+
+    async def rows(self, query: str) -> AsyncIterator[Tuple[Optional[Node], ...]]:
+        """The rows of a SELECT query, as they arrive, None for an unbound variable"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # used in another event loop, the connections of the previous one were closed by run
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            self._idle = []
+        async with self._slots:
+            self.queries += 1
+            self.in_flight += 1
+            self.max_seen_in_flight = max(self.max_seen_in_flight, self.in_flight)
+            try:
+                attempt = 0
+                while True:
+                    given = False
+                    attempt_rows = self._send(query)
+                    try:
+                        async for row in attempt_rows:
+                            given = True
+                            yield row
+                        return
+                    except _Retry as e:
+                        if given or attempt >= self.retries:
+                            raise EndpointError(f'{self.url}: {e.__cause__ or e}',
+                                                getattr(e.__cause__, 'status', None)) from e.__cause__
+                    finally:
+                        # closes its connection at once, also when the rows are not all read
+                        await attempt_rows.aclose()
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+                    attempt += 1
+                    self.retried += 1
+            finally:
+                self.in_flight -= 1
+
+    async def select(self, query: str) -> List[Tuple[Optional[Node], ...]]:
+        """All the rows of a SELECT query"""
+        return [row async for row in self.rows(query)]
+
+    async def conforming(self, shape: SANode, ignore_tests=False) -> set:
+        """The nodes of the endpoint's data conforming to shape, by its to_uq query"""
+        return {row[0] async for row in self.rows(to_uq(shape, ignore_tests)) if row[0] is not None}
+
+    async def fragment(self, shape: SANode, ignore_tests=False) -> set:
+        """The triples of the shape fragment of shape, by its to_sfquery query"""
+        return {row[1:] async for row in self.rows(to_sfquery(shape, ignore_tests)) if row[1] is not None}
+
+    async def close(self):
+        """Closes the idle connections"""
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        return {'queries': self.queries, 'connections': self.connections, 'retried': self.retried,
+                'max_in_flight': self.max_seen_in_flight, 'idle': len(self._idle)}
+
+    async def _connect(self):
+        if self._idle:
+            return self._idle.pop() + (True,)
+        reader, writer = await self._wait(asyncio.open_connection(self._host, self._port, ssl=self._ssl))
+        self.connections += 1
+        return reader, writer, False
+
+    async def _send(self, query: str):
+        # the rows of one attempt, raises _Retry when the query can be sent again
+        body = urlencode({'query': query}).encode()
+        request = (f'POST {self._path} HTTP/1.1\r\n'
+                   f'Host: {self._host}:{self._port}\r\n'
+                   f'Accept: {TSV}, {JSON};q=0.9\r\n'
+                   'Content-Type: application/x-www-form-urlencoded\r\n'
+                   f'Content-Length: {len(body)}\r\n'
+                   'Connection: keep-alive\r\n\r\n').encode() + body
+        while True:
+            try:
+                reader, writer, reused = await self._connect()
+            except asyncio.TimeoutError:
+                raise
+            except (OSError, asyncio.IncompleteReadError) as e:
+                raise _Retry() from e
+            try:
+                writer.write(request)
+                await self._wait(writer.drain())
+                status, headers = await self._head(reader)
+                break
+            except asyncio.TimeoutError:
+                writer.close()
+                raise
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                writer.close()
+                if not reused:
+                    raise _Retry() from e
+                # the endpoint closed the idle connection, on a new one
+            except BaseException:
+                writer.close()
+                raise
+
+        reusable = False
+        try:
+            content = self._body(reader, headers)
+            if status != 200:
+                message = b''.join([piece async for piece in content]).decode(errors='replace')
+                error = EndpointError(f'status {status}: {message[:200]}', status)
+                if status in RETRY_STATUS:
+                    raise _Retry() from error
+                raise error
+
+            if headers.get('content-type', '').startswith(JSON):
+                answer = json.loads(b''.join([piece async for piece in content]))
+                names = answer['head']['vars']
+                for binding in answer['results']['bindings']:
+                    yield tuple(_json_term(binding[name]) if name in binding else None for name in names)
+            else:
+                header = True
+                async for line in _lines(content):
+                    if header:
+                        header = False  # the variables
+                    elif line:
+                        yield tuple(from_n3(cell) if cell else None for cell in line.split('\t'))
+            reusable = headers.get('connection', '').lower() != 'close' \
+                and ('content-length' in headers or 'chunked' in headers.get('transfer-encoding', ''))
+        finally:
+            if reusable:
+                self._idle.append((reader, writer))
+            else:
+                # also when cancelled, or when the rows are not all read
+                writer.close()
+
+    async def _head(self, reader) -> Tuple[int, dict]:
+        status_line = await self._wait(reader.readuntil(b'\r\n'))
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self._wait(reader.readuntil(b'\r\n'))
+            if line == b'\r\n':
+                return status, headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    async def _body(self, reader, headers: dict):
+        # the pieces of the body, as they arrive
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            while True:
+                size = int((await self._wait(reader.readuntil(b'\r\n'))).split(b';')[0], 16)
+                if size == 0:
+                    while await self._wait(reader.readuntil(b'\r\n')) != b'\r\n':
+                        pass  # the trailers
+                    return
+                yield await self._wait(reader.readexactly(size))
+                await self._wait(reader.readexactly(2))
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining:
+                piece = await self._wait(reader.read(min(remaining, 64 * 1024)))
+                if not piece:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(piece)
+                yield piece
+        else:
+            # until the endpoint closes the connection
+            while True:
+                piece = await self._wait(reader.read(64 * 1024))
+                if not piece:
+                    return
+                yield piece
+
+    async def _wait(self, awaitable):
+        if self.timeout is None:
+            return await awaitable
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+
+async def _lines(pieces) -> AsyncIterator[str]:
+    # the lines of the pieces of a body, without their line breaks
+    rest = b''
+    async for piece in pieces:
+        *lines, rest = (rest + piece).split(b'\n')
+        for line in lines:
+            yield line.rstrip(b'\r').decode()
+    if rest:
+        yield rest.rstrip(b'\r').decode()
+
+
+def _json_term(value: dict) -> Node:
+    if value['type'] == 'uri':
+        return URIRef(value['value'])
+    if value['type'] == 'bnode':
+        return BNode(value['value'])
+    datatype = value.get('datatype')
+    return Literal(value['value'], lang=value.get('xml:lang'),
+                   datatype=URIRef(datatype) if datatype else None)
+
+
+def run(coroutine, *endpoints: Endpoint):
+    """
+    Runs coroutine with asyncio.run and closes the connections of endpoints,
+    they open new ones in the event loop of the next run
+    """
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            for endpoint in endpoints:
+                await endpoint.close()
+    return asyncio.run(main())
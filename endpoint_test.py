@@ -0,0 +1,182 @@
+import asyncio
+import time
+from threading import Event, Thread
+
+import pytest
+from rdflib import Graph, Literal, URIRef
+
+from algebra import SANode, Op
+from endpoint import Endpoint, EndpointError, run
+from sfquery import to_sfquery
+from testsupport import IRI, P, Q, S, TOP, StandIn
+from unaryquery import to_uq
+
+SHAPES = [
+    SANode(Op.GEQ, [Literal(1), P, TOP]),
+    SANode(Op.FORALL, [Q, IRI]),
+    SANode(Op.OR, [SANode(Op.EXACTLY1, [S]), SANode(Op.NOT, [SANode(Op.EQ, [P, Q])])]),
+]
+
+
+@pytest.mark.parametrize('json_results', [False, True])
+def test_as_rdflib(standin, json_results):
+    standin.json = json_results
+    data = standin.graph
+
+    async def queries():
+        endpoint = Endpoint(standin.url)
+        try:
+            for shape in SHAPES:
+                expected = {row.v for row in data.query(to_uq(shape))}
+                assert expected
+                assert await endpoint.conforming(shape) == expected
+                expected = {(row.s, row.p, row.o) for row in data.query(to_sfquery(shape)) if row.s is not None}
+                assert expected
+                assert await endpoint.fragment(shape) == expected
+        finally:
+            await endpoint.close()
+        # one connection for all the queries
+        assert endpoint.connections == 1
+
+    asyncio.run(queries())
+
+
+@pytest.mark.parametrize('json_results', [False, True])
+def test_terms(json_results):
+    literals = [Literal('a "b"\nc\\d\te'), Literal('x', lang='en'), Literal(12), Literal(1.5), Literal(True),
+                Literal('2020-01-01', datatype=URIRef('http://www.w3.org/2001/XMLSchema#date'))]
+    graph = Graph()
+    for i, literal in enumerate(literals):
+        graph.add((URIRef(f'http://ex.tt/{i}'), URIRef('http://ex.tt/p'), literal))
+    server = StandIn(graph)
+    server.json = json_results
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        endpoint = Endpoint(server.url)
+        rows = run(endpoint.select('SELECT ?s ?o ?u WHERE { ?s ?p ?o }'), endpoint)
+        assert {row[1] for row in rows} == set(literals)
+        # an unbound variable
+        assert all(row[2] is None for row in rows)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_max_in_flight(standin):
+    standin.delay = 0.05
+    endpoint = Endpoint(standin.url, max_in_flight=2)
+
+    async def queries():
+        try:
+            return await asyncio.gather(*[endpoint.select(to_uq(shape)) for shape in SHAPES * 3])
+        finally:
+            await endpoint.close()
+
+    assert all(asyncio.run(queries()))
+    assert standin.max_in_flight == endpoint.max_seen_in_flight == 2
+    assert endpoint.connections == 2
+
+
+def test_retry(standin):
+    standin.failures = 2
+    endpoint = Endpoint(standin.url, backoff=0.01)
+    assert run(endpoint.select(to_uq(SHAPES[0])), endpoint)
+    assert endpoint.retried == 2
+
+    standin.failures = 2
+    endpoint = Endpoint(standin.url, retries=1, backoff=0.01)
+    with pytest.raises(EndpointError) as e:
+        run(endpoint.select(to_uq(SHAPES[0])), endpoint)
+    assert e.value.status == 503
+
+
+def test_not_retried(standin):
+    endpoint = Endpoint(standin.url, backoff=0.01)
+    # a query that cannot be parsed
+    with pytest.raises(EndpointError) as e:
+        run(endpoint.select('SELECT'), endpoint)
+    assert e.value.status == 400
+    assert endpoint.retried == 0
+
+
+def test_timeout(standin):
+    standin.delay = 0.5
+    endpoint = Endpoint(standin.url, timeout=0.1, backoff=0.01)
+
+    async def queries():
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await endpoint.select(to_uq(SHAPES[0]))
+            # not retried, the connection is not reused
+            assert endpoint.retried == 0
+            assert endpoint.in_flight == 0
+            standin.delay = 0.0
+            return await endpoint.select(to_uq(SHAPES[0]))
+        finally:
+            await endpoint.close()
+
+    assert asyncio.run(queries())
+    assert endpoint.connections == 2
+
+
+def test_cancel(standin):
+    standin.delay = 0.5
+    endpoint = Endpoint(standin.url)
+
+    async def queries():
+        try:
+            task = asyncio.ensure_future(endpoint.select(to_uq(SHAPES[0])))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert endpoint.in_flight == 0
+            standin.delay = 0.0
+            return await endpoint.select(to_uq(SHAPES[0]))
+        finally:
+            await endpoint.close()
+
+    assert asyncio.run(queries())
+    assert endpoint.connections == 2
+
+
+def test_incremental(standin):
+    standin.gate = Event()
+    endpoint = Endpoint(standin.url, timeout=2)
+
+    async def query():
+        try:
+            rows = []
+            async for row in endpoint.rows(to_uq(TOP)):
+                # the endpoint sends the other rows once the first one is read
+                standin.gate.set()
+                rows.append(row)
+            return rows
+        finally:
+            await endpoint.close()
+
+    start = time.perf_counter()
+    rows = asyncio.run(query())
+    assert len(rows) > 1
+    assert time.perf_counter() - start < 2
+
+
+def test_stop_early(standin):
+    endpoint = Endpoint(standin.url)
+
+    async def query():
+        rows = endpoint.rows(to_uq(TOP))
+        try:
+            async for _ in rows:
+                break
+        finally:
+            await rows.aclose()
+        assert endpoint.in_flight == 0
+        # the connection was not read to the end, it is not reused
+        assert not endpoint.stats()['idle']
+        result = await endpoint.select(to_uq(TOP))
+        await endpoint.close()
+        return result
+
+    assert asyncio.run(query())
+    assert endpoint.connections == 2
@@ -0,0 +1,430 @@
+import re
+from typing import Dict, FrozenSet, Iterable, Optional
+
+from rdflib import Graph, Literal
+from rdflib.namespace import RDF, SH, XSD
+from rdflib.term import BNode, Node, URIRef
+
+import trampoline
+from algebra import SANode, Op
+from pathalg import PANode
+from patheval import PathEvaluator
+
+'''
+Native evaluation of the shape algebra
+
+An Evaluator computes the nodes of an rdflib Graph that conform to a shape
+directly, as operations on sets of nodes, instead of translating the shape
+to SPARQL (unaryquery.py) and evaluating the query. The result of every node
+of the algebra, the successors of every path and the nodes of the graph are
+computed once per Evaluator, shared by all the shapes evaluated with it, and
+computed again when the graph changes.
+
+A path is evaluated to a successor index by a patheval.PathEvaluator: a dict
+from every node with a value to the set of its values. The counting,
+universal and comparison operators are evaluated on the index of their path,
+a negation is a difference with the nodes of the graph, or with the nodes of
+an enclosing conjunction.
+
+focus evaluates a shape for some nodes only, like the target nodes of a
+shape: top-down, every subshape is evaluated for the values its path leads to
+from those nodes (patheval.PathEvaluator.successors), so the cost depends on
+the nodes and their neighbourhoods instead of on the size of the graph.
+
+The results are the results of the SPARQL translation evaluated by rdflib,
+including its treatment of errors: a test that cannot be evaluated on a node
+(like strlen of an IRI) is neither passed nor failed by the node, as a
+FILTER with an error. Literals are compared like rdflib compares them.
+'''
+
+_REGEX_FLAGS = {'i': re.IGNORECASE, 's': re.DOTALL, 'm': re.MULTILINE, 'x': re.VERBOSE}
+_OPERATORS = {'>': Literal.__gt__, '>=': Literal.__ge__, '<': Literal.__lt__, '<=': Literal.__le__}
+_NODE_KINDS = {SH.IRI: (URIRef,), SH.Literal: (Literal,), SH.BlankNode: (BNode,),
+               SH.BlankNodeOrIRI: (BNode, URIRef), SH.BlankNodeOrLiteral: (BNode, Literal),
+               SH.IRIOrLiteral: (URIRef, Literal)}
+
+
+class Evaluator:
+    """The conformance of the nodes of a graph to shapes, each node of the algebra once"""
+
+    def __init__(self, graph: Graph, paths: Optional[PathEvaluator] = None):
+        self.graph = graph
+        self.paths = paths if paths is not None else PathEvaluator(graph)
+        self._version = self.paths.version
+        self._conforming = {}  # SANode -> conforming nodes
+        self._tests = {}  # test SANode -> (passing nodes, failing nodes)
+        self._focused = {}  # SANode -> (nodes evaluated by focus, the ones conforming)
+
+    @property
+    def universe(self) -> FrozenSet[Node]:
+        """The nodes of the graph, the subjects and objects of its triples"""
+        return self.paths.universe
+
+    def conforming(self, node: SANode) -> FrozenSet[Node]:
+        """The nodes conforming to node, like the results of unaryquery.to_uq; node is expanded"""
+        self._check()
+        return trampoline.run(self._shape(node))
+
+    def focus(self, node: SANode, nodes: Iterable[Node]) -> FrozenSet[Node]:
+        """
+        The nodes of nodes conforming to node, like conforming(node) & nodes,
+        evaluated for those nodes (and the values they lead to) only
+        """
+        self._check()
+        return trampoline.run(self._focus(node, frozenset(nodes)))
+
+    def _check(self):
+        # the sets of a graph that changed since are dropped, see patheval
+        self.paths.check()
+        if self._version != self.paths.version:
+            self._version = self.paths.version
+            self._conforming = {}
+            self._tests = {}
+            self._focused = {}
+
+    def values(self, path: PANode) -> Dict[Node, FrozenSet[Node]]:
+        """The successor index of path: every node with a value, to its values"""
+        return self.paths.values(path)
+
+    def _shape(self, node: SANode):
+        # generator, see trampoline.run
+        if node not in self._conforming:
+            self._conforming[node] = frozenset((yield self._evaluate(node)))
+        return self._conforming[node]
+
+    def _evaluate(self, node: SANode):
+        # generator, the conforming nodes of node
+        if node.op == Op.HASSHAPE:
+            raise ValueError('node must be expanded')
+
+        if node.op == Op.TOP:
+            return self.universe
+
+        if node.op == Op.HASVALUE:
+            return {node.children[0]}
+
+        if node.op == Op.TEST:
+            return self._test(node)[0]
+
+        if node.op == Op.AND:
+            # the negations are subtracted from the other conjuncts
+            positive = []
+            negative = []
+            for child in node.children:
+                if child.op == Op.NOT and child.children[0].op != Op.TEST:
+                    negative.append((yield self._shape(child.children[0])))
+                else:
+                    positive.append((yield self._shape(child)))
+            if not positive:
+                positive.append(self.universe)
+            positive.sort(key=len)
+            result = set(positive[0]).intersection(*positive[1:])
+            return result.difference(*negative)
+
+        if node.op == Op.OR:
+            result = set()
+            for child in node.children:
+                result |= yield self._shape(child)
+            return result
+
+        if node.op == Op.NOT:
+            child = node.children[0]
+            if child.op == Op.TOP:
+                # the target of the shapes without target, without the nodes of the graph
+                return set()
+            if child.op == Op.TEST:
+                return self._test(child)[1]
+            return self.universe - (yield self._shape(child))
+
+        if node.op == Op.GEQ:
+            minimum = max(int(node.children[0]), 1)
+            index = self.paths.values(node.children[1])
+            if node.children[2].op == Op.TOP:
+                return {v for v, values in index.items() if len(values) >= minimum}
+            shape = yield self._shape(node.children[2])
+            return {v for v, values in index.items() if len(values & shape) >= minimum}
+
+        if node.op == Op.LEQ:
+            maximum = int(node.children[0])
+            index = self.paths.values(node.children[1])
+            if node.children[2].op == Op.TOP:
+                return self.universe - {v for v, values in index.items() if len(values) > maximum}
+            shape = yield self._shape(node.children[2])
+            return self.universe - {v for v, values in index.items()
+                                    if len(values & shape) > maximum}
+
+        if node.op == Op.EXACTLY1:
+            index = self.paths.values(node.children[0])
+            return {v for v, values in index.items() if len(values) == 1}
+
+        if node.op == Op.FORALL:
+            index = self.paths.values(node.children[0])
+            child = node.children[1]
+            if child.op == Op.TOP:
+                return self.universe
+            if is_test(child):
+                # as unaryquery: the values that fail the test, not the ones
+                # without an error
+                failing = self._test(child)[1]
+                return self.universe - {v for v, values in index.items()
+                                        if not values.isdisjoint(failing)}
+            shape = yield self._shape(child)
+            return self.universe - {v for v, values in index.items() if not values <= shape}
+
+        if node.op == Op.EQ:
+            index1 = self.paths.values(node.children[0])
+            index2 = self.paths.values(node.children[1])
+            return self.universe - {v for v in index1.keys() | index2.keys()
+                                    if index1.get(v, frozenset()) != index2.get(v, frozenset())}
+
+        if node.op == Op.DISJ:
+            index1 = self.paths.values(node.children[0])
+            index2 = self.paths.values(node.children[1])
+            return self.universe - {v for v, values in index1.items()
+                                    if not values.isdisjoint(index2.get(v, frozenset()))}
+
+        if node.op == Op.CLOSED:
+            allowed = {child.children[0] for child in node.children}
+            others = {p for p in self.graph.predicates() if p not in allowed}
+            return self.universe - {s for p in others for s in self.graph.subjects(p)}
+
+        if node.op in (Op.LESSTHAN, Op.LESSTHANEQ):
+            index = self.paths.values(node.children[0])
+            bounds = self.paths.values(node.children[1])
+            # the nodes with a value that no bound exceeds (or reaches, for LESSTHAN)
+            operator = '>=' if node.op == Op.LESSTHAN else '>'
+            return {v for v, values in index.items()
+                    if any(not any(compare(bound, operator, value) for bound in bounds.get(v, ()))
+                           for value in values)}
+
+        if node.op == Op.UNIQUELANG:
+            index = self.paths.values(node.children[0])
+            return self.universe - {v for v, values in index.items() if not _unique_languages(values)}
+
+        raise ValueError(f'Unknown operator {node.op}')
+
+    def _focus(self, node: SANode, nodes: FrozenSet[Node]):
+        # generator, the nodes of nodes conforming to node, each node evaluated once
+        if node in self._conforming:
+            return self._conforming[node] & nodes
+        evaluated, conforming = self._focused.setdefault(node, (set(), set()))
+        todo = nodes - evaluated
+        if todo:
+            conforming |= yield self._evaluate_focus(node, todo)
+            evaluated |= todo
+        return frozenset(conforming.intersection(nodes))
+
+    def _evaluate_focus(self, node: SANode, nodes: FrozenSet[Node]):
+        # generator, as _evaluate for the nodes of nodes; the nodes outside
+        # the graph only conform to the shapes that do not need the universe
+        if node.op == Op.HASSHAPE:
+            raise ValueError('node must be expanded')
+
+        if node.op == Op.TOP:
+            return self._contained(nodes)
+
+        if node.op == Op.HASVALUE:
+            return nodes & {node.children[0]}
+
+        if node.op == Op.TEST:
+            return {v for v in self._contained(nodes) if passes(node, v) is True}
+
+        if node.op == Op.AND:
+            # every conjunct evaluates the nodes that passed the ones before
+            remaining = nodes
+            negative = []
+            positive = False
+            for child in node.children:
+                if child.op == Op.NOT and child.children[0].op != Op.TEST:
+                    negative.append(child.children[0])
+                else:
+                    positive = True
+                    remaining = yield self._focus(child, remaining)
+            if not positive:
+                remaining = self._contained(remaining)
+            for child in negative:
+                remaining = remaining - (yield self._focus(child, remaining))
+            return remaining
+
+        if node.op == Op.OR:
+            result = set()
+            remaining = nodes
+            for child in node.children:
+                found = yield self._focus(child, remaining)
+                result |= found
+                remaining = remaining - found
+            return result
+
+        if node.op == Op.NOT:
+            child = node.children[0]
+            if child.op == Op.TEST:
+                return {v for v in self._contained(nodes) if passes(child, v) is False}
+            return self._contained(nodes) - (yield self._focus(child, nodes))
+
+        if node.op in (Op.GEQ, Op.LEQ):
+            index = self.paths.successors(node.children[1], nodes)
+            child = node.children[2]
+            if child.op == Op.TOP:
+                counts = {v: len(values) for v, values in index.items()}
+            else:
+                shape = yield self._focus(child, frozenset().union(*index.values()))
+                counts = {v: len(values & shape) for v, values in index.items()}
+            if node.op == Op.GEQ:
+                minimum = max(int(node.children[0]), 1)
+                return {v for v, count in counts.items() if count >= minimum}
+            maximum = int(node.children[0])
+            return self._contained(nodes) - {v for v, count in counts.items() if count > maximum}
+
+        if node.op == Op.EXACTLY1:
+            index = self.paths.successors(node.children[0], nodes)
+            return {v for v, values in index.items() if len(values) == 1}
+
+        if node.op == Op.FORALL:
+            child = node.children[1]
+            if child.op == Op.TOP:
+                return self._contained(nodes)
+            index = self.paths.successors(node.children[0], nodes)
+            if is_test(child):
+                return self._contained(nodes) - {v for v, values in index.items()
+                                                 if any(passes(child, value) is False for value in values)}
+            shape = yield self._focus(child, frozenset().union(*index.values()))
+            return self._contained(nodes) - {v for v, values in index.items() if not values <= shape}
+
+        if node.op in (Op.EQ, Op.DISJ):
+            index1 = self.paths.successors(node.children[0], nodes)
+            index2 = self.paths.successors(node.children[1], nodes)
+            if node.op == Op.EQ:
+                failing = {v for v in index1.keys() | index2.keys()
+                           if index1.get(v, frozenset()) != index2.get(v, frozenset())}
+            else:
+                failing = {v for v, values in index1.items()
+                           if not values.isdisjoint(index2.get(v, frozenset()))}
+            return self._contained(nodes) - failing
+
+        if node.op == Op.CLOSED:
+            allowed = {child.children[0] for child in node.children}
+            return {v for v in self._contained(nodes)
+                    if all(p in allowed for p in self.graph.predicates(v))}
+
+        if node.op in (Op.LESSTHAN, Op.LESSTHANEQ):
+            index = self.paths.successors(node.children[0], nodes)
+            bounds = self.paths.successors(node.children[1], nodes)
+            operator = '>=' if node.op == Op.LESSTHAN else '>'
+            return {v for v, values in index.items()
+                    if any(not any(compare(bound, operator, value) for bound in bounds.get(v, ()))
+                           for value in values)}
+
+        if node.op == Op.UNIQUELANG:
+            index = self.paths.successors(node.children[0], nodes)
+            return self._contained(nodes) - {v for v, values in index.items() if not _unique_languages(values)}
+
+        raise ValueError(f'Unknown operator {node.op}')
+
+    def _contained(self, nodes: FrozenSet[Node]) -> FrozenSet[Node]:
+        # the nodes of nodes that are nodes of the graph
+        return frozenset(v for v in nodes if self.paths.contains(v))
+
+    def _test(self, node: SANode):
+        # (passing, failing) nodes of the graph of a test, the others give an error
+        if node not in self._tests:
+            passing = set()
+            failing = set()
+            for v in self.universe:
+                result = passes(node, v)
+                if result is True:
+                    passing.add(v)
+                elif result is False:
+                    failing.add(v)
+            self._tests[node] = (frozenset(passing), frozenset(failing))
+        return self._tests[node]
+
+
+def is_test(node: SANode) -> bool:
+    """Whether node is a TEST, a negated TEST or a conjunction of those, see unaryquery.test_condition"""
+    tests = node.children if node.op == Op.AND else [node]
+    return bool(tests) and all(test.op == Op.TEST or test.op == Op.NOT and test.children[0].op == Op.TEST
+                               for test in tests)
+
+
+def passes(node: SANode, term: Node) -> Optional[bool]:
+    """The result of a test (see is_test) on term, None for an error"""
+    if node.op == Op.NOT:
+        result = passes(node.children[0], term)
+        return None if result is None else not result
+    if node.op == Op.AND:
+        results = [passes(child, term) for child in node.children]
+        if False in results:
+            return False
+        return None if None in results else True
+
+    test_type, parameter = node.children[0], node.children[1]
+    if test_type == 'nodekind':
+        return isinstance(term, _NODE_KINDS[parameter])
+    if test_type == 'datatype':
+        if not isinstance(term, Literal):
+            return None
+        if term.language:
+            return parameter == RDF.langString
+        return parameter == (term.datatype or XSD.string)
+    if test_type == 'min_exclusive':
+        return compare(term, '>', parameter)
+    if test_type == 'max_exclusive':
+        return compare(term, '<', parameter)
+    if test_type == 'min_inclusive':
+        return compare(term, '>=', parameter)
+    if test_type == 'max_inclusive':
+        return compare(term, '<=', parameter)
+    if test_type in ('min_length', 'max_length'):
+        if not _is_string(term):
+            return None
+        if test_type == 'min_length':
+            return len(term) >= int(parameter)
+        return len(term) <= int(parameter)
+    if test_type == 'pattern':
+        if not _is_string(term):
+            return None
+        flags = 0
+        for flag in ''.join(str(flag) for flag in node.children[2]):
+            flags |= _REGEX_FLAGS.get(flag, 0)
+        # the pattern is escaped for a SPARQL string, see algebra._escape_backslash
+        return re.search(str(parameter).replace('\\\\', '\\'), str(term), flags) is not None
+    if test_type == 'languageIn':
+        if not isinstance(term, Literal):
+            return None
+        language = (term.language or '').lower()
+        wanted = str(parameter).lower()
+        return bool(language) and (language == wanted or language.startswith(wanted + '-'))
+    raise ValueError(f'Unknown test {test_type}')
+
+
+def _is_string(term: Node) -> bool:
+    # a plain, xsd:string or language tagged literal
+    return isinstance(term, Literal) and term.datatype in (None, XSD.string)
+
+
+def compare(left: Node, operator: str, right: Node) -> Optional[bool]:
+    """
+    left operator right as a FILTER evaluated by rdflib, None for an error.
+    Literals are compared by rdflib.Literal, also when their types differ.
+    """
+    if not isinstance(left, Literal) or not isinstance(right, Literal):
+        return None
+    if left.datatype is not None and not left.datatype.startswith(XSD) and \
+            right.datatype is not None and not right.datatype.startswith(XSD):
+        return None
+    try:
+        result = _OPERATORS[operator](left, right)
+    except TypeError:
+        return None
+    return None if result is NotImplemented else bool(result)
+
+
+def _unique_languages(values) -> bool:
+    # no two values with the same language tag
+    languages = set()
+    for value in values:
+        if isinstance(value, Literal) and value.language:
+            if value.language in languages:
+                return False
+            languages.add(value.language)
+    return True
@@ -0,0 +1,111 @@
+import random
+
+from pytest import mark
+from rdflib import Literal
+
+from algebra import SANode, Op
+from conformance import conforms
+from evaluator import Evaluator
+from pathalg import PANode, POp
+from testsupport import (B, DATA, EX, IRI, P, Q, R, S, SHAPES, SHORT, SMALL, STRING, TOP, conformance_files,
+                         graph)
+from unaryquery import to_uq
+
+
+@mark.parametrize('shape', SHAPES)
+def test_conforming_as_sparql(shape):
+    data = graph(DATA)
+    assert Evaluator(data).conforming(shape) == {row.v for row in data.query(to_uq(shape))}
+
+
+def test_nested_subqueries():
+    # rdflib evaluates the subqueries of the negated operand with the bindings of the row
+    data = graph('''
+        @prefix ex: <http://ex.tt/> .
+        ex:a ex:q ex:b, ex:d .
+        ex:b ex:p ex:b, ex:c, 1 .
+        ex:c ex:p ex:a, 1 .
+        ex:d ex:p ex:d, 1 .
+    ''')
+    shape = SANode(Op.FORALL, [PANode(POp.INV, [P]), SANode(Op.FORALL, [
+        PANode(POp.ZEROORONE, [P]), SANode(Op.LESSTHAN, [Q, Q])])])
+    expected = Evaluator(data).conforming(shape)
+    assert expected == set()
+    assert {row.v for row in data.query(to_uq(shape))} == expected
+
+
+def _random_path(rnd, depth):
+    if depth == 0 or rnd.random() < 0.5:
+        return rnd.choice([P, Q, R, S])
+    pop = rnd.choice([POp.INV, POp.ZEROORONE, POp.KLEENE, POp.ALT, POp.COMP])
+    if pop in (POp.ALT, POp.COMP):
+        return PANode(pop, [_random_path(rnd, depth - 1), _random_path(rnd, depth - 1)])
+    return PANode(pop, [_random_path(rnd, depth - 1)])
+
+
+def _random_shape(rnd, depth):
+    if depth == 0 or rnd.random() < 0.25:
+        return rnd.choice([TOP, IRI, STRING, SMALL, SHORT, B, SANode(Op.HASVALUE, [EX.a]),
+                           SANode(Op.HASVALUE, [Literal(5)]), SANode(Op.NOT, [TOP]), SANode(Op.OR, [])])
+    op = rnd.choice([Op.NOT, Op.AND, Op.OR, Op.GEQ, Op.LEQ, Op.FORALL, Op.EQ, Op.DISJ, Op.CLOSED,
+                     Op.LESSTHAN, Op.LESSTHANEQ, Op.EXACTLY1, Op.UNIQUELANG])
+    if op == Op.NOT:
+        return SANode(op, [_random_shape(rnd, depth - 1)])
+    if op in (Op.AND, Op.OR):
+        return SANode(op, [_random_shape(rnd, depth - 1) for _ in range(rnd.randint(1, 3))])
+    if op in (Op.GEQ, Op.LEQ):
+        return SANode(op, [Literal(rnd.randint(0, 2)), _random_path(rnd, 2), _random_shape(rnd, depth - 1)])
+    if op == Op.FORALL:
+        return SANode(op, [_random_path(rnd, 2), _random_shape(rnd, depth - 1)])
+    if op in (Op.EQ, Op.DISJ, Op.LESSTHAN, Op.LESSTHANEQ):
+        return SANode(op, [_random_path(rnd, 1), rnd.choice([P, Q, R, S])])
+    if op == Op.CLOSED:
+        return SANode(op, rnd.sample([P, Q, R, S], rnd.randint(1, 3)))
+    if op == Op.EXACTLY1:
+        return SANode(op, [_random_path(rnd, 1)])
+    return SANode(op, [rnd.choice([P, Q, R, S])])
+
+
+@mark.parametrize('seed', range(3))
+def test_random_shapes(seed):
+    # the two engines agree on shapes nobody picked
+    data = graph(DATA)
+    rnd = random.Random(seed)
+    for _ in range(200):
+        shape = _random_shape(rnd, 3)
+        assert Evaluator(data).conforming(shape) == {row.v for row in data.query(to_uq(shape))}, shape
+
+
+@mark.parametrize('shape', SHAPES + [
+    SANode(Op.GEQ, [Literal(2), PANode(POp.INV, [PANode(POp.KLEENE, [P])]), TOP]),
+    SANode(Op.GEQ, [Literal(1), PANode(POp.INV, [PANode(POp.COMP, [P, PANode(POp.ZEROORONE, [Q])])]), IRI]),
+])
+def test_focus(shape):
+    data = graph(DATA)
+    expected = Evaluator(data).conforming(shape)
+    evaluator = Evaluator(data)
+    # the nodes outside the graph too, and nodes evaluated before
+    for nodes in [{EX.a, EX.z}, {EX.b, Literal(5), Literal('Bart')}, set(evaluator.universe) | {EX.z}]:
+        assert evaluator.focus(shape, nodes) == expected & nodes
+
+
+def test_shared_evaluator():
+    data = graph(DATA)
+    evaluator = Evaluator(data)
+    for shape in SHAPES:
+        evaluator.conforming(shape)
+    # every subshape and path was evaluated once, with the shapes that contain it
+    assert evaluator.conforming(IRI) is evaluator.conforming(IRI)
+    assert evaluator.values(P)[EX.a] == {EX.b, EX.c, Literal('Bob'), Literal(5)}
+
+
+def test_deep_shape():
+    shape = SANode(Op.HASVALUE, [EX.a])
+    for _ in range(5000):
+        shape = SANode(Op.FORALL, [P, SANode(Op.NOT, [shape])])
+    assert Evaluator(graph(DATA)).conforming(shape)
+
+
+def test_conforms():
+    data, shapes = conformance_files('and-001')
+    assert conforms(data, shapes) == conforms(data, shapes, native=False)
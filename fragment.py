@@ -0,0 +1,190 @@
+from typing import TYPE_CHECKING, Iterable, Iterator, Set, Union
+
+import rdflib
+from rdflib import Literal
+from rdflib.term import BNode, Node
+
+import trampoline
+from algebra import SANode, Op, negation_normal_form
+from evaluator import Evaluator, compare
+from pathalg import PANode, POp
+from patheval import Triple, trace
+
+if TYPE_CHECKING:
+    import compiler
+    import encoded
+
+'''
+Native shape fragments
+
+A FragmentExtractor computes shape fragments on a graph without SPARQL: the
+triples of the neighbourhood of every conforming node, as to_sfquery
+(sfquery.py) defines them. The graph is an rdflib Graph, evaluated by an
+evaluator.Evaluator, or an encoded.EncodedGraph, evaluated by an
+encoded.MaskEvaluator.
+
+The neighbourhood of a node is collected by walking the shape, with the
+conforming nodes of the subshapes and the triples on the paths
+(patheval.trace) given by the evaluator. Every triple is yielded once, as soon
+as the neighbourhood of a node that has it is collected, so the fragment can
+be written while the rest is found: write_ntriples writes it as N-Triples.
+'''
+
+_COMPARISONS = {Op.LESSTHAN: '<', Op.LESSTHANEQ: '<='}
+
+
+class FragmentExtractor:
+    """The shape fragments of a graph, each triple once"""
+
+    def __init__(self, graph: Union[rdflib.Graph, 'encoded.EncodedGraph']):
+        self.graph = graph
+        if isinstance(graph, rdflib.Graph):
+            self.evaluator = Evaluator(graph)
+        else:
+            # numpy is only needed for encoded graphs
+            from encoded import MaskEvaluator
+            self.evaluator = MaskEvaluator(graph)
+        self._predicates = None
+        self._negations = {}  # memo of negation_normal_form
+        self._visited = set()  # (shape, node) whose neighbourhood is collected
+        self._seen = set()  # the triples yielded
+
+    def triples(self, shape: SANode) -> Iterator[Triple]:
+        """
+        The triples of the fragment of shape that were not yielded before;
+        shape is expanded and in negation normal form
+        """
+        for node in self.evaluator.conforming(shape):
+            found = set()
+            trampoline.run(self._neighbourhood(shape, node, found))
+            for triple in found - self._seen:
+                self._seen.add(triple)
+                yield triple
+
+    def _values(self, path: PANode, node: Node) -> frozenset:
+        return self.evaluator.values(path).get(node, frozenset())
+
+    def _trace(self, path: PANode, node: Node, targets=None) -> Set[Triple]:
+        return trace(self.evaluator.values, path, node, targets)
+
+    def _neighbourhood(self, shape: SANode, node: Node, found: Set[Triple]):
+        # generator, adds the triples of the neighbourhood of node, conforming to shape, to found
+        if (shape, node) in self._visited:
+            return
+        self._visited.add((shape, node))
+
+        if shape.op == Op.OR:
+            for child in shape.children:
+                if node in self.evaluator.conforming(child):
+                    yield self._neighbourhood(child, node, found)
+
+        elif shape.op == Op.AND:
+            for child in shape.children:
+                yield self._neighbourhood(child, node, found)
+
+        elif shape.op in (Op.GEQ, Op.LEQ):
+            path, child = shape.children[1], shape.children[2]
+            if shape.op == Op.LEQ:
+                # the values that do not conform, nothing for TOP
+                if child.op == Op.TOP:
+                    return
+                child = negation_normal_form(SANode(Op.NOT, [child]), self._negations)
+            heads = self._values(path, node)
+            if child.op != Op.TOP:
+                heads = heads & self.evaluator.conforming(child)
+            found |= self._trace(path, node, heads)
+            for head in heads:
+                yield self._neighbourhood(child, head, found)
+
+        elif shape.op == Op.FORALL:
+            path, child = shape.children
+            found |= self._trace(path, node)
+            for head in self._values(path, node):
+                yield self._neighbourhood(child, head, found)
+
+        elif shape.op == Op.EQ:
+            found |= self._trace(shape.children[0], node)
+            found |= self._trace(shape.children[1], node)
+
+        elif shape.op == Op.EXACTLY1:
+            found |= self._trace(shape.children[0], node)
+
+        elif shape.op == Op.NOT:
+            found |= self._violations(shape.children[0], node)
+
+    def _violations(self, shape: SANode, node: Node) -> Set[Triple]:
+        # the triples of node that violate shape, a CLOSED, UNIQUELANG or pair constraint
+        if shape.op == Op.CLOSED:
+            allowed = {child.children[0] for child in shape.children}
+            triples = set()
+            for p in self._predicate_list():
+                if p not in allowed:
+                    triples |= {(node, p, o) for o in self._values(PANode(POp.PROP, [p]), node)}
+            return triples
+
+        if shape.op == Op.UNIQUELANG:
+            # lang(?h) = lang(?h2) as SPARQL: also the literals without a language
+            path = shape.children[0]
+            languages = {}
+            for value in self._values(path, node):
+                if isinstance(value, Literal):
+                    languages.setdefault(value.language or '', []).append(value)
+            heads = [value for values in languages.values() if len(values) > 1 for value in values]
+            return self._trace(path, node, heads)
+
+        if shape.op in (Op.EQ, Op.DISJ, Op.LESSTHAN, Op.LESSTHANEQ):
+            path1, path2 = shape.children
+            values1 = self._values(path1, node)
+            values2 = self._values(path2, node)
+            if shape.op == Op.EQ:
+                heads1, heads2 = values1 - values2, values2 - values1
+            elif shape.op == Op.DISJ:
+                heads1 = heads2 = values1 & values2
+            else:
+                # the pairs for which the comparison is false, not an error
+                operator = _COMPARISONS[shape.op]
+                heads1 = [h for h in values1 if any(compare(h, operator, h2) is False for h2 in values2)]
+                heads2 = [h for h in values2 if any(compare(h2, operator, h) is False for h2 in values1)]
+            return self._trace(path1, node, heads1) | self._trace(path2, node, heads2)
+
+        return set()
+
+    def _predicate_list(self):
+        if self._predicates is None:
+            if isinstance(self.graph, rdflib.Graph):
+                self._predicates = list(set(self.graph.predicates()))
+            else:
+                self._predicates = list(self.graph.forward)
+        return self._predicates
+
+
+def extract(compiled: 'compiler.CompiledSchema',
+            graph: Union[rdflib.Graph, 'encoded.EncodedGraph']) -> Iterator[Triple]:
+    """The triples of the shape fragment of compiled on graph, like the results of its fragment query"""
+    extractor = FragmentExtractor(graph)
+    for shape_name in compiled.targeted:
+        yield from extractor.triples(compiled.shapes[shape_name])
+
+
+def write_ntriples(triples: Iterable[Triple], sink) -> int:
+    """Writes triples to sink, an object with a write(str) method, as N-Triples; returns their number"""
+    count = 0
+    for s, p, o in triples:
+        sink.write(f'{ntriples_term(s)} {ntriples_term(p)} {ntriples_term(o)} .\n')
+        count += 1
+    return count
+
+
+def ntriples_term(term: Node) -> str:
+    """term in N-Triples syntax"""
+    if isinstance(term, Literal):
+        lexical = str(term).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+        if term.language:
+            return f'"{lexical}"@{term.language}'
+        if term.datatype is not None:
+            return f'"{lexical}"^^<{term.datatype}>'
+        return f'"{lexical}"'
+    if isinstance(term, BNode):
+        return f'_:{term}'
+    return f'<{term}>'
@@ -0,0 +1,82 @@
+from io import StringIO
+
+from pytest import mark
+from rdflib import Dataset, Graph, Literal
+
+import compiler
+import pipeline
+from algebra import SANode, Op
+from encoded import EncodedGraph
+from fragment import FragmentExtractor, extract, write_ntriples
+from sfquery import to_sfquery_rope
+from testsupport import (DATA, EX, FRAGMENT_SHAPES, IRI, P, Q, R, RECTANGLE_SHAPES, S, TARGETED_DATA,
+                         TARGETED_FRAGMENT, TARGETED_SHAPES, TOP, graph, rectangles)
+
+
+def _sparql(compiled, data):
+    # the conformance queries evaluated first, see pipeline.py
+    dataset = Dataset()
+    for triple in data:
+        dataset.add(triple)
+    return {(s, p, o) for v, s, p, o in pipeline.run_fragment_query(compiled, dataset) if s is not None}
+
+
+# the constructs that sh:not gives, in negation normal form: as a shapes graph,
+# their LEQ loses its shape (see algebra.remove_empty)
+NEGATIONS = [
+    SANode(Op.LEQ, [Literal(1), P, SANode(Op.NOT, [IRI])]),
+    SANode(Op.LEQ, [Literal(1), Q, SANode(Op.GEQ, [Literal(1), P, TOP])]),
+    SANode(Op.NOT, [SANode(Op.CLOSED, [P, Q])]),
+    SANode(Op.NOT, [SANode(Op.UNIQUELANG, [R])]),
+    SANode(Op.NOT, [SANode(Op.EQ, [P, Q])]),
+    SANode(Op.NOT, [SANode(Op.DISJ, [P, Q])]),
+    SANode(Op.NOT, [SANode(Op.LESSTHAN, [S, S])]),
+    SANode(Op.AND, [SANode(Op.EQ, [P, P]), SANode(Op.EXACTLY1, [S])]),
+]
+
+
+@mark.parametrize('shape', NEGATIONS)
+def test_triples_as_sparql(shape):
+    data = graph(DATA)
+    dataset = Dataset()
+    for triple in data:
+        dataset.add(triple)
+    conformance = pipeline.EvaluatedConformance(dataset)
+    query = str(to_sfquery_rope(shape, False, conformance))
+    expected = {(row.s, row.p, row.o) for row in dataset.query(query) if row.s is not None}
+    assert expected
+    assert set(FragmentExtractor(data).triples(shape)) == expected
+
+
+@mark.parametrize('shapes, data', [(FRAGMENT_SHAPES, DATA), (TARGETED_SHAPES, TARGETED_DATA)])
+def test_extract_as_sparql(shapes, data):
+    compiled = compiler.compile_schema(graph(shapes))
+    expected = _sparql(compiled, graph(data))
+    assert expected
+    triples = list(extract(compiled, graph(data)))
+    assert len(triples) == len(set(triples))
+    assert set(triples) == expected
+    assert set(extract(compiled, EncodedGraph.from_triples(graph(data)))) == expected
+
+
+def test_rectangles():
+    compiled = compiler.compile_schema(graph(RECTANGLE_SHAPES))
+    data = rectangles(40)
+    assert set(extract(compiled, data)) == _sparql(compiled, data)
+
+
+def test_write_ntriples():
+    compiled = compiler.compile_schema(graph(TARGETED_SHAPES))
+    sink = StringIO()
+    assert write_ntriples(extract(compiled, graph(TARGETED_DATA)), sink) == 5
+    written = Graph()
+    written.parse(data=sink.getvalue(), format='nt')
+    assert set(written) == {triple[1:] for triple in TARGETED_FRAGMENT}
+
+
+def test_triples_once():
+    compiled = compiler.compile_schema(graph(TARGETED_SHAPES))
+    extractor = FragmentExtractor(graph(TARGETED_DATA))
+    first = set(extractor.triples(compiled.shapes[EX.a]))
+    # ex:c takes the fragment of ex:b2, already in the one of ex:a
+    assert not set(extractor.triples(compiled.shapes[EX.c])) - first
@@ -0,0 +1,109 @@
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
+
+import rdflib
+
+from conformance import DEFAULT_BATCH_SIZE, PreparedSchema
+
+if TYPE_CHECKING:
+    import encoded
+
+'''
+Parallel validation
+
+validate evaluates every targeted shape of a schema as a job of its own, in a
+process pool: rdflib evaluates queries in Python, holding the GIL, so threads
+would not run them at the same time. The data graph is sent to every worker
+once, when it starts, as a snapshot: the triples of an rdflib Graph (the
+worker builds a Graph of its own, with the same blank nodes) or the arrays of
+an encoded.EncodedGraph. The schema is sent along, so its shapes are not
+parsed again. A worker keeps one evaluator for all its jobs, the subshapes the
+shapes of a worker have in common are evaluated once per worker.
+
+Every job reports its wall time, conforms merges the results as
+conformance.conforms returns them.
+'''
+
+
+class ShapeResult:
+    """The validation of one shape"""
+
+    def __init__(self, shape_name, targets: set, violations: set, seconds: float):
+        self.shape_name = shape_name
+        self.targets = targets  # the target nodes
+        self.violations = violations  # the target nodes that do not conform
+        self.seconds = seconds  # the wall time of the job
+
+
+def validate(data_graph: Union['rdflib.Graph', 'encoded.EncodedGraph'], schema: PreparedSchema,
+             native=True, workers: Optional[int] = None, focus: Optional[bool] = None,
+             batch_size: int = DEFAULT_BATCH_SIZE) -> List[ShapeResult]:
+    """
+    The ShapeResult of every targeted shape of schema, in order, evaluated in
+    workers processes (the number of CPUs by default, one runs in this
+    process). The options are the ones of conformance.conforms.
+    """
+    if workers == 1:
+        evaluator = schema.evaluator(data_graph, native)
+        return [_timed(schema, data_graph, evaluator, shape_name, focus, batch_size)
+                for shape_name in schema.shape_names]
+
+    if isinstance(data_graph, rdflib.Graph):
+        # the store and its listeners are not sent, only the triples
+        snapshot = pickle.dumps(list(data_graph), protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        snapshot = pickle.dumps(data_graph, protocol=pickle.HIGHEST_PROTOCOL)
+    with ProcessPoolExecutor(workers, initializer=_start_worker,
+                             initargs=(snapshot, schema, native)) as pool:
+        # one shape per task, the shapes take very different times
+        names = schema.shape_names
+        return list(pool.map(_validate, names, [focus] * len(names), [batch_size] * len(names)))
+
+
+def conforms(data_graph: Union['rdflib.Graph', 'encoded.EncodedGraph'], shapes_graph: 'rdflib.Graph',
+             native=True, workers: Optional[int] = None, focus: Optional[bool] = None,
+             batch_size: int = DEFAULT_BATCH_SIZE) -> Tuple[List[set], List[set]]:
+    """conformance.conforms, with the shapes validated in parallel, see validate"""
+    return merge(validate(data_graph, PreparedSchema(shapes_graph), native, workers, focus, batch_size))
+
+
+def merge(results: List[ShapeResult]) -> Tuple[List[set], List[set]]:
+    """The target nodes of the shapes that conform, and the ones that do not, as conformance.conforms"""
+    conforms = []
+    not_conforms = []
+    for result in results:
+        if result.violations:
+            not_conforms.append(result.violations)
+        else:
+            conforms.append(result.targets)
+    return conforms, not_conforms
+
+
+def _timed(schema: PreparedSchema, data_graph, evaluator, shape_name, focus, batch_size) -> ShapeResult:
+    start = time.perf_counter()
+    targets, violations = schema.validate(shape_name, data_graph, evaluator, focus, batch_size)
+    return ShapeResult(shape_name, targets, violations, time.perf_counter() - start)
+
+
+# the data graph, schema and evaluator of a worker process
+_graph = None
+_schema = None
+_evaluator = None
+
+
+def _start_worker(snapshot: bytes, schema: PreparedSchema, native: bool):
+    global _graph, _schema, _evaluator
+    data = pickle.loads(snapshot)
+    if isinstance(data, list):
+        _graph = rdflib.Graph()
+        _graph.addN((s, p, o, _graph) for s, p, o in data)
+    else:
+        _graph = data
+    _schema = schema
+    _evaluator = schema.evaluator(_graph, native)
+
+
+def _validate(shape_name, focus: Optional[bool], batch_size: int) -> ShapeResult:
+    return _timed(_schema, _graph, _evaluator, shape_name, focus, batch_size)
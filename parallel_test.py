@@ -0,0 +1,32 @@
+from pytest import mark
+
+import conformance
+from conformance import PreparedSchema
+from encoded import EncodedGraph
+from parallel import conforms, validate
+
+
+@mark.parametrize('native', [True, False])
+# targeted: the blank nodes of the data in the results
+@mark.parametrize('case', ['rectangles', 'targeted'], indirect=True)
+def test_conforms(case, native):
+    data, shapes = case
+    expected = conformance.conforms(data, shapes, native)
+    assert conforms(data, shapes, native, workers=2) == expected
+    assert conforms(data, shapes, native, workers=1) == expected
+
+
+@mark.parametrize('case', ['rectangles'], indirect=True)
+def test_encoded(case):
+    data, shapes = case
+    assert conforms(EncodedGraph.from_triples(data), shapes, workers=2) == conformance.conforms(data, shapes)
+
+
+@mark.parametrize('case', ['rectangles'], indirect=True)
+def test_validate(case):
+    data, shapes = case
+    schema = PreparedSchema(shapes)
+    results = validate(data, schema, workers=2)
+    assert [result.shape_name for result in results] == schema.shape_names
+    assert all(result.seconds > 0 for result in results)
+    assert all(result.violations <= result.targets for result in results)
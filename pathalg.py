@@ -1,4 +1,6 @@
 from typing import List
+from threading import Lock
+from weakref import WeakValueDictionary
 
 from enum import Enum, auto
 
@@ -7,6 +9,8 @@ from rdflib.term import URIRef, BNode
 from rdflib.namespace import SH, RDF
 from rdflib.collection import Collection
 
+import trampoline
+
 
 class POp(Enum):  # Path Operator
     PROP = auto()
@@ -18,27 +22,43 @@ class POp(Enum):  # Path Operator
 
 
 class PANode:  # Path Algebra Node
-    """Ordered tree representing a path expression"""
+    """Ordered tree representing a path expression
+
+    Nodes are immutable and hash-consed: constructing a node that is
+    structurally equal to a living node returns that very object. Equality
+    is therefore identity, and the structural hash is computed only once.
+    """
+    __slots__ = ('pop', 'children', '_hash', '__weakref__')
+
+    _interned = WeakValueDictionary()
+    _intern_lock = Lock()
+
+    def __new__(cls, pop: POp, children: List):
+        children = _freeze(children)
+        key = (pop, children)
+        node = cls._interned.get(key)
+        if node is not None:
+            return node
+
+        node = object.__new__(cls)
+        object.__setattr__(node, 'pop', pop)
+        object.__setattr__(node, 'children', children)
+        object.__setattr__(node, '_hash', hash((cls, pop, children)))
+        with cls._intern_lock:
+            return cls._interned.setdefault(key, node)
 
-    def __init__(self, pop: POp, children: List):
-        self.pop = pop
-        self.children = children
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
 
-    def __eq__(self, other):
-        """ Overwrite the '==' operator """
-        if self.pop == POp.PROP:
-            return self.pop == other.pop and \
-              self.children[0] == other.children[0]
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
 
-        if len(self.children) != len(other.children):
-            return False
-        same_children = True
-        for child_self, child_other in zip(self.children, other.children):
-            if type(child_self) == BNode and type(child_other) == BNode:
-                continue
-            same_children = same_children and child_self == child_other
+    def __hash__(self):
+        return self._hash
 
-        return self.pop == other.pop and same_children
+    def __reduce__(self):
+        # unpickling and copying go through __new__ and are interned again
+        return type(self), (self.pop, self.children)
 
     def __repr__(self):
         """ Pretty representation of the PANode tree """
@@ -51,11 +71,22 @@ class PANode:  # Path Algebra Node
         return out
 
 
+def _freeze(children) -> tuple:
+    """Children as a tuple, with nested lists turned into tuples"""
+    return tuple(_freeze(c) if type(c) in (list, tuple) else c
+                 for c in children)
+
+
 def parse(graph: Graph, path) -> PANode:
+    return trampoline.run(_parse(graph, path))
+
+
+def _parse(graph: Graph, path):
+    # generator, see trampoline.run
     if type(path) == URIRef:
         return _parse_prop(path)
     elif type(path) == BNode:
-        return _parse_path(graph, path)
+        return (yield _parse_path(graph, path))
     else:
         raise TypeError(f'Unable to parse path of type {type(path)}')
 
@@ -64,7 +95,8 @@ def _parse_prop(prop: URIRef) -> PANode:
     return PANode(POp.PROP, [prop])
 
 
-def _parse_path(graph: Graph, path: BNode) -> PANode:
+def _parse_path(graph: Graph, path: BNode):
+    # generator, see trampoline.run
     # Basic path constructors, except composition and alternative path
     transl = {SH.inversePath: POp.INV,
               SH.zeroOrMorePath: POp.KLEENE,
@@ -73,12 +105,12 @@ def _parse_path(graph: Graph, path: BNode) -> PANode:
                       SH.zeroOrOnePath]:
         if (path, predicate, None) in graph:
             rest = next(graph.objects(path, predicate))
-            return PANode(transl[predicate], [parse(graph, rest)])
+            return PANode(transl[predicate], [(yield _parse(graph, rest))])
 
     # One or more paths
     if (path, SH.oneOrMorePath, None) in graph:
         rest = next(graph.objects(path, SH.oneOrMorePath))
-        parsed_rest = parse(graph, rest)
+        parsed_rest = yield _parse(graph, rest)
         return PANode(POp.COMP, [parsed_rest,
                                  PANode(POp.KLEENE, [parsed_rest])])
 
@@ -88,7 +120,7 @@ def _parse_path(graph: Graph, path: BNode) -> PANode:
         shacl_list = Collection(graph, first)
         children = []
         for item in shacl_list:
-            step = parse(graph, item)
+            step = yield _parse(graph, item)
             children.append(step)
         return PANode(POp.ALT, children)
 
@@ -97,7 +129,7 @@ def _parse_path(graph: Graph, path: BNode) -> PANode:
         shacl_list = Collection(graph, path)
         children = []
         for item in shacl_list:
-            step = parse(graph, item)
+            step = yield _parse(graph, item)
             children.append(step)
         return PANode(POp.COMP, children)
 
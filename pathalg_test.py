@@ -48,3 +48,10 @@ def test_path_parsing(graph_file, expected_path):
     parsed = parse(g, path)
 
     assert parsed == expected_path
+
+
+def test_path_hash_consing():
+    path = PANode(POp.KLEENE, [PANode(POp.PROP, [EX.a])])
+    assert path is PANode(POp.KLEENE, [PANode(POp.PROP, [EX.a])])
+    assert path is not PANode(POp.KLEENE, [PANode(POp.PROP, [EX.b])])
+    assert {path: 1}[PANode(POp.KLEENE, [PANode(POp.PROP, [EX.a])])] == 1
@@ -0,0 +1,362 @@
+import weakref
+from collections import defaultdict
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from rdflib import Graph
+from rdflib.events import Event
+from rdflib.store import TripleAddedEvent, TripleRemovedEvent
+from rdflib.term import Node
+
+import trampoline
+from pathalg import PANode, POp
+
+'''
+Evaluation of paths
+
+A PathEvaluator computes the values of the paths of pathalg.py in an rdflib
+Graph, as successor indexes: a dict from every node with a value to the set of
+its values. The index of every path is computed once and kept until the graph
+changes.
+
+The index of a KLEENE path, its transitive closure, is not computed with a
+search from every node. The strongly connected components of the steps are
+found once (Tarjan's algorithm), every component reaches the same nodes, and
+the nodes reached by a component are the union of the ones reached by the
+components it has a step to. The components are found successors first, so
+each set is built once and shared by all the nodes of the component.
+
+successors gives the values of a path of some nodes only, found by following
+the triples from those nodes (or to them, for an inverse path) instead of
+computing the index, so its cost depends on the nodes and not on the graph.
+
+edges (and trace, for other evaluators) gives the triples on the paths from a
+node to some of its values, the triples of the paths in a shape fragment (see
+sfquery.graph_paths).
+
+The indexes are dropped when a triple is added to the graph (rdflib
+dispatches an event) or the number of triples changes; call invalidate after
+other changes, like the ones made directly to the store.
+'''
+
+Triple = Tuple[Node, Node, Node]
+
+
+class PathEvaluator:
+    """The values of paths in a graph, each path once"""
+
+    def __init__(self, graph: Graph):
+        self.graph = graph
+        self.version = 0  # incremented when the indexes are dropped
+        self._size = len(graph)
+        self._universe = None
+        self._values = {}  # PANode -> successor index
+        self._successors = {}  # (PANode, inverse) -> the values of the nodes asked for
+        _subscribe(graph, self)
+
+    def invalidate(self):
+        """Drops the indexes, computed again for the graph as it is now"""
+        self.version += 1
+        self._size = len(self.graph)
+        self._universe = None
+        self._values = {}
+        self._successors = {}
+
+    def check(self):
+        """Drops the indexes when the number of triples of the graph changed"""
+        if len(self.graph) != self._size:
+            self.invalidate()
+
+    @property
+    def universe(self) -> FrozenSet[Node]:
+        """The nodes of the graph, the subjects and objects of its triples"""
+        self.check()
+        if self._universe is None:
+            nodes = set()
+            for s, p, o in self.graph:
+                nodes.add(s)
+                nodes.add(o)
+            self._universe = frozenset(nodes)
+        return self._universe
+
+    def values(self, path: PANode) -> Dict[Node, FrozenSet[Node]]:
+        """The successor index of path: every node with a value, to its values"""
+        self.check()
+        return trampoline.run(self._path(path))
+
+    def successors(self, path: PANode, nodes: Iterable[Node]) -> Dict[Node, FrozenSet[Node]]:
+        """
+        The values of path of nodes, the entries of nodes in the successor
+        index of path, found from those nodes without computing the index
+        """
+        self.check()
+        if path in self._values:
+            index = self._values[path]
+            return {v: index[v] for v in nodes if v in index}
+        found = trampoline.run(self._search(path, frozenset(nodes), False))
+        return {v: values for v, values in found.items() if values}
+
+    def contains(self, node: Node) -> bool:
+        """Whether node is a node of the graph, without computing the universe"""
+        if self._universe is not None:
+            return node in self._universe
+        return (node, None, None) in self.graph or (None, None, node) in self.graph
+
+    def edges(self, path: PANode, node: Node, targets: Optional[Iterable[Node]] = None) -> Set[Triple]:
+        """The triples on the paths of path from node to targets, or to all its values"""
+        return trace(self.values, path, node, targets)
+
+    def _path(self, path: PANode):
+        # generator, see trampoline.run
+        if path not in self._values:
+            index = yield self._evaluate_path(path)
+            self._values[path] = {v: frozenset(values) for v, values in index.items()}
+        return self._values[path]
+
+    def _evaluate_path(self, path: PANode):
+        # generator, the successor index of path
+        if path.pop == POp.PROP:
+            index = defaultdict(set)
+            for s, o in self.graph.subject_objects(path.children[0]):
+                index[s].add(o)
+            return index
+
+        if path.pop == POp.INV:
+            index = defaultdict(set)
+            for s, values in (yield self._path(path.children[0])).items():
+                for o in values:
+                    index[o].add(s)
+            return index
+
+        if path.pop == POp.ALT:
+            index = defaultdict(set)
+            for child in path.children:
+                for s, values in (yield self._path(child)).items():
+                    index[s] |= values
+            return index
+
+        if path.pop == POp.COMP:
+            index = yield self._path(path.children[0])
+            for child in path.children[1:]:
+                step = yield self._path(child)
+                composed = {}
+                for s, values in index.items():
+                    successors = set()
+                    for value in values:
+                        successors |= step.get(value, frozenset())
+                    if successors:
+                        composed[s] = successors
+                index = composed
+            return index
+
+        if path.pop == POp.ZEROORONE:
+            step = yield self._path(path.children[0])
+            return {v: step.get(v, frozenset()) | {v} for v in self.universe}
+
+        if path.pop == POp.KLEENE:
+            # every node of the graph reaches itself, and what its component reaches
+            step = yield self._path(path.children[0])
+            reached = _closure(step)
+            return {v: reached.get(v) or frozenset((v,)) for v in self.universe}
+
+        raise ValueError(f'Unknown path operator {path.pop}')
+
+    def _search(self, path: PANode, nodes: FrozenSet[Node], inverse: bool):
+        # generator, the values (predecessors when inverse) of every node of nodes
+        found = self._successors.setdefault((path, inverse), {})
+        todo = [v for v in nodes if v not in found]
+        if todo:
+            found.update((yield self._search_path(path, todo, inverse)))
+        return {v: found[v] for v in nodes}
+
+    def _search_path(self, path: PANode, nodes: List[Node], inverse: bool):
+        # generator, as _search without the memo
+        if path.pop == POp.PROP:
+            p = path.children[0]
+            if inverse:
+                return {v: frozenset(self.graph.subjects(p, v)) for v in nodes}
+            return {v: frozenset(self.graph.objects(v, p)) for v in nodes}
+
+        if path.pop == POp.INV:
+            return (yield self._search(path.children[0], frozenset(nodes), not inverse))
+
+        if path.pop == POp.ALT:
+            found = {v: frozenset() for v in nodes}
+            for child in path.children:
+                for v, values in (yield self._search(child, frozenset(nodes), inverse)).items():
+                    found[v] |= values
+            return found
+
+        if path.pop == POp.COMP:
+            steps = path.children[::-1] if inverse else path.children
+            found = {v: frozenset((v,)) for v in nodes}
+            for step in steps:
+                middle = frozenset().union(*found.values())
+                values = yield self._search(step, middle, inverse)
+                found = {v: frozenset().union(*(values[m] for m in reached)) for v, reached in found.items()}
+            return found
+
+        # the nodes outside the graph reach nothing, not even themselves
+        if path.pop == POp.ZEROORONE:
+            step = yield self._search(path.children[0], frozenset(nodes), inverse)
+            return {v: step[v] | {v} if self.contains(v) else frozenset() for v in nodes}
+
+        if path.pop == POp.KLEENE:
+            # a search from every node, the steps of a node are found once
+            found = {}
+            for v in nodes:
+                if not self.contains(v):
+                    found[v] = frozenset()
+                    continue
+                reached = {v}
+                frontier = frozenset(reached)
+                while frontier:
+                    step = yield self._search(path.children[0], frontier, inverse)
+                    frontier = frozenset().union(*step.values()) - reached
+                    reached |= frontier
+                found[v] = frozenset(reached)
+            return found
+
+        raise ValueError(f'Unknown path operator {path.pop}')
+
+
+def trace(values: Callable[[PANode], Dict[Node, FrozenSet[Node]]], path: PANode, node: Node,
+          targets: Optional[Iterable[Node]] = None) -> Set[Triple]:
+    """
+    The triples on the paths of path from node to targets, or to all its
+    values, given values, the successor index of a path (PathEvaluator.values)
+    """
+    reached = values(path).get(node, frozenset())
+    targets = reached if targets is None else reached.intersection(targets)
+    return trampoline.run(_edges(values, path, node, targets)) if targets else set()
+
+
+def _edges(values, path: PANode, node: Node, targets: FrozenSet[Node]):
+    # generator, the triples on the paths from node to targets, values of node
+    if path.pop == POp.PROP:
+        return {(node, path.children[0], target) for target in targets}
+
+    if path.pop == POp.INV:
+        triples = set()
+        for target in targets:
+            triples |= yield _edges(values, path.children[0], target, frozenset((node,)))
+        return triples
+
+    if path.pop == POp.ALT:
+        triples = set()
+        for child in path.children:
+            reached = targets & values(child).get(node, frozenset())
+            if reached:
+                triples |= yield _edges(values, child, node, reached)
+        return triples
+
+    if path.pop == POp.COMP:
+        first = path.children[0]
+        rest = path.children[1] if len(path.children) == 2 else PANode(POp.COMP, path.children[1:])
+        rest_values = values(rest)
+        # the nodes between the first step and the rest, on a path to targets
+        middle = frozenset(m for m in values(first).get(node, frozenset())
+                           if not targets.isdisjoint(rest_values.get(m, frozenset())))
+        triples = yield _edges(values, first, node, middle)
+        for m in middle:
+            triples |= yield _edges(values, rest, m, targets & rest_values[m])
+        return triples
+
+    if path.pop == POp.ZEROORONE:
+        child = path.children[0]
+        reached = targets & values(child).get(node, frozenset())
+        return (yield _edges(values, child, node, reached)) if reached else set()
+
+    if path.pop == POp.KLEENE:
+        # the steps between the nodes reached from node that reach targets
+        child = path.children[0]
+        closure = values(path)
+        step = values(child)
+        on_paths = frozenset(m for m in closure[node] if not targets.isdisjoint(closure[m]))
+        triples = set()
+        for m in on_paths:
+            reached = on_paths & step.get(m, frozenset())
+            if reached:
+                triples |= yield _edges(values, child, m, reached)
+        return triples
+
+    raise ValueError(f'Unknown path operator {path.pop}')
+
+
+def components(step: Dict[Node, Iterable[Node]]) -> List[List[Node]]:
+    """
+    The strongly connected components of the graph of step, a successor
+    index, each after the components it has a step to (Tarjan's algorithm)
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    result = []
+    for root in step:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(step[root]))]
+        while work:
+            v, successors = work[-1]
+            for w in successors:
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, iter(step.get(w, ()))))
+                    break
+                if w in on_stack:
+                    low[v] = min(low[v], index[w])
+            else:
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        component.append(w)
+                        if w == v:
+                            break
+                    result.append(component)
+    return result
+
+
+def _closure(step: Dict[Node, FrozenSet[Node]]) -> Dict[Node, FrozenSet[Node]]:
+    # the nodes reached in zero or more steps from every node of step
+    reached = {}
+    for component in components(step):
+        members = frozenset(component)
+        nodes = set(members)
+        for v in component:
+            for w in step.get(v, ()):
+                # a node already reached brings nothing new
+                if w not in nodes:
+                    nodes |= reached[w]
+        nodes = frozenset(nodes)
+        for v in component:
+            reached[v] = nodes
+    return reached
+
+
+_watched = weakref.WeakKeyDictionary()  # store -> its PathEvaluators
+
+
+def _subscribe(graph: Graph, evaluator: PathEvaluator):
+    # invalidates evaluator on the events of the store, without keeping it alive
+    store = graph.store
+    if store not in _watched:
+        evaluators = _watched[store] = weakref.WeakSet()
+
+        def changed(event: Event):
+            for evaluator in list(evaluators):
+                evaluator.invalidate()
+
+        store.dispatcher.subscribe(TripleAddedEvent, changed)
+        store.dispatcher.subscribe(TripleRemovedEvent, changed)
+    _watched[store].add(evaluator)
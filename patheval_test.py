@@ -0,0 +1,87 @@
+from collections import defaultdict
+
+from pytest import mark
+from rdflib import Graph, Literal
+
+from algebra import SANode, Op
+from evaluator import Evaluator
+from pathalg import PANode, POp
+from patheval import PathEvaluator, components
+from sfquery import graph_paths
+from testsupport import DATA, EX, P, Q, graph
+
+# the paths whose graph_paths query rdflib evaluates as SPARQL does
+PATHS = [
+    P,
+    PANode(POp.INV, [P]),
+    PANode(POp.ALT, [P, PANode(POp.INV, [Q])]),
+    PANode(POp.ZEROORONE, [P]),
+]
+
+
+def _search(step, node):
+    # the nodes reached from node, one at a time
+    reached = {node}
+    todo = [node]
+    while todo:
+        for value in step.get(todo.pop(), ()):
+            if value not in reached:
+                reached.add(value)
+                todo.append(value)
+    return reached
+
+
+@mark.parametrize('path', PATHS)
+def test_edges_as_sparql(path):
+    data = graph(DATA)
+    expected = defaultdict(set)
+    for row in data.query(graph_paths(path)):
+        if row.s is not None:
+            expected[row.t, row.h].add((row.s, row.p, row.o))
+    paths = PathEvaluator(data)
+    for t, values in paths.values(path).items():
+        for h in values:
+            assert paths.edges(path, t, [h]) == expected[t, h]
+
+
+def test_edges():
+    data = graph(DATA)
+    paths = PathEvaluator(data)
+    assert paths.edges(PANode(POp.COMP, [P, Q]), EX.a, [EX.a]) == {(EX.a, EX.p, EX.c), (EX.c, EX.q, EX.a)}
+    assert paths.edges(PANode(POp.COMP, [P, Q]), EX.a, [EX.d]) == set()
+    x = data.value(EX.d, EX.q)
+    assert paths.edges(PANode(POp.KLEENE, [PANode(POp.ALT, [P, Q])]), EX.d, [Literal('Bart')]) == \
+        {(EX.d, EX.q, x), (x, EX.p, Literal('Bart'))}
+    assert paths.edges(PANode(POp.KLEENE, [P]), EX.a, [EX.a]) == \
+        {(EX.a, EX.p, EX.b), (EX.a, EX.p, EX.c), (EX.b, EX.p, EX.c), (EX.c, EX.p, EX.a)}
+
+
+def test_closure():
+    data = Graph()
+    # a chain of cycles of two nodes
+    for i in range(200):
+        data.add((EX[f'n{i}'], EX.p, EX[f'm{i}']))
+        data.add((EX[f'm{i}'], EX.p, EX[f'n{i}']))
+        data.add((EX[f'm{i}'], EX.p, EX[f'n{i + 1}']))
+    paths = PathEvaluator(data)
+    step = paths.values(P)
+    assert [len(component) for component in components(step)] == [1] + [2] * 200
+    closure = paths.values(PANode(POp.KLEENE, [P]))
+    for node in paths.universe:
+        assert closure[node] == _search(step, node)
+    # the nodes of a component share their set
+    assert closure[EX.n7] is closure[EX.m7]
+    assert len(paths.edges(PANode(POp.KLEENE, [P]), EX.n0, [EX.n2])) == 8
+
+
+def test_invalidated():
+    data = graph(DATA)
+    evaluator = Evaluator(data)
+    kleene = PANode(POp.KLEENE, [P])
+    reaches_d = SANode(Op.GEQ, [Literal(1), kleene, SANode(Op.HASVALUE, [EX.d])])
+    assert EX.a not in evaluator.conforming(reaches_d)
+    data.add((EX.c, EX.p, EX.d))
+    assert EX.d in evaluator.paths.values(kleene)[EX.a]
+    assert EX.a in evaluator.conforming(reaches_d)
+    data.remove((EX.c, EX.p, EX.d))
+    assert EX.a not in evaluator.conforming(reaches_d)
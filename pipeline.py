@@ -0,0 +1,111 @@
+from typing import Dict, List
+
+from rdflib import BNode, Dataset, URIRef
+
+import compiler
+import plan
+import unaryquery
+from algebra import SANode
+from sfquery import to_sfquery_rope
+
+'''
+Multi-stage execution of fragment queries
+
+Instead of sending one fragment query with every conformance query nested in
+it, run_fragment_query evaluates the conformance query of every distinct node
+once, bottom-up, on the data. The conforming nodes are kept here and given to
+the queries that use them as a VALUES block,
+
+    SELECT DISTINCT ?v WHERE { VALUES ?v { <http://ex.tt/a> <http://ex.tt/b> } }
+
+so the fragment query, translated last, no longer computes the conformance of
+?t and ?h in every branch. A set whose VALUES block is larger than max_inline
+characters, or that holds blank nodes (which cannot be written in a query), is
+added to a temporary named graph of the Dataset instead and read from there.
+The temporary graphs are removed when the query has run.
+
+The data must be in the default graph of the Dataset.
+'''
+
+DEFAULT_MAX_INLINE = 64 * 1024
+SPILL_PREFIX = 'urn:ssf:conforming:'
+MEMBER = URIRef('urn:ssf:member')
+
+
+class EvaluatedConformance(unaryquery.ConformanceQueries):
+    """Conformance queries evaluated on a Dataset, each node once"""
+
+    def __init__(self, dataset: Dataset, max_inline: int = DEFAULT_MAX_INLINE,
+                 prefix: str = SPILL_PREFIX):
+        super().__init__()
+        self.dataset = dataset
+        self.max_inline = max_inline
+        self.prefix = prefix
+        self.conforming = {}  # (node, ignore_tests) -> set of conforming nodes
+        self.spilled = []  # the temporary graphs
+        self.inlined = 0  # number of sets given as VALUES
+        self._references = {}
+
+    def reference(self, node: SANode, ignore_tests=False):
+        # generator, see trampoline.run
+        key = (node, ignore_tests)
+        query = yield self.query(node, ignore_tests)
+        if plan.is_restriction(query):
+            # not evaluated, the queries using it can restrict the nodes of the graph
+            return query
+        if key not in self._references:
+            # a query without a pattern has one row without ?v
+            nodes = {row[0] for row in self.dataset.query(str(self.sparql(query)))
+                     if row[0] is not None}
+            self.conforming[key] = nodes
+            self._references[key] = self._values(nodes)
+        return self._references[key]
+
+    def _values(self, nodes):
+        # DISTINCT, rdflib evaluates a join with the bindings of its left side
+        # pushed into the right side unless the right side has a modifier,
+        # and a VALUES block skips the rows whose ?v is already bound
+        if not nodes:
+            # rdflib does not accept an empty VALUES block, and joins a
+            # FILTER without a pattern as if it had one row
+            return plan.project(plan.filtered(plan.FALSE, plan.pattern(f'VALUES ?v {{ <{MEMBER}> }}')),
+                                '?v', distinct=True)
+        if not any(type(node) == BNode for node in nodes):
+            values = ' '.join(sorted(node.n3() for node in nodes))
+            if len(values) <= self.max_inline:
+                self.inlined += 1
+                return plan.project(plan.pattern(f'VALUES ?v {{ {values} }}'), '?v', distinct=True)
+
+        graph = URIRef(f'{self.prefix}{len(self.spilled)}')
+        self.spilled.append(graph)
+        spill = self.dataset.graph(graph)
+        for node in nodes:
+            spill.add((graph, MEMBER, node))
+        return plan.project(plan.pattern(f'GRAPH <{graph}> {{ <{graph}> <{MEMBER}> ?v }}'),
+                            '?v', distinct=True)
+
+    def cleanup(self):
+        for graph in self.spilled:
+            self.dataset.remove_graph(graph)
+        self.spilled = []
+
+
+def run_fragment_query(compiled: compiler.CompiledSchema, dataset: Dataset,
+                       max_inline: int = DEFAULT_MAX_INLINE) -> List:
+    """The rows (?v ?s ?p ?o) of the fragment query of compiled on dataset"""
+    conformance = EvaluatedConformance(dataset, max_inline)
+    try:
+        queries = fragment_queries(compiled, conformance)
+        return list(dataset.query(str(compiler.fragment_rope(compiled, queries))))
+    finally:
+        conformance.cleanup()
+
+
+def fragment_queries(compiled: compiler.CompiledSchema,
+                     conformance: EvaluatedConformance) -> Dict:
+    """
+    The query of every targeted shape, with the conformance queries evaluated.
+    The temporary graphs of conformance must be kept until the queries ran.
+    """
+    return {shape_name: to_sfquery_rope(compiled.shapes[shape_name], False, conformance)
+            for shape_name in compiled.targeted}
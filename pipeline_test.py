@@ -0,0 +1,57 @@
+from rdflib import BNode, Dataset
+
+import compiler
+import pipeline
+from testsupport import EX, TARGETED_DATA, TARGETED_FRAGMENT, TARGETED_SHAPES, graph
+
+
+def _compiled():
+    return compiler.compile_schema(graph(TARGETED_SHAPES))
+
+
+def _dataset(data=TARGETED_DATA):
+    dataset = Dataset()
+    dataset.default_graph.parse(data=data, format='ttl')
+    return dataset
+
+
+def _triples(rows):
+    return {tuple(row) for row in rows if row[1] is not None}
+
+
+def test_run_fragment_query():
+    for max_inline in (pipeline.DEFAULT_MAX_INLINE, 0):
+        dataset = _dataset()
+        size = len(dataset)
+        rows = pipeline.run_fragment_query(_compiled(), dataset, max_inline)
+        assert _triples(rows) == TARGETED_FRAGMENT
+        assert len(dataset) == size  # the temporary graphs are removed
+
+
+def test_conforming():
+    compiled = _compiled()
+    conformance = pipeline.EvaluatedConformance(_dataset())
+    pipeline.fragment_queries(compiled, conformance)
+
+    conforming = conformance.conforming
+    assert conforming[(compiled.shapes[EX.a], False)] == {EX.a1}
+    # ex:b, shared by ex:a and ex:c
+    assert {EX.b1, EX.b2} in conforming.values()
+    assert conforming[(compiled.shapes[EX.c], False)] == {EX.b2}
+    assert not conformance.spilled
+    assert conformance.inlined == len([nodes for nodes in conforming.values() if nodes])
+
+
+def test_spill_blank_nodes():
+    dataset = _dataset(TARGETED_DATA + '[] a ex:A ; ex:p ex:b1, ex:b2 .\n')
+    conformance = pipeline.EvaluatedConformance(dataset)
+    compiled = _compiled()
+    queries = pipeline.fragment_queries(compiled, conformance)
+    a = conformance.conforming[(compiled.shapes[EX.a], False)]
+    assert len(a) == 2 and EX.a1 in a and any(type(node) == BNode for node in a)
+    assert conformance.spilled
+    for query in queries.values():
+        assert '_:' not in str(query)
+    conformance.cleanup()
+    assert not conformance.spilled
+    assert {graph.identifier for graph in dataset.graphs()} == {dataset.default_graph.identifier}
@@ -0,0 +1,652 @@
+import re
+from enum import Enum, auto
+from threading import Lock
+from typing import Dict, FrozenSet, List, Optional
+from weakref import WeakValueDictionary
+
+import trampoline
+from emit import Rope, template
+from rewrite import RuleSet
+
+'''
+Relational plans of queries
+
+The translations (unaryquery.py and sfquery.py) build the plan of a query
+instead of its text. A plan is a tree of relational operators:
+
+    SCAN     [subject, path, object]      a triple pattern, the path can be a property path
+    NODES    [var, construct]             the nodes of the graph (subjects and objects),
+                                          construct is what needed them, see universe
+    PATTERN  [text]                       any other group graph pattern, as SPARQL text
+    JOIN     [plan, ...]
+    UNION    [plan, ...]
+    MINUS    [plan, plan]
+    FILTER   [condition, plan]
+    GROUP    [var, having, plan]          SELECT var ... GROUP BY var HAVING (having)
+    PROJECT  [projection, distinct, comment, plan]
+
+so the query can still be rewritten after the translation. SIMPLIFY removes
+the projections that do not hide a variable (the SELECT ?v WHERE { ... }
+around every subquery), flattens joins, merges filters, pushes
+them into subqueries and drops the joins with the nodes of the graph that
+only restrict ?v to nodes of the graph. A negation joined with a plan that
+binds ?v becomes an anti-join of that plan: the nodes of the graph are only
+scanned for the negations without such a context. to_sparql prints a plan
+as a query.
+
+The rewrites keep the set of results of a query, not the number of times a
+result occurs. The translations count with COUNT(DISTINCT ...).
+
+Like SANode, plans are immutable and hash-consed. A plan knows the variables
+it binds and the variables it always binds to a node of the graph.
+'''
+
+
+class Rel(Enum):
+    SCAN = auto()
+    NODES = auto()
+    PATTERN = auto()
+    JOIN = auto()
+    UNION = auto()
+    MINUS = auto()
+    FILTER = auto()
+    GROUP = auto()
+    PROJECT = auto()
+
+
+_VARIABLE = re.compile(r'[?$]\w+')
+_RENAME = re.compile(r'\(([?$]\w+) AS ([?$]\w+)\)')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+# helper variables of NODES
+_NODES_VARIABLES = frozenset(['?_a', '?_b', '?_c', '?_d'])
+# a condition that is always false, rdflib evaluates FILTER (false) as true
+FALSE = '(1 = 0)'
+# the value of the empty plan, filtered out
+NOTHING = 'urn:ssf:nothing'
+
+
+class Plan:
+    """Ordered tree of relational operators, see Rel"""
+    __slots__ = ('op', 'children', 'variables', 'nodes', 'mentioned', 'hidden', '_hash', '__weakref__')
+
+    _interned = WeakValueDictionary()
+    _intern_lock = Lock()
+
+    def __new__(cls, op: Rel, children: List):
+        # the projections are tuples already
+        children = tuple(children)
+        key = (op, children)
+        plan = cls._interned.get(key)
+        if plan is not None:
+            return plan
+
+        plan = object.__new__(cls)
+        object.__setattr__(plan, 'op', op)
+        object.__setattr__(plan, 'children', children)
+        variables, nodes = _scope(op, children)
+        object.__setattr__(plan, 'variables', variables)  # the variables in scope
+        object.__setattr__(plan, 'nodes', nodes)  # the variables bound to nodes of the graph
+        object.__setattr__(plan, 'mentioned', _mentioned(op, children))  # all the variables in the text
+        # the variables of its subqueries out of its scope, see isolate_subqueries
+        object.__setattr__(plan, 'hidden', _hidden(op, children, variables))
+        object.__setattr__(plan, '_hash', hash((cls, op, children)))
+        with cls._intern_lock:
+            return cls._interned.setdefault(key, plan)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return type(self), (self.op, self.children)
+
+    def __repr__(self):
+        return f'Plan({self.op.name}, {list(self.children)!r})'
+
+
+def _mentioned(op: Rel, children: tuple) -> FrozenSet[str]:
+    if op == Rel.NODES:
+        return _NODES_VARIABLES | {children[0]}
+    mentioned = set()
+    if op == Rel.PROJECT:
+        # not the comment
+        children = children[:2] + children[3:]
+    for child in children:
+        if type(child) == Plan:
+            mentioned |= child.mentioned
+        elif type(child) == tuple:
+            mentioned.update(*(_VARIABLE.findall(item) for item in child))
+        elif type(child) == str:
+            mentioned.update(_VARIABLE.findall(child))
+    return frozenset(mentioned)
+
+
+def _hidden(op: Rel, children: tuple, variables: FrozenSet[str]) -> FrozenSet[str]:
+    if op == Rel.PROJECT:
+        projection, distinct, comment, child = children
+        # a DISTINCT subquery is evaluated on its own
+        if distinct:
+            return frozenset()
+        # and (?x AS ?y) binds ?y over the one of the row
+        bound = frozenset(_VARIABLE.findall(item)[-1] for item in projection
+                          if item != '*' and not _VARIABLE.fullmatch(item))
+        return child.hidden | (child.variables - variables) | bound
+    if op == Rel.GROUP:
+        child = children[2]
+        return child.hidden | (child.variables - variables)
+    if op == Rel.MINUS:
+        plan, subtrahend = children
+        return plan.hidden | subtrahend.hidden | (subtrahend.variables - plan.variables)
+    if op == Rel.FILTER:
+        condition, child = children
+        return child.hidden | (frozenset(_VARIABLE.findall(condition)) - child.variables)
+    if op in (Rel.JOIN, Rel.UNION):
+        return frozenset().union(*(child.hidden for child in children))
+    return frozenset()
+
+
+def _scope(op: Rel, children: tuple):
+    # the variables and node variables of a plan, from those of its children
+    if op == Rel.SCAN:
+        subject, path, obj = children
+        return (frozenset(_VARIABLE.findall(f'{subject} {path} {obj}')),
+                frozenset(term for term in (subject, obj) if _VARIABLE.fullmatch(term)))
+    if op == Rel.NODES:
+        return _NODES_VARIABLES | {children[0]}, frozenset(children[:1])
+    if op == Rel.PATTERN:
+        # all the variables in the text, also the ones out of scope
+        return frozenset(_VARIABLE.findall(children[0])), frozenset()
+    if op == Rel.JOIN:
+        return (frozenset().union(*(child.variables for child in children)),
+                frozenset().union(*(child.nodes for child in children)))
+    if op == Rel.UNION:
+        return (frozenset().union(*(child.variables for child in children)),
+                frozenset.intersection(*(child.nodes for child in children)) if children
+                else frozenset())
+    if op == Rel.MINUS:
+        return children[0].variables, children[0].nodes
+    if op == Rel.FILTER:
+        return children[1].variables, children[1].nodes
+    if op == Rel.GROUP:
+        var, having, child = children
+        return frozenset([var]), frozenset([var]) & child.nodes
+    if op == Rel.PROJECT:
+        projection, distinct, comment, child = children
+        variables = set()
+        nodes = set()
+        for item in projection:
+            if item == '*':
+                variables |= child.variables
+                nodes |= child.nodes
+                continue
+            variables.add(_VARIABLE.findall(item)[-1])
+            # ?x or (?y AS ?x)
+            rename = _RENAME.fullmatch(item)
+            if item in child.nodes:
+                nodes.add(item)
+            elif rename and rename.group(1) in child.nodes:
+                nodes.add(rename.group(2))
+        return frozenset(variables), frozenset(nodes)
+    raise ValueError(f'Unknown operator {op}')
+
+
+def scan(subject: str, path: str, obj: str) -> Plan:
+    return Plan(Rel.SCAN, [subject, path, obj])
+
+
+def nodes(var: str = '?v', construct: str = '') -> Plan:
+    """construct names what needs the nodes of the graph, for universe"""
+    return Plan(Rel.NODES, [var, construct])
+
+
+def pattern(text: str) -> Plan:
+    return Plan(Rel.PATTERN, [text])
+
+
+def join(*plans: Plan) -> Plan:
+    return Plan(Rel.JOIN, list(plans))
+
+
+def union(*plans: Plan) -> Plan:
+    return Plan(Rel.UNION, list(plans))
+
+
+def minus(plan: Plan, subtrahend: Plan) -> Plan:
+    return Plan(Rel.MINUS, [plan, subtrahend])
+
+
+def filtered(condition: str, plan: Plan) -> Plan:
+    """condition is a bracketed expression or a function call, like NOT EXISTS { ... }"""
+    return Plan(Rel.FILTER, [condition, plan])
+
+
+def group(var: str, having: str, plan: Plan) -> Plan:
+    return Plan(Rel.GROUP, [var, having, plan])
+
+
+def project(plan: Plan, *projection: str, distinct=False, comment='') -> Plan:
+    """projection holds variables, (expression AS ?var) and *"""
+    return Plan(Rel.PROJECT, [projection, distinct, comment, plan])
+
+
+def empty(*variables: str) -> Plan:
+    """SELECT variables without rows"""
+    # not WHERE { }, one row without bindings that joins with every row;
+    # rdflib does not accept an empty VALUES block, and joins a FILTER
+    # without a pattern as if it had one row
+    return project(filtered(FALSE, pattern(f'VALUES {variables[0]} {{ <{NOTHING}> }}')), *variables)
+
+
+def _plain(projection) -> Optional[FrozenSet[str]]:
+    # the variables of a projection without expressions, or None
+    if all(_VARIABLE.fullmatch(item) for item in projection):
+        return frozenset(projection)
+    return None
+
+
+SIMPLIFY = RuleSet('plan')
+
+
+@SIMPLIFY.rule(Rel.JOIN, Rel.UNION, Rel.MINUS, Rel.FILTER)
+def inline_subqueries(plan: Plan) -> Plan:
+    # { SELECT ?v WHERE { x } } is x in a group, when the other variables of x
+    # do not occur in the rest of the group, also not in its subqueries: rdflib
+    # evaluates the right operand of a join with the bindings of the left one
+    children = list(plan.children)
+    for i, child in enumerate(children):
+        if type(child) != Plan or child.op != Rel.PROJECT:
+            continue
+        projection, distinct, comment, subplan = child.children
+        plain = _plain(projection)
+        if distinct or plain is None:
+            continue
+        hidden = subplan.variables - plain
+        if hidden and any(hidden & _mentioned_in(other)
+                          for j, other in enumerate(children) if j != i):
+            continue
+        children[i] = subplan
+    return Plan(plan.op, children)
+
+
+def _mentioned_in(child) -> FrozenSet[str]:
+    # the variables in the text of a plan or of a condition
+    return child.mentioned if type(child) == Plan else frozenset(_VARIABLE.findall(child))
+
+
+@SIMPLIFY.rule(Rel.JOIN, Rel.UNION)
+def remove_single_operand(plan: Plan) -> Plan:
+    if len(plan.children) == 1:
+        return plan.children[0]
+    return plan
+
+
+@SIMPLIFY.rule(Rel.JOIN, Rel.UNION, Rel.MINUS)
+def remove_empty(plan: Plan) -> Plan:
+    # a join with an operand without rows has no rows, a union and a minus
+    # ignore it
+    if plan.op == Rel.MINUS:
+        child, subtrahend = plan.children
+        return child if _empty(subtrahend) else plan
+    rest = [child for child in plan.children if not _empty(child)]
+    if len(rest) == len(plan.children):
+        return plan
+    if plan.op == Rel.UNION and rest:
+        return union(*rest)
+    # ?v first, the variable of the VALUES block
+    return empty(*sorted(plan.variables or {'?v'}, key=lambda var: (var != '?v', var)))
+
+
+def _empty(plan: Plan) -> bool:
+    if plan.op == Rel.PROJECT:
+        return _empty(plan.children[3])
+    if plan.op == Rel.GROUP:
+        # GROUP BY ?v has no groups without rows
+        return _empty(plan.children[2])
+    return plan.op == Rel.FILTER and plan.children[0] == FALSE
+
+
+@SIMPLIFY.rule(Rel.JOIN)
+def flatten_joins(plan: Plan) -> Plan:
+    # unions are not flattened, a chain of nested disjunctions would be
+    # rebuilt at every level
+    children = []
+    for child in plan.children:
+        if child.op == plan.op:
+            children.extend(child.children)
+        else:
+            children.append(child)
+    return Plan(plan.op, children)
+
+
+@SIMPLIFY.rule(Rel.PROJECT)
+def merge_projections(plan: Plan) -> Plan:
+    projection, distinct, comment, child = plan.children
+    if child.op == Rel.GROUP and tuple(projection) == child.children[:1] and not distinct:
+        return child
+    if child.op != Rel.PROJECT or '*' in projection:
+        return plan
+    inner, inner_distinct, inner_comment, subplan = child.children
+    plain = _plain(inner)
+    if inner_distinct or plain is None:
+        return plan
+    # the variables used by the expressions, and the variables they are bound to
+    used = frozenset(_VARIABLE.findall(' '.join(item.split(' AS ')[0] for item in projection)))
+    bound = frozenset(_VARIABLE.findall(item)[-1] for item in projection if ' AS ' in item)
+    if not used <= plain or bound & subplan.variables:
+        return plan
+    return project(subplan, *projection, distinct=distinct, comment=comment or inner_comment)
+
+
+@SIMPLIFY.rule(Rel.FILTER)
+def merge_filters(plan: Plan) -> Plan:
+    condition, child = plan.children
+    if child.op == Rel.FILTER:
+        return filtered(f'({child.children[0]} && {condition})', child.children[1])
+    return plan
+
+
+@SIMPLIFY.rule(Rel.FILTER)
+def push_filter_into_join(plan: Plan) -> Plan:
+    # a filter of a join on ?v is a filter of the subquery of the join binding ?v
+    condition, child = plan.children
+    if child.op != Rel.JOIN:
+        return plan
+    used = frozenset(_VARIABLE.findall(condition))
+    if 'EXISTS' in condition or len(used) != 1:
+        return plan
+    children = list(child.children)
+    for i, subquery in enumerate(children):
+        if subquery.op == Rel.PROJECT and not subquery.children[1] and \
+                used <= subquery.nodes and used <= (_plain(subquery.children[0]) or frozenset()):
+            projection, distinct, comment, subplan = subquery.children
+            children[i] = project(filtered(condition, subplan), *projection, comment=comment)
+            return join(*children)
+    return plan
+
+
+def _restriction(plan: Plan):
+    # (var, condition or None, construct) when plan is NODES(var), filtered or projected to var
+    projection = None
+    if plan.op == Rel.PROJECT:
+        projection, distinct, comment, plan = plan.children
+        if distinct:
+            return None
+    condition = None
+    if plan.op == Rel.FILTER:
+        condition, plan = plan.children
+    if plan.op != Rel.NODES or projection not in (None, plan.children[:1]):
+        return None
+    return plan.children[0], condition, plan.children[1]
+
+
+@SIMPLIFY.rule(Rel.JOIN)
+def remove_nodes_from_join(plan: Plan) -> Plan:
+    # the nodes of the graph, joined with a plan binding ?v to nodes of the graph
+    for i, child in enumerate(plan.children):
+        restriction = _restriction(child)
+        if restriction is None:
+            continue
+        var, condition, construct = restriction
+        others = plan.children[:i] + plan.children[i + 1:]
+        if any(var in other.nodes for other in others):
+            rest = join(*others)
+            return rest if condition is None else filtered(condition, rest)
+    return plan
+
+
+def _negation(plan: Plan):
+    # (var, condition or None, construct, subtrahends) when plan is the nodes of the graph,
+    # restricted as in _restriction, minus the subtrahends
+    subtrahends = []
+    projection = None
+    if plan.op == Rel.PROJECT and not plan.children[1]:
+        projection, plan = plan.children[0], plan.children[3]
+    while plan.op == Rel.MINUS:
+        plan, subtrahend = plan.children
+        subtrahends.append(subtrahend)
+    restriction = _restriction(plan)
+    if not subtrahends or restriction is None or projection not in (None, restriction[:1]):
+        return None
+    return restriction + (subtrahends[::-1],)
+
+
+@SIMPLIFY.rule(Rel.JOIN)
+def anti_join(plan: Plan) -> Plan:
+    # the nodes of the graph minus x, joined with a plan binding ?v to nodes
+    # of the graph, is that plan minus x
+    for i, child in enumerate(plan.children):
+        negation = _negation(child)
+        if negation is None:
+            continue
+        var, condition, construct, subtrahends = negation
+        others = plan.children[:i] + plan.children[i + 1:]
+        if not any(var in other.nodes for other in others):
+            continue
+        rest = join(*others)
+        if condition is not None:
+            rest = filtered(condition, rest)
+        for subtrahend in subtrahends:
+            # minus compares all the variables the operands have in common, and
+            # the subqueries of rest can still be inlined
+            if not subtrahend.variables & rest.mentioned <= {var}:
+                subtrahend = project(subtrahend, var)
+            rest = minus(rest, subtrahend)
+        return rest
+    return plan
+
+
+@SIMPLIFY.rule(Rel.JOIN)
+def isolate_subqueries(plan: Plan) -> Plan:
+    # rdflib evaluates the right operand of a join without other joins once
+    # per row of the left operand, with its bindings, also in the subqueries
+    # that hide or bind those variables: { SELECT (?v AS ?o) ... } after
+    # ?v p ?o would only see the ?v of the row, and keep the ?o of the row
+    # for any ?v. An operand with subqueries hiding or binding a variable of
+    # the rest of the join is made DISTINCT, rdflib evaluates it on its own
+    for i, child in enumerate(plan.children):
+        others = plan.children[:i] + plan.children[i + 1:]
+        if child.hidden & frozenset().union(*(other.variables for other in others)):
+            return join(*others[:i], _isolated(child), *others[i:])
+    return plan
+
+
+def _isolated(plan: Plan) -> Plan:
+    if plan.op == Rel.PROJECT:
+        projection, distinct, comment, child = plan.children
+        return project(child, *projection, distinct=True, comment=comment)
+    if plan.op == Rel.GROUP:
+        return project(plan, plan.children[0], distinct=True)
+    return project(plan, '*', distinct=True)
+
+
+@SIMPLIFY.rule(Rel.MINUS)
+def minus_restriction(plan: Plan) -> Plan:
+    # a plan binding ?v to nodes minus the nodes of the graph that pass a
+    # test is that plan filtered by the negated test, a test with an error
+    # keeps the row like MINUS does
+    child, subtrahend = plan.children
+    negation = _negation(subtrahend)
+    if negation is not None and negation[0] in child.nodes and negation[1] is None \
+            and len(negation[3]) == 1:
+        # minus a negation is a join
+        return join(child, project(negation[3][0], negation[0]))
+    restriction = _restriction(subtrahend)
+    if restriction is None or restriction[0] not in child.nodes:
+        return plan
+    var, condition, construct = restriction
+    if condition is None:
+        return filtered(FALSE, child)
+    if not frozenset(_VARIABLE.findall(condition)) <= {var} or 'EXISTS' in condition:
+        return plan
+    return filtered(f'(!COALESCE({condition}, false))', child)
+
+
+@SIMPLIFY.rule(Rel.PROJECT)
+def rename_negation(plan: Plan) -> Plan:
+    # (?v AS ?o) of the nodes of the graph minus x is the nodes of the graph
+    # as ?o minus x as ?o, which anti_join can bind to the ?o of a join
+    projection, distinct, comment, child = plan.children
+    rename = _RENAME.fullmatch(projection[0]) if len(projection) == 1 else None
+    if distinct or rename is None:
+        return plan
+    var, renamed = rename.groups()
+    if child.op == Rel.JOIN:
+        # the renamed restriction of a join, apart from the rest of the join
+        for i, restriction in enumerate(child.children):
+            others = child.children[:i] + child.children[i + 1:]
+            if (_restriction(restriction) or _negation(restriction) or (None,))[0] == var and \
+                    not any(other.mentioned & _NODES_VARIABLES for other in others):
+                return join(project(restriction, projection[0]),
+                            project(join(*others), projection[0], comment=comment))
+        return plan
+    negation = _negation(child)
+    if negation is None:
+        restriction = _restriction(child)
+        if restriction is None:
+            return plan
+        negation = restriction + ([],)
+    restricted_var, condition, construct, subtrahends = negation
+    if restricted_var != var or condition is not None and renamed in _VARIABLE.findall(condition):
+        return plan
+    # minus compares ?v, not the helper variables of NODES
+    if any(subtrahend.variables & _NODES_VARIABLES for subtrahend in subtrahends):
+        return plan
+    result = nodes(renamed, construct)
+    if condition is not None:
+        result = filtered(_renamed(condition, var, renamed), result)
+    result = project(result, renamed, comment=comment)
+    for subtrahend in subtrahends:
+        result = minus(result, project(subtrahend, projection[0]))
+    return result
+
+
+def _renamed(condition: str, var: str, renamed: str) -> str:
+    # condition with var renamed, not in string literals
+    parts = []
+    start = 0
+    for string in _STRING.finditer(condition):
+        parts += [re.sub(re.escape(var) + r'\b', renamed, condition[start:string.start()]), string.group()]
+        start = string.end()
+    parts.append(re.sub(re.escape(var) + r'\b', renamed, condition[start:]))
+    return ''.join(parts)
+
+
+def is_restriction(plan: Plan) -> bool:
+    """
+    Whether plan is the nodes of the graph, filtered or minus other plans. A
+    join with a plan that binds its variable to nodes filters that plan
+    instead, see remove_nodes_from_join and anti_join.
+    """
+    return _restriction(plan) is not None or _negation(plan) is not None
+
+
+def universe(plan: Plan) -> FrozenSet[str]:
+    """The constructs of the NODES left in plan, the ones that scan all the nodes of the graph"""
+    constructs = set()
+    seen = set()
+    todo = [plan]
+    while todo:
+        plan = todo.pop()
+        if plan in seen:
+            continue
+        seen.add(plan)
+        if plan.op == Rel.NODES:
+            constructs.add(plan.children[1])
+        todo += [child for child in plan.children if type(child) == Plan]
+    return frozenset(constructs)
+
+
+def simplify(plan: Plan, memo: Optional[Dict] = None) -> Plan:
+    """plan rewritten with SIMPLIFY, memo as in RuleSet.rewrite"""
+    return SIMPLIFY.rewrite(plan, memo)
+
+
+def to_sparql(plan: Plan, memo: Optional[Dict] = None) -> Rope:
+    """
+    The SPARQL query of plan. memo maps plans to their text, pass the same
+    dict to share the text of common subplans between queries.
+    """
+    if memo is None:
+        memo = {}
+    return trampoline.run(_query(plan, memo))
+
+
+def _query(plan: Plan, memo: Dict):
+    # generator, see trampoline.run
+    key = ('query', plan)
+    if key in memo:
+        return memo[key]
+
+    if plan.op == Rel.PROJECT:
+        projection, distinct, comment, child = plan.children
+        rope = template('{comment}SELECT {distinct}{projection} WHERE {{ {group} }}',
+                        comment=f'# {comment}\n' if comment else '',
+                        distinct='DISTINCT ' if distinct else '',
+                        projection=' '.join(projection), group=(yield _group(child, memo)))
+    elif plan.op == Rel.GROUP:
+        var, having, child = plan.children
+        rope = template('SELECT {var} WHERE {{ {group} }} GROUP BY {var} HAVING ({having})',
+                        var=var, having=having, group=(yield _group(child, memo)))
+    else:
+        rope = template('SELECT * WHERE {{ {group} }}', group=(yield _group(plan, memo)))
+    memo[key] = rope
+    return rope
+
+
+def _group(plan: Plan, memo: Dict):
+    # generator, the text of plan in a group graph pattern
+    key = ('group', plan)
+    if key in memo:
+        return memo[key]
+
+    if plan.op == Rel.SCAN:
+        rope = Rope([' '.join(plan.children)])
+    elif plan.op == Rel.NODES:
+        var = plan.children[0]
+        rope = Rope([f'{{ {var} ?_a ?_b }} UNION {{ ?_c ?_d {var} }}'])
+    elif plan.op == Rel.PATTERN:
+        rope = Rope([plan.children[0]])
+    elif plan.op == Rel.JOIN:
+        parts = []
+        for child in plan.children:
+            parts += [(yield _element(child, memo)), ' . ']
+        rope = Rope(parts[:-1])
+    elif plan.op == Rel.UNION:
+        parts = []
+        for child in plan.children:
+            parts += [(yield _braced(child, memo)), ' UNION ']
+        rope = Rope(parts[:-1])
+    elif plan.op == Rel.MINUS:
+        rope = template('{plan} MINUS {subtrahend}', plan=(yield _element(plan.children[0], memo)),
+                        subtrahend=(yield _braced(plan.children[1], memo)))
+    elif plan.op == Rel.FILTER:
+        condition, child = plan.children
+        rope = template('{group} FILTER {condition}', group=(yield _group(child, memo)),
+                        condition=condition)
+    else:
+        # a subquery
+        rope = template('{{ {query} }}', query=(yield _query(plan, memo)))
+    memo[key] = rope
+    return rope
+
+
+def _braced(plan: Plan, memo: Dict):
+    # generator, plan as a group graph pattern { ... }
+    if plan.op in (Rel.PROJECT, Rel.GROUP):
+        return (yield _group(plan, memo))
+    key = ('braced', plan)
+    if key not in memo:
+        memo[key] = template('{{ {group} }}', group=(yield _group(plan, memo)))
+    return memo[key]
+
+
+def _element(plan: Plan, memo: Dict):
+    # generator, plan as an element of a group, triple patterns are not braced
+    if plan.op == Rel.SCAN:
+        return (yield _group(plan, memo))
+    return (yield _braced(plan, memo))
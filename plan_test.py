@@ -0,0 +1,173 @@
+from rdflib import Graph, Literal, Namespace
+from rdflib.namespace import SH
+
+import plan
+from emit import Rope
+from algebra import SANode, Op
+from pathalg import PANode, POp
+from unaryquery import to_uq, to_uq_plan
+
+EX = Namespace('http://ex.tt/')
+
+P = plan.scan('?v', '<http://ex.tt/p>', '?o')
+Q = plan.scan('?v', '<http://ex.tt/q>', '?x')
+
+
+def test_scope():
+    assert P.variables == {'?v', '?o'} and P.nodes == {'?v', '?o'}
+    renamed = plan.project(P, '(?v AS ?t)', '?o')
+    assert renamed.variables == {'?t', '?o'} and renamed.nodes == {'?t', '?o'}
+    value = plan.pattern('BIND ( <http://ex.tt/a> AS ?v )')
+    assert value.variables == {'?v'} and not value.nodes
+    assert plan.union(P, value).nodes == frozenset()
+    assert plan.join(P, value).nodes == {'?v', '?o'}
+    assert plan.minus(plan.nodes(), P).variables == plan.nodes().variables
+
+
+def test_inline_subqueries():
+    joined = plan.simplify(plan.project(plan.join(plan.project(P, '?v'), plan.project(Q, '?v')), '?v'))
+    assert joined == plan.project(plan.join(P, Q), '?v')
+    assert str(plan.to_sparql(joined)) == \
+        'SELECT ?v WHERE { ?v <http://ex.tt/p> ?o . ?v <http://ex.tt/q> ?x }'
+
+    # the second ?o is another variable, also for rdflib
+    clash = plan.join(plan.project(P, '?v'), plan.project(plan.scan('?v', '<http://ex.tt/q>', '?o'), '?v'))
+    assert plan.simplify(plan.project(clash, '?v')) == plan.project(clash, '?v')
+
+    distinct = plan.project(P, '?v', distinct=True)
+    assert plan.simplify(plan.union(distinct, Q)) == plan.union(distinct, Q)
+
+
+def test_merge_projections():
+    inner = plan.project(plan.pattern('BIND ( <http://ex.tt/a> AS ?v )'), '?v')
+    assert plan.simplify(plan.project(inner, '(?v AS ?o)')) == \
+        plan.project(plan.pattern('BIND ( <http://ex.tt/a> AS ?v )'), '(?v AS ?o)')
+    # ?o is bound by P
+    renamed = plan.project(plan.project(P, '?v'), '(?v AS ?o)')
+    assert plan.simplify(renamed) == renamed
+
+    counted = plan.group('?v', 'COUNT(DISTINCT ?o) > 1', P)
+    assert plan.simplify(plan.project(counted, '?v')) == counted
+
+
+def test_remove_nodes_from_join():
+    test = plan.project(plan.filtered('(isIRI(?v))', plan.nodes('?v')), '?v')
+    query = plan.project(plan.join(plan.project(P, '?v'), test), '?v')
+    assert plan.simplify(query) == plan.project(plan.filtered('(isIRI(?v))', P), '?v')
+
+    # BIND does not restrict ?v to the nodes of the graph
+    value = plan.project(plan.pattern('BIND ( <http://ex.tt/a> AS ?v )'), '?v')
+    query = plan.project(plan.join(value, test), '?v')
+    assert plan.nodes('?v') in _plans(plan.simplify(query))
+
+
+def _plans(query):
+    found = []
+    todo = [query]
+    while todo:
+        query = todo.pop()
+        found.append(query)
+        todo += [child for child in query.children if type(child) == plan.Plan]
+    return found
+
+
+def test_conformance_query():
+    path = PANode(POp.PROP, [EX.p])
+    shape = SANode(Op.AND, [SANode(Op.GEQ, [Literal(2), path, SANode(Op.TOP, [])]),
+                            SANode(Op.TEST, ['nodekind', SH.IRI]),
+                            SANode(Op.TEST, ['datatype', EX.d])])
+    query = to_uq_plan(shape)
+    # the test filters the counted nodes, not the nodes of the graph
+    assert plan.nodes('?v') not in _plans(query)
+    assert to_uq(shape).count('SELECT') == 2
+
+    data = Graph()
+    data.parse(data='''
+        @prefix ex: <http://ex.tt/> .
+        ex:a ex:p ex:b, ex:c .
+        ex:b ex:p ex:c .
+        ex:c ex:q ex:a, ex:b .
+    ''', format='ttl')
+    assert {row.v for row in data.query(to_uq(shape))} == set()
+    shape = SANode(Op.AND, [SANode(Op.GEQ, [Literal(2), path, SANode(Op.TOP, [])]),
+                            SANode(Op.TEST, ['nodekind', SH.IRI]),
+                            SANode(Op.NOT, [SANode(Op.HASVALUE, [EX.b])])])
+    assert {row.v for row in data.query(to_uq(shape))} == {EX.a}
+
+
+def test_shared_text():
+    shared = plan.project(P, '?v')
+    memo = {}
+    first = plan.to_sparql(plan.project(plan.minus(plan.nodes(), shared), '?v'), memo)
+    second = plan.to_sparql(plan.project(plan.union(shared, Q), '?v'), memo)
+    assert id(plan.to_sparql(shared, memo)) in _ropes(first) & _ropes(second)
+
+
+def _ropes(rope):
+    found = set()
+    todo = [rope]
+    while todo:
+        rope = todo.pop()
+        found.add(id(rope))
+        todo += [part for part in rope.parts if isinstance(part, Rope)]
+    return found
+
+
+def test_anti_join():
+    negation = plan.project(plan.minus(plan.nodes('?v', 'NOT'), plan.project(Q, '?v')), '?v')
+    query = plan.simplify(plan.project(plan.join(plan.project(P, '?v'), negation), '?v'))
+    assert not plan.universe(query)
+    assert str(plan.to_sparql(query)) == \
+        'SELECT ?v WHERE { ?v <http://ex.tt/p> ?o MINUS { ?v <http://ex.tt/q> ?x } }'
+
+    # the values of a path are bound, the tested ones are removed
+    test = plan.project(plan.filtered('(isIRI(?v))', plan.nodes('?v', 'TEST')), '?v')
+    renamed = plan.project(plan.minus(plan.nodes('?v', 'FORALL'), test), '(?v AS ?o)')
+    query = plan.simplify(plan.project(plan.join(P, renamed), '?v'))
+    assert query == plan.project(plan.filtered('(!COALESCE((isIRI(?o)), false))', P), '?v')
+
+    # without a context the nodes of the graph are scanned
+    assert plan.universe(plan.simplify(negation)) == {'NOT'}
+    assert plan.universe(plan.simplify(plan.union(plan.project(P, '?v'), negation))) == {'NOT'}
+
+
+def test_remove_empty():
+    nothing = plan.empty('?v')
+    assert str(plan.to_sparql(nothing)) == 'SELECT ?v WHERE { VALUES ?v { <urn:ssf:nothing> } FILTER (1 = 0) }'
+    assert plan.simplify(plan.join(P, nothing)) == plan.empty('?v', '?o')
+    assert plan.simplify(plan.project(plan.union(plan.project(P, '?v'), nothing), '?v')) == plan.project(P, '?v')
+    counted = plan.group('?v', 'COUNT(DISTINCT ?o) > 1', plan.join(P, nothing))
+    assert plan.simplify(plan.minus(Q, counted)) == Q
+
+
+def test_isolate_subqueries():
+    # rdflib would evaluate the renaming subquery with the ?o of P
+    renamed = plan.project(plan.project(Q, '?v'), '(?v AS ?o)')
+    query = plan.simplify(plan.join(P, renamed))
+    assert query == plan.join(P, plan.project(Q, '(?v AS ?o)', distinct=True))
+    # and the subquery hiding ?x with the ?x of the scan
+    hiding = plan.project(Q, '?v')
+    other = plan.scan('?x', '<http://ex.tt/r>', '?v')
+    assert plan.simplify(plan.join(other, hiding)) == plan.join(other, plan.project(Q, '?v', distinct=True))
+
+
+def test_negation_conformance():
+    data = Graph()
+    data.parse(data='''
+        @prefix ex: <http://ex.tt/> .
+        ex:a ex:p ex:b ; ex:q ex:c .
+        ex:b ex:p ex:c ; ex:q "c" .
+        ex:c ex:p "d" .
+    ''', format='ttl')
+    p = PANode(POp.PROP, [EX.p])
+    q = PANode(POp.PROP, [EX.q])
+    with_p = SANode(Op.GEQ, [Literal(1), p, SANode(Op.TOP, [])])
+    shapes = {
+        SANode(Op.AND, [with_p, SANode(Op.NOT, [SANode(Op.HASVALUE, [EX.a])])]): {EX.b, EX.c},
+        SANode(Op.AND, [with_p, SANode(Op.FORALL, [q, SANode(Op.NOT, [SANode(Op.HASVALUE, [EX.c])])])]):
+            {EX.b, EX.c},
+        SANode(Op.AND, [with_p, SANode(Op.FORALL, [p, with_p])]): {EX.a, EX.b},
+    }
+    for shape, expected in shapes.items():
+        assert not plan.universe(to_uq_plan(shape))
+        assert {row.v for row in data.query(to_uq(shape))} == expected
@@ -0,0 +1,78 @@
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+import trampoline
+
+'''
+Rule based rewriting of shape algebra trees
+
+A RuleSet holds rewrite rules, registered per operator with the rule
+decorator. A rule receives a node whose children have already been
+rewritten and returns
+  - the node itself when it does not apply,
+  - a replacement node, or
+  - None to remove the node from its parent (like optimize_tree did).
+
+RuleSet.rewrite applies the rules in one bottom-up traversal: every node is
+rewritten until no rule applies any more. Nodes are hash-consed, so the
+result for a subtree is memoized and shared subtrees are rewritten once.
+'''
+
+
+class RuleSet:
+    def __init__(self, name: str):
+        self.name = name
+        self.rules: Dict = {}  # operator -> rules, in order of registration
+        self.fired = Counter()  # rule name -> number of times it applied
+
+    def rule(self, *ops) -> Callable:
+        """Decorator registering a rule for nodes with one of the operators"""
+        def register(function):
+            for op in ops:
+                self.rules.setdefault(op, []).append(function)
+            self.fired[function.__name__] += 0
+            return function
+        return register
+
+    def rewrite(self, node, memo: Optional[Dict] = None):
+        """
+        Rewrites node to a fixpoint of the rules. memo maps nodes to their
+        rewritten form, pass the same dict to share work between trees.
+        """
+        if memo is None:
+            memo = {}
+        return trampoline.run(self._rewrite(node, memo))
+
+    def report(self) -> List[str]:
+        return [f'{self.name}.{rule}: {count}'
+                for rule, count in self.fired.items()]
+
+    def _rewrite(self, node, memo: Dict):
+        # generator, see trampoline.run
+        if node in memo:
+            return memo[node]
+
+        node_type = type(node)
+        children = []
+        for child in node.children:
+            if type(child) == node_type:
+                child = yield self._rewrite(child, memo)
+                if child is None:  # the child is removed
+                    continue
+            children.append(child)
+        result = node_type(node.op, children)
+
+        for rule in self.rules.get(result.op, ()):
+            replacement = rule(result)
+            if replacement is not result:
+                self.fired[rule.__name__] += 1
+                if replacement is not None:
+                    # the replacement can have children that are not rewritten yet
+                    replacement = yield self._rewrite(replacement, memo)
+                result = replacement
+                break
+
+        memo[node] = result
+        if result is not None:
+            memo[result] = result  # a rewritten node is a fixpoint
+        return result
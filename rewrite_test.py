@@ -0,0 +1,62 @@
+from rdflib import Namespace, Literal
+
+from algebra import Op, SANode, optimize_tree, OPTIMIZE
+from pathalg import PANode, POp
+from rewrite import RuleSet
+
+EX = Namespace('http://ex.tt/')
+
+TOP = SANode(Op.TOP, [])
+
+
+def _geq(prop):
+    return SANode(Op.GEQ, [Literal(1), PANode(POp.PROP, [prop]), TOP])
+
+
+def test_rules_to_fixpoint():
+    rules = RuleSet('test')
+
+    @rules.rule(Op.NOT)
+    def double_negation(tree):
+        if tree.children[0].op == Op.NOT:
+            return tree.children[0].children[0]
+        return tree
+
+    @rules.rule(Op.HASVALUE)
+    def remove_value(tree):
+        return None
+
+    tree = SANode(Op.NOT, [SANode(Op.NOT, [SANode(Op.NOT, [SANode(Op.NOT, [
+        SANode(Op.AND, [_geq(EX.p), SANode(Op.HASVALUE, [EX.v])])])])])])
+
+    assert rules.rewrite(tree) is SANode(Op.AND, [_geq(EX.p)])
+    assert rules.fired == {'double_negation': 2, 'remove_value': 1}
+    assert rules.rewrite(SANode(Op.HASVALUE, [EX.v])) is None
+
+
+def test_rewrite_memo():
+    rules = RuleSet('test')
+    seen = []
+
+    @rules.rule(Op.GEQ)
+    def record(tree):
+        seen.append(tree)
+        return tree
+
+    shared = _geq(EX.p)
+    memo = {}
+    rules.rewrite(SANode(Op.AND, [shared, SANode(Op.OR, [shared, _geq(EX.q)])]), memo)
+    rules.rewrite(SANode(Op.NOT, [shared]), memo)
+    assert seen == [shared, _geq(EX.q)]
+
+
+def test_optimize_wide_conjunction():
+    children = []
+    for i in range(200):
+        children.append(SANode(Op.AND, [_geq(EX[f'p{i}']), TOP]))
+        children.append(TOP)
+    optimized = optimize_tree(SANode(Op.AND, children))
+
+    assert optimized is SANode(Op.AND, [_geq(EX[f'p{i}']) for i in range(200)])
+    assert OPTIMIZE.fired['remove_top_from_conjunction'] > 0
+    assert optimize_tree(SANode(Op.OR, [TOP, TOP])) is None
@@ -0,0 +1,256 @@
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, Optional
+from urllib.parse import urlsplit, parse_qs
+
+import algebra
+import compiler
+import ssf
+
+if TYPE_CHECKING:
+    from rdflib import Graph
+
+'''
+Compile server
+
+Keeps shapes graphs, parsed and compiled, in memory and answers the ssf
+commands over HTTP on localhost:
+
+    python server.py [port]
+
+    GET /frag?file=shapes.ttl[&ignore_tests=1]
+    GET /bvg?file=shapes.ttl&shape=ex:Shape
+    GET /parser?file=shapes.ttl&shape=ex:Shape[&options=neo]
+    GET /info?file=shapes.ttl
+    GET /stats
+
+The answers are the outputs of the ssf.py commands, as text/plain. An error
+is answered with status 400 and the message of ssf.py. /stats returns the
+hits and misses of the registry and the latency per command, as JSON.
+
+A shapes graph is loaded again when its file changes (its size or mtime),
+the fragment queries are then compiled incrementally. The registry holds
+the max_size most recently used shapes graphs.
+'''
+
+DEFAULT_PORT = 8321
+
+
+class Schema:
+    """A shapes graph file, parsed and compiled on demand"""
+
+    def __init__(self, filename: str, stamp, previous: Optional['Schema'] = None):
+        self.filename = filename
+        self.stamp = stamp  # the size and mtime of the file when it was loaded
+        self.lock = Lock()
+        self._shapesgraph = None
+        self._schema = None
+        self._compiled = {}  # ignore_tests -> CompiledSchema
+        # the compiled schemas of the previous version of the file
+        self._previous = previous._compiled if previous is not None else {}
+
+    def shapesgraph(self) -> 'Graph':
+        with self.lock:
+            if self._shapesgraph is None:
+                self._shapesgraph = compiler.parse_file(self.filename)
+            return self._shapesgraph
+
+    def schema(self):
+        """The definitions and targets of the shapes graph"""
+        shapesgraph = self.shapesgraph()
+        with self.lock:
+            if self._schema is None:
+                self._schema = algebra.parse(shapesgraph)
+            return self._schema
+
+    def compiled(self, ignore_tests: bool) -> compiler.CompiledSchema:
+        shapesgraph = self.shapesgraph()
+        with self.lock:
+            if ignore_tests not in self._compiled:
+                self._compiled[ignore_tests] = compiler.compile_schema(
+                    shapesgraph, ignore_tests, self._previous.get(ignore_tests))
+            return self._compiled[ignore_tests]
+
+
+class SchemaRegistry:
+    """The most recently used shapes graphs, by file name"""
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._schemas = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, filename: str) -> Schema:
+        """The Schema of a file, raises ValueError when there is no such file"""
+        filename = os.path.abspath(filename)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            raise ValueError(f'Could not find file: {filename}')
+        stamp = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            schema = self._schemas.get(filename)
+            if schema is not None and schema.stamp == stamp:
+                self._schemas.move_to_end(filename)
+                self.hits += 1
+                return schema
+            self.misses += 1
+            schema = Schema(filename, stamp, schema)
+            self._schemas[filename] = schema
+            self._schemas.move_to_end(filename)
+            while len(self._schemas) > self.max_size:
+                self._schemas.popitem(last=False)
+            return schema
+
+    def __len__(self):
+        return len(self._schemas)
+
+
+def _frag(registry: SchemaRegistry, parameters: Dict) -> str:
+    schema = registry.get(_parameter(parameters, 'file'))
+    ignore_tests = parameters.get('ignore_tests', ['0'])[0] not in ('0', 'false', '')
+    return compiler.fragment_query(schema.compiled(ignore_tests))
+
+
+def _bvg(registry: SchemaRegistry, parameters: Dict) -> str:
+    schema = registry.get(_parameter(parameters, 'file'))
+    shapename = ssf.resolve_shapename(schema.shapesgraph().namespace_manager,
+                                      _parameter(parameters, 'shape'))
+    definitions, targets = schema.schema()
+    return ssf.bvg_query(definitions, shapename, schema.filename)
+
+
+def _parser(registry: SchemaRegistry, parameters: Dict) -> str:
+    schema = registry.get(_parameter(parameters, 'file'))
+    shapename = ssf.resolve_shapename(schema.shapesgraph().namespace_manager,
+                                      _parameter(parameters, 'shape'))
+    definitions, targets = schema.schema()
+    options = parameters['options'][0] if 'options' in parameters else None
+    return ssf.parser_output(definitions, shapename, schema.filename, options)
+
+
+def _info(registry: SchemaRegistry, parameters: Dict) -> str:
+    schema = registry.get(_parameter(parameters, 'file'))
+    definitions, targets = schema.schema()
+    return ssf.info_output(schema.shapesgraph(), definitions, targets)
+
+
+COMMANDS = {
+    'frag': _frag,
+    'bvg': _bvg,
+    'parser': _parser,
+    'info': _info,
+}
+
+
+def _parameter(parameters: Dict, name: str) -> str:
+    if name not in parameters:
+        raise ValueError(f'Missing parameter: {name}')
+    return parameters[name][0]
+
+
+class Statistics:
+    """Number of requests, errors and latency per command"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.commands = {command: {'requests': 0, 'errors': 0,
+                                   'total_ms': 0.0, 'max_ms': 0.0}
+                         for command in COMMANDS}
+
+    def record(self, command: str, elapsed: float, error: bool):
+        milliseconds = elapsed * 1000
+        with self._lock:
+            counters = self.commands[command]
+            counters['requests'] += 1
+            counters['errors'] += error
+            counters['total_ms'] += milliseconds
+            counters['max_ms'] = max(counters['max_ms'], milliseconds)
+
+    def report(self, registry: SchemaRegistry) -> Dict:
+        commands = {}
+        with self._lock:
+            for command, counters in self.commands.items():
+                commands[command] = dict(counters)
+                commands[command]['mean_ms'] = counters['total_ms'] / max(counters['requests'], 1)
+        return {'registry': {'hits': registry.hits, 'misses': registry.misses,
+                             'size': len(registry), 'max_size': registry.max_size},
+                'commands': commands}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: 'CompileServer'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        command = url.path.strip('/')
+        parameters = parse_qs(url.query, keep_blank_values=True)
+
+        if command == 'stats':
+            report = self.server.statistics.report(self.server.registry)
+            self._answer(200, json.dumps(report, indent=2), 'application/json')
+            return
+        if command not in COMMANDS:
+            self._answer(404, f'Unknown command: {command}')
+            return
+
+        start = time.perf_counter()
+        try:
+            status, answer = 200, COMMANDS[command](self.server.registry, parameters)
+        except compiler.ShapesFileError as e:
+            status, answer = 400, f'Could not parse file: {parameters["file"][0]}\n{e}'
+        except ValueError as e:  # including algebra.RecursiveShapeError
+            status, answer = 400, str(e)
+        self.server.statistics.record(command, time.perf_counter() - start, status != 200)
+        self._answer(status, answer)
+
+    def _answer(self, status: int, text: str, content_type='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class CompileServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', DEFAULT_PORT), registry=None, verbose=False):
+        super().__init__(address, _Handler)
+        self.registry = registry if registry is not None else SchemaRegistry()
+        self.statistics = Statistics()
+        self.verbose = verbose
+
+
+if __name__ == '__main__':
+    port = DEFAULT_PORT
+    if len(sys.argv) == 2:
+        try:
+            port = int(sys.argv[1])
+        except ValueError:
+            print(f'Not a port number: {sys.argv[1]}')
+            exit(1)
+    elif len(sys.argv) > 2:
+        print(f'{sys.argv[0]} [port]')
+        exit(1)
+
+    server = CompileServer(('127.0.0.1', port), verbose=True)
+    print(f'Serving on http://127.0.0.1:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import pytest
+from rdflib import Graph
+
+import algebra
+import compiler
+import ssf
+from server import CompileServer, SchemaRegistry
+
+SHAPES = './real_shacl_testfiles/tyrol/wineryshape.ttl'
+BASIC = './algebra_testfiles/shape_basic.ttl'
+
+
+@pytest.fixture
+def server():
+    server = CompileServer(('127.0.0.1', 0), SchemaRegistry(max_size=2))
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _get(server, command, **parameters):
+    url = f'http://127.0.0.1:{server.server_address[1]}/{command}?{urlencode(parameters)}'
+    try:
+        with urlopen(url) as response:
+            return response.status, response.read().decode('utf-8')
+    except HTTPError as e:
+        return e.code, e.read().decode('utf-8')
+
+
+def test_commands(server):
+    g = Graph()
+    g.parse(SHAPES, format='ttl')
+    definitions, targets = algebra.parse(g)
+
+    for ignore_tests in [0, 1]:
+        expected = compiler.fragment_query(compiler.compile_schema(g, bool(ignore_tests)))
+        assert _get(server, 'frag', file=SHAPES, ignore_tests=ignore_tests) == (200, expected)
+
+    g = Graph()
+    g.parse(BASIC, format='ttl')
+    definitions, targets = algebra.parse(g)
+    shapename = ssf.resolve_shapename(g.namespace_manager, ':shape')
+    filename = os.path.abspath(BASIC)
+    assert _get(server, 'bvg', file=BASIC, shape=':shape') == \
+        (200, ssf.bvg_query(definitions, shapename, filename))
+    assert _get(server, 'parser', file=BASIC, shape=':shape', options='neo') == \
+        (200, ssf.parser_output(definitions, shapename, filename, 'neo'))
+    assert _get(server, 'info', file=BASIC) == \
+        (200, ssf.info_output(g, definitions, targets))
+
+    stats = json.loads(_get(server, 'stats')[1])
+    assert stats['registry'] == {'hits': 3, 'misses': 2, 'size': 2, 'max_size': 2}
+    assert stats['commands']['frag']['requests'] == 2
+
+
+def test_errors(server):
+    assert _get(server, 'frag', file='missing.ttl')[0] == 400
+    assert _get(server, 'frag')[1] == 'Missing parameter: file'
+    assert _get(server, 'bvg', file=BASIC, shape='nope:shape') == \
+        (400, 'Prefix "nope" not defined in graph')
+    assert _get(server, 'parser', file=BASIC, shape=':shape', options='x') == \
+        (400, 'No valid options found in x')
+    assert _get(server, 'latex', file=SHAPES)[0] == 404
+
+    stats = json.loads(_get(server, 'stats')[1])
+    assert stats['commands']['frag']['errors'] == 2
+
+
+def test_changed_file(server, tmp_path):
+    shapes = str(tmp_path / 'shapes.ttl')
+    shutil.copy(SHAPES, shapes)
+    first = _get(server, 'frag', file=shapes)[1]
+
+    with open(shapes) as f:
+        text = f.read()
+    with open(shapes, 'w') as f:
+        f.write(text.replace('sh:minCount 1', 'sh:minCount 2'))
+    os.utime(shapes, ns=(0, 10 ** 9))  # the mtime may not have changed
+    second = _get(server, 'frag', file=shapes)[1]
+    assert second != first
+    assert second == compiler.fragment_query(compiler.compile_file(shapes))
+
+    # the registry holds two schemas
+    _get(server, 'info', file=SHAPES)
+    _get(server, 'info', file=BASIC)
+    assert len(server.registry) == 2
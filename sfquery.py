@@ -1,304 +1,261 @@
+from typing import Optional
+
 from algebra import SANode, Op, negation_normal_form
 from pathalg import PANode, POp
 import unaryquery
 
+import plan
+import trampoline
+from emit import Rope
+
 
 def _make_simple_comp(complist):
-    if len(complist) == 1:
-        return complist[0]
-    return PANode(POp.COMP, [complist[0], _make_simple_comp(complist[1:])])
+    # right nested binary compositions, built from the end
+    comp = complist[-1]
+    for path in reversed(complist[:-1]):
+        comp = PANode(POp.COMP, [path, comp])
+    return comp
+
+
+_TRIPLE = ('?s', '?p', '?o')
+
+
+def graph_paths(node, head_condition: Optional[str] = None) -> str:
+    return str(plan.to_sparql(plan.simplify(graph_paths_plan(node, head_condition))))
+
+
+def graph_paths_plan(node, head_condition: Optional[str] = None) -> plan.Plan:
+    """
+    The plan of graph_paths: the triples ?s ?p ?o on the paths from ?t to ?h.
+    head_condition is a filter condition on ?h, like the ones of
+    unaryquery.test_condition, checked where the heads are found.
+    """
+    return trampoline.run(_graph_paths(node, head_condition))
 
 
-def graph_paths(node):
+def _graph_paths(node, head_condition=None):
+    # generator, see trampoline.run
     if node.pop == POp.PROP:
-        prop = str(node.children[0])
-        return f'''
-        # graph_paths POp.PROP
-        SELECT (?s AS ?t) ?s (<{prop}> AS ?p) ?o (?o AS ?h)
-        WHERE {{ ?s <{prop}> ?o }}'''
+        prop = f'<{str(node.children[0])}>'
+        if head_condition is not None:
+            return plan.project(plan.filtered(head_condition, plan.scan('?s', prop, '?h')),
+                                '(?s AS ?t)', '?s', f'({prop} AS ?p)', '(?h AS ?o)', '?h',
+                                comment='graph_paths POp.PROP')
+        return plan.project(plan.scan('?s', prop, '?o'),
+                            '(?s AS ?t)', '?s', f'({prop} AS ?p)', '?o', '(?o AS ?h)',
+                            comment='graph_paths POp.PROP')
     if node.pop == POp.ZEROORONE:
-        qe1 = graph_paths(node.children[0])
-        return f'''
-        # graph_paths POp.ZEROORONE
-        SELECT *
-        WHERE {{
-        {{ {qe1} }}
-        UNION
-        {{
-        SELECT (?h AS ?t) ?h
-        WHERE {{ {{ ?h ?_p1 ?_o1 }} UNION {{ ?_s2 ?_p2 ?h }} }}
-        }} }}'''
+        qe1 = yield _graph_paths(node.children[0], head_condition)
+        heads = plan.nodes('?h', 'ZEROORONE')
+        if head_condition is not None:
+            heads = plan.filtered(head_condition, heads)
+        return plan.union(qe1, plan.project(heads, '(?h AS ?t)', '?h'))
 
     if node.pop == POp.ALT:
-        qes = ''
+        qes = []
         for child in node.children:
-            qes += f'{{ {graph_paths(child)} }} UNION '
-        return f'''
-        # graph_paths POp.ALT
-        SELECT ?t ?s ?p ?o ?h WHERE {{ {qes[:-6]} }}'''
+            qes.append((yield _graph_paths(child, head_condition)))
+        return plan.project(plan.union(*qes), '?t', *_TRIPLE, '?h', comment='graph_paths POp.ALT')
 
     if node.pop == POp.COMP:
         node = _make_simple_comp(node.children)
-        qe1 = graph_paths(node.children[0])
-        qe2 = graph_paths(node.children[1])
-        return f'''
-# graph_paths POp.COMP
-SELECT ?t ?s ?p ?o ?h
-WHERE {{
-{{
-  {{
-    SELECT ?t ?s ?p ?o (?h AS ?h1)
-    WHERE {{ {qe1} }}
-  }} .
-  {{
-    SELECT (?t AS ?h1) (?s AS ?s1) (?p AS ?p1) (?o AS ?o1) ?h
-    WHERE {{ {qe2} }}
-  }}
-}} UNION {{
-  {{
-    SELECT ?t (?s AS ?s2) (?p AS ?p2) (?o AS ?o2) (?h AS ?h1)
-    WHERE {{ {qe1} }}
-  }} .
-  {{
-    SELECT (?t AS ?h1) ?s ?p ?o ?h
-    WHERE {{ {qe2} }}
-  }}
-}} }}
-'''
+        qe1 = yield _graph_paths(node.children[0])
+        # the heads of the path are the heads of its second part
+        qe2 = yield _graph_paths(node.children[1], head_condition)
+        # the triples on the first part of the path, and on the second part
+        return plan.project(plan.union(
+            plan.join(plan.project(qe1, '?t', *_TRIPLE, '(?h AS ?h1)'),
+                      plan.project(qe2, '(?t AS ?h1)', '(?s AS ?s1)', '(?p AS ?p1)', '(?o AS ?o1)', '?h')),
+            plan.join(plan.project(qe1, '?t', '(?s AS ?s2)', '(?p AS ?p2)', '(?o AS ?o2)', '(?h AS ?h1)'),
+                      plan.project(qe2, '(?t AS ?h1)', *_TRIPLE, '?h'))),
+            '?t', *_TRIPLE, '?h', comment='graph_paths POp.COMP')
+
     if node.pop == POp.INV:
-        qe1 = graph_paths(node.children[0])
-        return f'''
-        SELECT (?h AS ?t) ?s ?p ?o (?t AS ?h)
-        WHERE {{ {qe1} }}
-'''
+        qe1 = yield _graph_paths(node.children[0])
+        # renamed in two steps, a projection cannot bind a variable of its pattern
+        qe = plan.project(plan.project(qe1, '(?t AS ?h1)', *_TRIPLE, '(?h AS ?t1)'),
+                          '(?t1 AS ?t)', *_TRIPLE, '(?h1 AS ?h)')
+        return qe if head_condition is None else plan.filtered(head_condition, qe)
 
     if node.pop == POp.KLEENE:
-        qe1 = graph_paths(node.children[0])
+        qe1 = yield _graph_paths(node.children[0])
         path = unaryquery.to_path(node)
-        return f'''
-# graph_paths POp.KLEENE
-SELECT ?t ?s ?p ?o ?h
-WHERE {{
-  ?t {path} ?x1 .
-  ?x2 {path} ?h .
-  {{
-    SELECT (?t AS ?x1) ?s ?p ?o (?h AS ?x2)
-    WHERE {{ {qe1} }}
-  }} UNION {{
-    SELECT (?h AS ?t) ?h
-    WHERE {{ {{ ?h ?_p1 ?_o1 }} UNION {{ ?_s2 ?_p2 ?h }} }}
-  }}
-}}
-'''
-
-
-def to_sfquery(node, ignore_tests=False):
+        paths = plan.join(
+            plan.scan('?t', path, '?x1'),
+            plan.scan('?x2', path, '?h'),
+            plan.union(plan.project(qe1, '(?t AS ?x1)', *_TRIPLE, '(?h AS ?x2)'),
+                       plan.project(plan.nodes('?h', 'KLEENE'), '(?h AS ?t)', '?h')))
+        if head_condition is not None:
+            paths = plan.filtered(head_condition, paths)
+        return plan.project(paths, '?t', *_TRIPLE, '?h', comment='graph_paths POp.KLEENE')
+
+
+def to_sfquery(node, ignore_tests=False) -> str:
+    return str(to_sfquery_rope(node, ignore_tests))
+
+
+def to_sfquery_rope(node, ignore_tests=False,
+                    queries: unaryquery.ConformanceQueries = None) -> Rope:
+    """
+    to_sfquery, as an emit.Rope. queries gives the conformance queries, the
+    same ConformanceQueries can be used for several shapes.
+    """
+    queries = queries if queries is not None else unaryquery.ConformanceQueries()
+    return queries.sparql(to_sfquery_plan(node, ignore_tests, queries))
+
+
+def to_sfquery_plan(node, ignore_tests=False,
+                    queries: unaryquery.ConformanceQueries = None) -> plan.Plan:
+    """to_sfquery, as a simplified plan.Plan"""
+    queries = queries if queries is not None else unaryquery.ConformanceQueries()
+    return queries.simplify(trampoline.run(_to_sfquery(node, ignore_tests, queries)))
+
+
+def _fragment(query: plan.Plan) -> plan.Plan:
+    return plan.project(query, '?v', *_TRIPLE)
+
+
+def _from_tail(query: plan.Plan) -> plan.Plan:
+    # the triples found from ?t, as the fragment of ?v
+    return plan.project(query, '(?t AS ?v)', *_TRIPLE)
+
+
+def _as(query: plan.Plan, var: str) -> plan.Plan:
+    # the conformance query query, with ?v renamed to var
+    return plan.project(query, f'(?v AS {var})')
+
+
+def _to_sfquery(node, ignore_tests, queries):
+    # generator, see trampoline.run
+    # the children are translated with ignore_tests=False
     # Optimization: OR does not need conformance
     if node.op == Op.OR:
-        qps = ''
+        qps = []
         for child in node.children:
-            qps += f'{{ {to_sfquery(child)} }} UNION '
-        return f'SELECT ?v ?s ?p ?o WHERE {{ {qps[:-6]} }}'
+            qps.append((yield _to_sfquery(child, False, queries)))
+        return _fragment(plan.union(*qps))
 
-    cqp = unaryquery.to_uq(node, ignore_tests=ignore_tests)
+    cqp = yield queries.reference(node, ignore_tests)
 
     if node.op == Op.AND:
-        qps = ''
+        qps = []
         for child in node.children:
-            qps += f'{{ {to_sfquery(child)} }} UNION '
-        return f'''
-        SELECT ?v ?s ?p ?o 
-        WHERE {{ 
-            {{ {cqp} }} . 
-            {{
-                SELECT ?v ?s ?p ?o 
-                WHERE {{
-                    {qps[:-6]} 
-                }}
-            }}
-        }}'''
+            qps.append((yield _to_sfquery(child, False, queries)))
+        return _fragment(plan.join(cqp, _fragment(plan.union(*qps))))
 
     if node.op == Op.GEQ:
-        cqp1 = unaryquery.to_uq(node.children[2], ignore_tests=ignore_tests)
+        # Optimization: If node is of the form geq_n E.TEST, the test is a filter on the
+        # heads of the paths, and the tested values have no fragment
+        condition = unaryquery.test_condition(node.children[2], var='?h')
+        if condition is not None and not ignore_tests:
+            qe = yield _graph_paths(node.children[1], condition)
+            return _from_tail(plan.join(_as(cqp, '?t'), qe))
+
+        cqp1 = yield queries.reference(node.children[2], ignore_tests)
         path = unaryquery.to_path(node.children[1])
-        qp1 = to_sfquery(node.children[2])
-        # TODO Optimization (??): If node is of the form geq_n E.TEST we should incorporate the test
-        # in the graph_paths query.
-        # We do this by adding a filter on the head '?h' in the graph_paths construction
+        qp1 = yield _to_sfquery(node.children[2], False, queries)
 
-        qe = graph_paths(node.children[1])
+        qe = yield _graph_paths(node.children[1])
         # Optimization: If node is of the form geq_n E.TOP, we do not need to retrieve psi
         # we also do not need to conformance check for psi
         if node.children[2].op == Op.TOP:
-            return f'''
-            SELECT (?t AS ?v) ?s ?p ?o
-            WHERE {{
-                {{ SELECT (?v AS ?t) WHERE {{ {cqp} }} }} .
-                {{ {qe} }} 
-            }}'''
-        return f'''
-        SELECT (?t AS ?v) ?s ?p ?o
-        WHERE {{ {{
-        {{ SELECT (?v AS ?t) WHERE {{ {cqp} }} }} .
-        {{ {qe} }} .
-        {{ SELECT (?v AS ?h) WHERE {{ {cqp1} }} }}
-        }} UNION {{
-        {{ SELECT (?v AS ?t) WHERE {{ {cqp} }} }} .
-        ?t {path} ?h .
-        {{ SELECT (?v AS ?h) ?s ?p ?o
-           WHERE {{ {{ {qp1} }} .  {{ {cqp1} }} }} }} }} }} '''
+            return _from_tail(plan.join(_as(cqp, '?t'), qe))
+        return _from_tail(plan.union(
+            plan.join(_as(cqp, '?t'), qe, _as(cqp1, '?h')),
+            plan.join(_as(cqp, '?t'), plan.scan('?t', path, '?h'),
+                      plan.project(plan.join(qp1, cqp1), '(?v AS ?h)', *_TRIPLE))))
 
     # Optimization: If the statement is of the form leq_n E.TOP, then nothing is returned
     if node.op == Op.LEQ and node.children[2].op != Op.TOP:
-        qe = graph_paths(node.children[1])
+        # Optimization: If node is of the form leq_n E.TEST, the values that fail the
+        # test are a filter on the heads of the paths, and have no fragment
+        condition = unaryquery.test_condition(node.children[2], negate=True, var='?h')
+        if condition is not None and not ignore_tests:
+            qe = yield _graph_paths(node.children[1], condition)
+            return _from_tail(plan.join(_as(cqp, '?t'), qe))
+
+        qe = yield _graph_paths(node.children[1])
         np1 = negation_normal_form(SANode(Op.NOT, [node.children[2]]))
-        cqnp1 = unaryquery.to_uq(np1, ignore_tests=ignore_tests)
-        qnp1 = to_sfquery(np1)
+        cqnp1 = yield queries.reference(np1, ignore_tests)
+        qnp1 = yield _to_sfquery(np1, False, queries)
         path = unaryquery.to_path(node.children[1])
 
-        return f'''
-        SELECT (?t AS ?v) ?s ?p ?o
-        WHERE {{
-        {{
-          {{ SELECT (?v AS ?t) WHERE {{ {cqp} }} }} .
-          {{ {qe} }} .
-          {{ SELECT (?v AS ?h) WHERE {{ {cqnp1 } }} }}
-        }} UNION {{
-          {{ SELECT (?v AS ?t) WHERE {{ {cqp} }} }} .
-          ?t {path} ?h .
-          {{
-            SELECT (?v AS ?h) ?s ?p ?o
-            WHERE {{ {{ {qnp1} }} . {{ {cqnp1} }} }}
-        }} }} }}
-        '''
+        return _from_tail(plan.union(
+            plan.join(_as(cqp, '?t'), qe, _as(cqnp1, '?h')),
+            plan.join(_as(cqp, '?t'), plan.scan('?t', path, '?h'),
+                      plan.project(plan.join(qnp1, cqnp1), '(?v AS ?h)', *_TRIPLE))))
 
     if node.op == Op.FORALL:
-        qe = graph_paths(node.children[0])
+        qe = yield _graph_paths(node.children[0])
         # This often occurs when we "ignore tests"
         # We do not need conformance because all nodes
         # conform to forall E.TOP and all nodes conform to TOP.
         if node.children[1].op == Op.TOP:
-            return f'''
-            SELECT (?t AS ?v) ?s ?p ?o
-            WHERE {{ {{ {qe} }} }}
-            '''
+            return _from_tail(qe)
+
+        # Optimization: If node is of the form forall E.TEST, the values of conforming nodes
+        # pass the test and have no fragment
+        if unaryquery.test_condition(node.children[1]) is not None:
+            return _from_tail(plan.join(_as(cqp, '?t'), qe))
 
         path = unaryquery.to_path(node.children[0])
-        qp1 = to_sfquery(node.children[1])
-
-        return f'''
-        SELECT (?t AS ?v) ?s ?p ?o
-        WHERE {{
-        {{
-          {{ SELECT (?v AS ?t) WHERE {{ {cqp} }} }} .
-          {{ {qe} }}
-        }} UNION {{
-          {{ SELECT (?v AS ?t) WHERE {{ {cqp} }} }} .
-          ?t {path} ?h .
-          {{
-            SELECT (?v AS ?h) ?s ?p ?o
-            WHERE {{ {qp1} }}
-        }} }} }}
-        '''
+        qp1 = yield _to_sfquery(node.children[1], False, queries)
 
-    if node.op == Op.EQ:
-        qe = graph_paths(node.children[0])
-        qp = graph_paths(node.children[1])
+        return _from_tail(plan.union(
+            plan.join(_as(cqp, '?t'), qe),
+            plan.join(_as(cqp, '?t'), plan.scan('?t', path, '?h'),
+                      plan.project(qp1, '(?v AS ?h)', *_TRIPLE))))
 
-        return f'''
-SELECT (?t AS ?v) ?s ?p ?o
-WHERE {{
-{{ SELECT (?v AS ?t) WHERE {{ {cqp} }} }} .
-{{ {{ {qe} }} UNION {{ {qp} }} }} }}
-'''
+    if node.op == Op.EQ:
+        qe = yield _graph_paths(node.children[0])
+        qp = yield _graph_paths(node.children[1])
+        return _from_tail(plan.join(_as(cqp, '?t'), plan.union(qe, qp)))
 
     # Optimization
     if node.op == Op.EXACTLY1:
-        qe = graph_paths(node.children[0])
-        return f'''
-        SELECT (?t AS ?v) ?s ?p ?o
-        WHERE {{
-            {{ SELECT (?v AS ?t) WHERE {{ {cqp} }} }} .
-            {{ {qe} }} 
-        }}'''
+        qe = yield _graph_paths(node.children[0])
+        return _from_tail(plan.join(_as(cqp, '?t'), qe))
 
     if node.op == Op.NOT:
         child = node.children[0]
         if child.op == Op.CLOSED:
-            notinlist = ''
-            for prop in child.children:
-                notinlist += f'{str(prop)} ,'
-            notinlist = f'( {notinlist[:-1]} )'
-        # Optimization: we do not need conformance
-            return f'''
-SELECT ?v (?v AS ?s) ?p ?o
-WHERE {{
-?v ?p ?o .
-FILTER (?p NOT IN {notinlist})
-}}
-'''
+            properties = ', '.join(unaryquery.to_path(prop) for prop in child.children)
+            # Optimization: we do not need conformance
+            return plan.project(plan.filtered(f'(?p NOT IN ( {properties} ))',
+                                              plan.scan('?v', '?p', '?o')),
+                                '?v', '(?v AS ?s)', '?p', '?o')
         if child.op == Op.UNIQUELANG:
-            qe = graph_paths(child.children[0])
+            qe = yield _graph_paths(child.children[0])
             path = unaryquery.to_path(child.children[0])
-
-            return f'''
-SELECT ( ?t AS ?v ) ?s ?p ?o
-WHERE {{
-{{ SELECT (?v AS ?t) WHERE {{ {cqp} }} .
-{{ {qe} }} .
-{{ ?t {path} ?h2 }}
-FILTER (?h != ?h2 && lang(?h) = lang(?h2))
-'''
+            return _from_tail(plan.filtered(
+                '(?h != ?h2 && lang(?h) = lang(?h2))',
+                plan.join(_as(cqp, '?t'), qe, plan.scan('?t', path, '?h2'))))
 
         if child.op in [Op.EQ, Op.DISJ, Op.LESSTHAN, Op.LESSTHANEQ]:
-            qe = graph_paths(child.children[0])
-            qp = graph_paths(child.children[1])
+            qe = yield _graph_paths(child.children[0])
+            qp = yield _graph_paths(child.children[1])
             path = unaryquery.to_path(child.children[0])  # E
             prop = unaryquery.to_path(child.children[1])  # p
 
             if child.op == Op.EQ:
                 # Optimization: no conformance needed
-                return f'''
-SELECT (?t AS ?v) ?s ?p ?o
-WHERE {{
-  {{ {{ {qe} }} MINUS {{ ?t {prop} ?h }} }}
-  UNION
-  {{ {{ {qp} }} MINUS {{ ?t {path} ?h }} }} 
-}} 
-'''
+                return _from_tail(plan.union(
+                    plan.minus(qe, plan.scan('?t', prop, '?h')),
+                    plan.minus(qp, plan.scan('?t', path, '?h'))))
 
             if child.op == Op.DISJ:
                 # Optimization: no conformance needed
-                return f'''
-SELECT (?t AS ?v) ?s ?p ?o
-WHERE {{
-  {{ {{ {qe} }} . {{ ?t {prop} ?h }} }}
-  UNION
-  {{ {{ {qp} }} . {{ ?t {path} ?h }} }} }}
-'''
-            if child.op == Op.LESSTHAN:
-                # Optimization: no conformance needed
-                return f'''
-SELECT (?t AS ?v) ?s ?p ?o
-WHERE {{
-  {{ {{ {qe} }} . {{ ?t {prop} ?h2 }} FILTER (!( ?h < ?h2 )) }}
-  UNION
-  {{ {{ {qp} }} . {{ ?t {path} ?h2 }} FILTER (!( ?h2 < ?h )) }}
-}} 
-'''
-            if child.op == Op.LESSTHANEQ:
-                # Optimization: no conformance needed
-                return f'''
-SELECT (?t AS ?v) ?s ?p ?o
-WHERE {{
-  {{ {{ {qe} }} . {{ ?t {prop} ?h2 }} FILTER (!( ?h <= ?h2 )) }}
-  UNION
-  {{ {{ {qp} }} . {{ ?t {path} ?h2 }} FILTER (!( ?h2 <= ?h )) }}
-}}
-'''
+                return _from_tail(plan.union(
+                    plan.join(qe, plan.scan('?t', prop, '?h')),
+                    plan.join(qp, plan.scan('?t', path, '?h'))))
+
+            # Optimization: no conformance needed
+            comparison = '<' if child.op == Op.LESSTHAN else '<='
+            return _from_tail(plan.union(
+                plan.filtered(f'(!( ?h {comparison} ?h2 ))',
+                              plan.join(qe, plan.scan('?t', prop, '?h2'))),
+                plan.filtered(f'(!( ?h2 {comparison} ?h ))',
+                              plan.join(qp, plan.scan('?t', path, '?h2')))))
 
     # In all other cases, we return the empty query
-    return '''
-    SELECT ?v ?s ?p ?o
-    WHERE {}
-    '''
\ No newline at end of file
+    return plan.empty('?v', *_TRIPLE)
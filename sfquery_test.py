@@ -7,7 +7,8 @@ from rdflib import Graph, Namespace, Literal
 from algebra import parse, Op, SANode, optimize_tree, expand_shape
 from pathalg import PANode, POp
 
-from sfquery import to_sfquery
+import plan
+from sfquery import to_sfquery, to_sfquery_plan, graph_paths
 
 EX = Namespace('http://ex.tt/')
 
@@ -19,4 +20,34 @@ def test_to_sfquery():
     print(to_sfquery(shape))
 
 
-test_to_sfquery()
\ No newline at end of file
+test_to_sfquery()
+
+def test_deep_to_sfquery():
+    shape = SANode(Op.HASVALUE, [EX.v])
+    for i in range(5000):
+        shape = SANode(Op.OR, [SANode(Op.EXACTLY1, [PANode(POp.PROP, [EX[f'p{i}']])]), shape])
+    assert to_sfquery(shape).count('# graph_paths POp.PROP') == 5000
+
+    path = PANode(POp.ALT, [PANode(POp.PROP, [EX[f'p{i}']]) for i in range(5000)])
+    assert graph_paths(path).count('# graph_paths POp.PROP') == 5000
+
+
+def test_tests_on_path_heads():
+    data = Graph()
+    data.parse(data='''
+        @prefix ex: <http://ex.tt/> .
+        ex:a ex:p ex:b, ex:c, "d" .
+        ex:b ex:p "e" .
+    ''', format='ttl')
+    p = PANode(POp.PROP, [EX.p])
+    iri = SANode(Op.TEST, ['nodekind', SH.IRI])
+    fragments = {
+        SANode(Op.GEQ, [Literal(2), p, iri]): {(EX.a, EX.p, EX.b), (EX.a, EX.p, EX.c)},
+        SANode(Op.LEQ, [Literal(2), p, iri]): {(EX.a, EX.p, Literal('d')), (EX.b, EX.p, Literal('e'))},
+        SANode(Op.FORALL, [p, SANode(Op.NOT, [iri])]): {(EX.b, EX.p, Literal('e'))},
+    }
+    for shape, expected in fragments.items():
+        query = to_sfquery_plan(shape)
+        # one filtered scan, no conformance query of the values
+        assert not plan.universe(query)
+        assert {(row.s, row.p, row.o) for row in data.query(str(plan.to_sparql(query)))} == expected
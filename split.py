@@ -0,0 +1,145 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+import compiler
+from endpoint import EndpointError
+from fragment import ntriples_term
+
+if TYPE_CHECKING:
+    import rdflib
+    from endpoint import Endpoint
+
+'''
+Per-shape execution of fragment queries
+
+The fragment query of a schema is the UNION of the queries of its targeted
+shapes, a single query that some stores cannot evaluate and that is sent
+again in full when it fails. run_local and run_endpoint send the query of
+every shape on its own instead, at the same time: in a pool of threads on an
+rdflib Graph, or with asyncio on an endpoint.Endpoint (which bounds the
+queries in flight). The rows (?v ?s ?p ?o) of all the queries go to a
+RowSink, as they arrive, which passes every distinct row once: the result is
+the one of the UNION, without duplicates.
+
+A shape whose query fails is sent again, at most retries times, the others
+are not. Its rows that were already passed are dropped by the sink, so a
+query can be retried after some of its rows were read. A shape that still
+fails is reported in its ShapeRun, the rows of the other shapes are kept.
+
+rdflib evaluates queries in Python, holding the GIL, so the threads of
+run_local mostly overlap the shapes rather than run them at the same time,
+the first rows arrive early; run_endpoint keeps the endpoint busy with
+several queries. The parser of rdflib is not thread safe, run_local parses
+the queries one at a time.
+'''
+
+DEFAULT_RETRIES = 2
+HEADER = '?v\t?s\t?p\t?o'
+
+_PARSING = Lock()  # the SPARQL parser of rdflib (pyparsing) is not thread safe
+
+
+class RowSink:
+    """The distinct rows of the shape queries, passed to write once, from any thread"""
+
+    def __init__(self, write: Optional[Callable[[Tuple], None]] = None):
+        self.write = write
+        self.rows = set()
+        self.duplicates = 0  # rows given again, by another shape or a retry
+        self._lock = Lock()
+
+    def add(self, row: Tuple) -> bool:
+        """Passes row to write unless it was passed before, True if it was new"""
+        with self._lock:
+            if row in self.rows:
+                self.duplicates += 1
+                return False
+            self.rows.add(row)
+            # in the lock, the lines of the rows are not interleaved
+            if self.write is not None:
+                self.write(row)
+            return True
+
+
+class ShapeRun:
+    """The execution of the query of one shape"""
+
+    def __init__(self, shape_name, rows: int, attempts: int, seconds: float, error: Optional[str] = None):
+        self.shape_name = shape_name
+        self.rows = rows  # the rows of the last attempt, with the duplicates
+        self.attempts = attempts
+        self.seconds = seconds  # the wall time of all the attempts
+        self.error = error  # the error of the last attempt, None when it succeeded
+
+
+def shape_queries(compiled: compiler.CompiledSchema) -> Dict:
+    """The query of every targeted shape, the parts of compiler.fragment_query"""
+    return {shape_name: str(compiled.queries[shape_name]) for shape_name in compiled.targeted}
+
+
+def run_local(compiled: compiler.CompiledSchema, graph: 'rdflib.Graph', sink: RowSink,
+              workers: Optional[int] = None, retries: int = DEFAULT_RETRIES) -> List[ShapeRun]:
+    """
+    Evaluates the query of every targeted shape on graph in workers threads,
+    the rows go to sink. The ShapeRun of every shape, in order.
+    """
+    from rdflib.plugins.sparql import prepareQuery
+    queries = shape_queries(compiled)
+
+    def run(shape_name) -> ShapeRun:
+        start = time.perf_counter()
+        for attempt in range(1, retries + 2):
+            rows = 0
+            try:
+                # parsed one at a time, evaluated at the same time
+                with _PARSING:
+                    query = prepareQuery(queries[shape_name])
+                for row in graph.query(query):
+                    rows += 1
+                    sink.add(tuple(row))
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+                continue
+            return ShapeRun(shape_name, rows, attempt, time.perf_counter() - start)
+        return ShapeRun(shape_name, rows, retries + 1, time.perf_counter() - start, error)
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(run, compiled.targeted))
+
+
+async def run_endpoint(compiled: compiler.CompiledSchema, endpoint: 'Endpoint', sink: RowSink,
+                       retries: int = DEFAULT_RETRIES) -> List[ShapeRun]:
+    """
+    Sends the query of every targeted shape to endpoint at once (it bounds
+    the queries in flight), the rows go to sink. The ShapeRun of every shape,
+    in order. A shape is retried after endpoint gave up on it, waiting as
+    endpoint does between its own retries.
+    """
+    queries = shape_queries(compiled)
+
+    async def run(shape_name) -> ShapeRun:
+        start = time.perf_counter()
+        for attempt in range(1, retries + 2):
+            rows = 0
+            try:
+                async for row in endpoint.rows(queries[shape_name]):
+                    rows += 1
+                    sink.add(row)
+            except (EndpointError, OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+                # a lost connection, or an answer that cannot be parsed
+                error = f'{type(e).__name__}: {e}'
+                if attempt <= retries:
+                    await asyncio.sleep(endpoint.backoff * 2 ** (attempt - 1))
+                continue
+            return ShapeRun(shape_name, rows, attempt, time.perf_counter() - start)
+        return ShapeRun(shape_name, rows, retries + 1, time.perf_counter() - start, error)
+
+    return list(await asyncio.gather(*[run(shape_name) for shape_name in compiled.targeted]))
+
+
+def tsv_row(row: Tuple) -> str:
+    """row as a line of SPARQL tab-separated values, without the line break"""
+    return '\t'.join('' if term is None else ntriples_term(term).replace('\t', '\\t') for term in row)
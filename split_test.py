@@ -0,0 +1,108 @@
+import pytest
+from rdflib import Graph, Literal, URIRef
+
+import compiler
+from endpoint import Endpoint, run
+from split import RowSink, run_endpoint, run_local, shape_queries, tsv_row
+from testsupport import DATA, FRAGMENT_SHAPES, TARGETED_DATA, TARGETED_SHAPES, graph
+
+
+def _union(compiled, data):
+    # the rows of the fragment query, without duplicates
+    return {tuple(row) for row in data.query(compiler.fragment_query(compiled))}
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+@pytest.mark.parametrize('case', ['fragment', 'targeted', 'split'], indirect=True)
+def test_local(case, workers):
+    data, shapes = case
+    compiled = compiler.compile_schema(shapes)
+    written = []
+    sink = RowSink(written.append)
+    runs = run_local(compiled, data, sink, workers)
+    assert [run.shape_name for run in runs] == compiled.targeted
+    assert all(run.error is None and run.attempts == 1 for run in runs)
+    assert len(written) == len(set(written))
+    assert written
+    assert set(written) == sink.rows == _union(compiled, data)
+    assert sum(run.rows for run in runs) == len(written) + sink.duplicates
+
+
+class Flaky(Graph):
+    """A graph whose first queries fail, at once or after their first row"""
+
+    def __init__(self, data, failures, first_row=True):
+        super().__init__()
+        self += data
+        self.failures = failures
+        self.first_row = first_row
+
+    def query(self, query, *args, **kwargs):
+        result = super().query(query, *args, **kwargs)
+        if self.failures:
+            self.failures -= 1
+            if not self.first_row:
+                raise ValueError('broken')
+            return _failing(result)
+        return result
+
+
+def _failing(rows):
+    yield next(iter(rows))
+    raise ConnectionError('lost')
+
+
+def test_local_retry():
+    compiled = compiler.compile_schema(graph(TARGETED_SHAPES))
+    data = graph(TARGETED_DATA)
+    sink = RowSink()
+    runs = run_local(compiled, Flaky(data, failures=1), sink, workers=1)
+    assert sink.rows == _union(compiled, data)
+    assert [run.attempts for run in runs] == [2] + [1] * (len(runs) - 1)
+    assert all(run.error is None for run in runs)
+    # the row given before the failure, again
+    assert sink.duplicates >= 1
+
+
+def test_local_failed():
+    compiled = compiler.compile_schema(graph(FRAGMENT_SHAPES))
+    data = graph(DATA)
+    sink = RowSink()
+    # in one thread, the shapes in order: the first one fails twice
+    runs = run_local(compiled, Flaky(data, failures=2, first_row=False), sink, workers=1, retries=1)
+    assert runs[0].error == 'ValueError: broken' and runs[0].attempts == 2
+    assert all(run.error is None for run in runs[1:])
+    # the rows of the other shapes
+    others = {tuple(row) for query in list(shape_queries(compiled).values())[1:] for row in data.query(query)}
+    assert sink.rows == others
+
+
+def test_endpoint(standin):
+    compiled = compiler.compile_schema(graph(FRAGMENT_SHAPES))
+    endpoint = Endpoint(standin.url, max_in_flight=2)
+    sink = RowSink()
+    runs = run(run_endpoint(compiled, endpoint, sink), endpoint)
+    assert all(run.error is None for run in runs)
+    assert sink.rows == _union(compiled, standin.graph)
+    assert standin.max_in_flight == 2
+
+
+def test_endpoint_retry(standin):
+    compiled = compiler.compile_schema(graph(FRAGMENT_SHAPES))
+    # the endpoint gives up at once, the shapes are retried
+    endpoint = Endpoint(standin.url, max_in_flight=1, retries=0, backoff=0.01)
+    standin.failures = 2
+    sink = RowSink()
+    runs = run(run_endpoint(compiled, endpoint, sink), endpoint)
+    assert sink.rows == _union(compiled, standin.graph)
+    assert all(run.error is None for run in runs)
+    assert sum(run.attempts for run in runs) == len(runs) + 2
+
+    standin.failures = 100
+    runs = run(run_endpoint(compiled, endpoint, RowSink(), retries=1), endpoint)
+    assert all(run.attempts == 2 and '503' in run.error for run in runs)
+
+
+def test_tsv_row():
+    row = (URIRef('http://ex.tt/a'), None, Literal('a\tb'), Literal(1))
+    assert tsv_row(row) == '<http://ex.tt/a>\t\t"a\\tb"\t"1"^^<http://www.w3.org/2001/XMLSchema#integer>'
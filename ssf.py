@@ -2,15 +2,17 @@
 
 import sys
 import os
-import algebra
-from algebra import SANode, Op
+from typing import TYPE_CHECKING
 
-from rdflib import Graph, URIRef, Namespace
-from sfquery import to_sfquery
+if TYPE_CHECKING:
+    from rdflib import URIRef
 
 '''
 ssf stands for Sparql Shape Fragments
 
+The modules for parsing and translating shapes graphs (and rdflib) are
+imported by the commands that use them, so --help does not load them.
+
 TODO: cleanup cmd argument parsing
 '''
 
@@ -18,16 +20,45 @@ TODO: cleanup cmd argument parsing
 def _cmd_help():
     print('Help:')
     print(
-        f'{sys.argv[0]} [--frag [-i] | --bvg shape | --parser [-neo] shape | --show shape | --latex shape | --info ] file')
+        f'{sys.argv[0]} [--help | --frag [-i] [-v] [-s] | --frag [-i] [-j n] -r data | --extract [-e] data | --batch [-i] [-j n] [-o dir] | --bvg shape | --parser [-neo] shape | --show shape | --latex shape | --info ] file')
     print('Note: shape should be a prefixed iri where the prefix should be defined in the')
     print('      shapes graph. File should be a filename of a Turtle file containing a')
     print('      shapes graph.')
     print('Description:')
     print('Only one mode can be used at a time.')
-    print('    --frag [-i] file')
+    print('    --frag [-i] [-v] [-s] file')
     print('        shows the SPARQL query representing the Shape Fragment of the')
     print('        shape schema given by file')
     print('        -i    ignore all test constraints')
+    print('        -v    report the shapes that were compiled (not cached) on stderr,')
+    print('              and the constructs for which a query scans all the nodes')
+    print('        -s    staged: every conformance query is written once, as a SPARQL')
+    print('              Update that stores its result in a named graph, followed by')
+    print('              the query that reads those graphs and an Update removing them')
+    print('        compiled shapes graphs are cached in $SSF_CACHE_DIR (default')
+    print('        ~/.cache/ssf, empty to disable) of at most $SSF_CACHE_SIZE MB')
+    print('    --frag [-i] [-j n] -r data file')
+    print('        runs the query of every shape of the fragment query on its own,')
+    print('        concurrently, on data: a data graph file or the URL of a SPARQL')
+    print('        endpoint. Writes the distinct rows (?v ?s ?p ?o) as tab-separated')
+    print('        values as they arrive. A failed query is retried, the shapes that')
+    print('        still fail are reported on stderr')
+    print('        -i    ignore all test constraints')
+    print('        -j    number of threads, or of queries sent at once to the')
+    print('              endpoint (default: number of CPUs, 4 for an endpoint)')
+    print('    --extract [-e] data file')
+    print('        writes the Shape Fragment of the shape schema given by file on the')
+    print('        data graph given by data as N-Triples, without SPARQL')
+    print('        -e    data is an N-Triples file, loaded as an encoded graph')
+    print('              (needs NumPy)')
+    print('    --batch [-i] [-j n] [-o dir] path ...')
+    print('        compiles the shapes graphs given by the paths (files, directories')
+    print('        or globs) in n processes and writes each fragment query to a .rq')
+    print('        file, in dir or next to the shapes graph. The cache of --frag is')
+    print('        shared by the processes. Prints the throughput')
+    print('        -i    ignore all test constraints')
+    print('        -j    number of processes (default: number of CPUs)')
+    print('        -o    output directory')
     print('    --bvg shape file')
     print('        be default shows the SPARQL query representing the neighborhood')
     print('        of shape')
@@ -44,7 +75,10 @@ def _cmd_help():
     exit(0)
 
 
-def _resolve_prefixed_shapename(namespacemanager, shapename):
+def resolve_shapename(namespacemanager, shapename) -> 'URIRef':
+    """The IRI of a prefixed shape name, raises ValueError"""
+    from rdflib import Namespace
+
     qnames = [qname for qname in namespacemanager.namespaces()]
 
     try:
@@ -52,16 +86,22 @@ def _resolve_prefixed_shapename(namespacemanager, shapename):
         prefix = split_name[0]
         rest = split_name[1]
     except:
-        print(f'Could not parse prefixed shapename "{shapename}"')
-        exit(1)
+        raise ValueError(f'Could not parse prefixed shapename "{shapename}"')
 
     for pre, uri in qnames:
         if pre == prefix:
             ns = Namespace(uri)
             return ns[rest]
 
-    print(f'Prefix "{prefix}" not defined in graph')
-    exit(1)
+    raise ValueError(f'Prefix "{prefix}" not defined in graph')
+
+
+def _resolve_prefixed_shapename(namespacemanager, shapename):
+    try:
+        return resolve_shapename(namespacemanager, shapename)
+    except ValueError as e:
+        print(e)
+        exit(1)
 
 
 def _get_filename():
@@ -73,221 +113,278 @@ def _get_filename():
 
 
 def _get_shapesgraph(filename):
-    shapesgraph = Graph()
+    import compiler
+
     try:
-        shapesgraph.parse(filename, format="ttl")
-    except Exception as e:
+        shapesgraph = compiler.parse_file(filename)
+    except compiler.ShapesFileError as e:
         print(f'Could not parse file: {filename}')
         print(e)
         exit(1)
     return shapesgraph
 
 
-def _replace_tests_with_top(tree: SANode) -> SANode:
-    new_children = []
-    for child in tree.children:
-        if type(child) == SANode and child.op == Op.TEST:
-            new_children.append(SANode(Op.TOP, []))
-        elif type(child) == SANode:  # and not child.op == Op.TEST
-            new_children.append(_replace_tests_with_top(child))
-        else:
-            new_children.append(child)
-    return SANode(tree.op, new_children)
+def _print_or_exit(output, *args):
+    # the commands raise ValueError with the message for the user
+    try:
+        print(output(*args))
+    except ValueError as e:
+        print(e)
+        exit(1)
+    exit(0)
 
 
-def _optimize_ignoring_tests(tree: SANode) -> SANode:
-    new_children = []
-    for child in tree.children:
-        if type(child) == SANode:
-            new_children.append(
-                _optimize_ignoring_tests(child))
-        else:
-            new_children.append(child)
-
-    tree = SANode(tree.op, new_children)
-
-    if tree.op == Op.AND:
-        # handle TOP children
-        if any(map(lambda c: c.op == Op.TOP, tree.children)):
-            new_children = list(filter(lambda c: c.op != Op.TOP, tree.children))
-            if len(new_children) == 0:
-                return SANode(Op.TOP, [])
-            elif len(new_children) == 1:
-                return new_children[0]
-            return SANode(Op.AND, new_children)
-
-        # handle NOT TOP children
-        if any(map(lambda c: c.op == Op.NOT and c.children[0].op == Op.TOP, tree.children)):
-            return SANode(Op.NOT, [SANode(Op.TOP, [])])
-
-    if tree.op == Op.OR:
-        # handle NOT TOP children
-        if any(map(lambda c: c.op == Op.NOT and c.children[0].op == Op.TOP, tree.children)):
-            new_children = list(filter(lambda c: not (c.op == Op.NOT and c.children[0].op == Op.TOP), tree.children))
-            if len(new_children) == 0:
-                return SANode(Op.NOT, [SANode(Op.TOP, [])])
-            elif len(new_children) == 1:
-                return new_children[0]
-            return SANode(Op.OR, new_children)
-
-        # handle multiple TOP
-        if any(map(lambda c: c.op == Op.TOP, tree.children)):
-            new_children = list(filter(lambda c: c.op != Op.TOP, tree.children))
-            if len(new_children) == 0:  # they were all TOP
-                return SANode(Op.TOP, [])
-            # they were not all TOP, but we need one to keep conformance semantics
-            new_children.append(SANode(Op.TOP, []))
-            return SANode(Op.OR, new_children)
-
-    if tree.op == Op.NOT:
-        if tree.children[0].op == Op.NOT and \
-                tree.children[0].children[0].op == Op.TOP:
-            return SANode(Op.TOP, [])
-
-    return tree
-
-
-def _optimize_exactly1(tree: SANode) -> SANode:
-    new_children = []
-    for child in tree.children:
-        if type(child) == SANode:
-            new_children.append(
-                _optimize_exactly1(child))
-        else:
-            new_children.append(child)
+def _check_defined(definitions, shapename, filename):
+    if shapename not in definitions:
+        raise ValueError(f'Shape {shapename} is not defined in {filename}')
+
 
-    tree = SANode(tree.op, new_children)
+def _cache_settings():
+    # the cache directory can be changed with SSF_CACHE_DIR, an empty value
+    # disables the cache. SSF_CACHE_SIZE is the maximum size in MB.
+    directory = os.environ.get('SSF_CACHE_DIR',
+                               os.path.join(os.path.expanduser('~'), '.cache', 'ssf'))
+    try:
+        max_size = int(float(os.environ.get('SSF_CACHE_SIZE', 256)) * 1024 * 1024)
+    except ValueError:
+        print(f'SSF_CACHE_SIZE is not a number: {os.environ["SSF_CACHE_SIZE"]}')
+        exit(1)
+    return directory, max_size
 
-    if tree.op == Op.AND:
-        # Optimization: if there is a GEQ 1 E TOP and LEQ 1 E TOP in its children, replace both with EXACTLY 1
-        is_geq_one_top = lambda c: c.op == Op.GEQ and \
-                                int(c.children[0]) == 1 and \
-                                c.children[2].op == Op.TOP
-        is_leq_one_top = lambda c: c.op == Op.LEQ and \
-                                int(c.children[0]) == 1 and \
-                                c.children[2].op == Op.TOP
-        if any(map(is_geq_one_top, tree.children)) and \
-                any(map(is_leq_one_top, tree.children)):
-            geq_one_tops = list(filter(is_geq_one_top, tree.children))
-            leq_one_tops = list(filter(is_leq_one_top, tree.children))
 
-            for geq_one in geq_one_tops:
-                for leq_one in leq_one_tops:
-                    if geq_one.children[1] == leq_one.children[1]:
-                        tree.children.append(SANode(Op.EXACTLY1, [geq_one.children[1]]))
-                        tree.children.remove(geq_one)
-                        tree.children.remove(leq_one)
-                        break
+def _get_cache():
+    directory, max_size = _cache_settings()
+    if not directory:
+        return None
+    from cache import SchemaCache
 
-            return SANode(Op.AND, tree.children)
+    return SchemaCache(directory, max_size)
 
-    return tree
+
+def _compile_file(filename, ignore_tests):
+    import algebra
+    import compiler
+
+    try:
+        return compiler.compile_file(filename, ignore_tests, _get_cache())
+    except algebra.RecursiveShapeError as e:
+        print(e)
+        exit(1)
+    except compiler.ShapesFileError as e:
+        print(f'Could not parse file: {filename}')
+        print(e)
+        exit(1)
 
 
 def _cmd_frag():
     filename = _get_filename()
-    shapesgraph = _get_shapesgraph(filename)
 
-    ignore_tests = '-i' in sys.argv  # if -i is in the options, ignore tests
+    import compiler
 
-    definitions, targets = algebra.parse(shapesgraph, ignore_tests=False)
-
-    # expand every shape that is defined in the schema
-    # put the shape in negation normal form
-    # add its target statement as a conjunction
-    # optimize this expression (remove redundancies from algebra)
-    prepared_shapes = []
-    for shape_name in definitions:
-        if shape_name not in targets or targets[shape_name] == SANode(Op.NOT, [SANode(Op.TOP, [])]):
-            continue  # we ignore the shapes that do not have any targets
-
-        prepared_shapes.append(
-            algebra.optimize_tree(
-                SANode(Op.AND, [
-                    algebra.negation_normal_form(
-                        algebra.expand_shape(definitions, definitions[shape_name])),
-                    targets[shape_name]
-                ])))
-
-    # Until now, everything is processed nicely as usual.
-    # However, when we know we want to ignore tests we can do some nice alterations
-    # on the syntax tree:
-    # 1. Replace every occurrence of a test-node to a top-node
-    # 2. Apply optimizations:
-    #    - remove tops from conjunction
-    #    - remove tops from disjunction (shapefragment-semantically the same BUT not a good optimization!!
-    #      because the tree must be correct wrt conformance at any time...)
-    #    - replace disjunction with only TOPs with TOP
-    #    - replace conjunctions with == 0 children with TOP
-    #    - replace conjunctions with == 1 child with the child
-    #    - search and replace "exactly one pattern"
-    if ignore_tests:
-        _eo_prepared_shapes = []
-        for shape in prepared_shapes:
-            _tt_shape = _replace_tests_with_top(shape)
-            _it_shape = _optimize_ignoring_tests(_tt_shape)
-            _eo_shape = _optimize_exactly1(_it_shape)
-            _eo_prepared_shapes.append(_eo_shape)
-        prepared_shapes = _eo_prepared_shapes
-
-    # translate every shape to a shape fragment query
-    shape_queries = []
-    for shape in prepared_shapes:
-        # here, the ignore_tests works only at translation time
-        shape_queries.append(to_sfquery(shape, ignore_tests=False))
-
-    # take the union of every query as the total shape fragment query
-    fragment_query = 'SELECT ?v ?s ?p ?o WHERE { '
-    for query in shape_queries:
-        fragment_query += f'''
-        # new shape as query
-        {{ {query} }} UNION '''
-
-    print(fragment_query[:-6] + '}')
+    ignore_tests = '-i' in sys.argv  # if -i is in the options, ignore tests
+    verbose = '-v' in sys.argv
+    staged = '-s' in sys.argv
+
+    compiled = _compile_file(filename, ignore_tests)
+
+    if verbose:
+        print(f'Rebuilt {len(compiled.rebuilt)} of {len(compiled.targeted)} shapes',
+              file=sys.stderr)
+        for shape_name in compiled.rebuilt:
+            print(shape_name.n3(), file=sys.stderr)
+        for shape_name in compiled.targeted:
+            if compiled.universe[shape_name]:
+                print(f'{shape_name.n3()} scans all the nodes for '
+                      f'{", ".join(compiled.universe[shape_name])}', file=sys.stderr)
+
+    # written part by part, the query is never joined in memory
+    try:
+        if staged:
+            import staged as staged_query
+            staged_query.staged_fragment_query(compiled).write(sys.stdout)
+        else:
+            compiler.write_fragment_query(compiled, sys.stdout)
+            print()
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader stopped reading, like head
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        exit(1)
     exit(0)
 
 
-def _cmd_bvg():
+def _cmd_frag_run():
+    # the options come before the file
+    arguments = sys.argv[sys.argv.index('--frag') + 1:-1]
+    ignore_tests = False
+    workers = None
+    source = None
+    while arguments:
+        option = arguments.pop(0)
+        if option == '-i':
+            ignore_tests = True
+        elif option not in ('-j', '-r') or not arguments:
+            _cmd_help()
+        elif option == '-j':
+            value = arguments.pop(0)
+            if not value.isdigit() or int(value) < 1:
+                print(f'Not a number of threads: {value}')
+                exit(1)
+            workers = int(value)
+        else:
+            source = arguments.pop(0)
+    if source is None:
+        _cmd_help()
     filename = _get_filename()
-    prefixed_shapename = sys.argv[-2]
-    shapesgraph = _get_shapesgraph(filename)
-    shapename = _resolve_prefixed_shapename(shapesgraph.namespace_manager,
-                                            prefixed_shapename)
+    remote = source.startswith(('http://', 'https://'))
+    if not remote and not os.path.exists(source):
+        print(f'Could not find file: {source}')
+        exit(1)
 
-    definitions, targets = algebra.parse(shapesgraph)
+    import split
 
-    if shapename not in definitions:
-        print(f'Shape {shapename} is not defined in {filename}')
+    compiled = _compile_file(filename, ignore_tests)
+
+    def write(row):
+        print(split.tsv_row(row))
+    sink = split.RowSink(write)
+
+    try:
+        print(split.HEADER)
+        if remote:
+            import endpoint
+            sparql = endpoint.Endpoint(source, workers or endpoint.DEFAULT_MAX_IN_FLIGHT)
+            runs = endpoint.run(split.run_endpoint(compiled, sparql, sink), sparql)
+        else:
+            from rdflib import Graph, util
+            data = Graph()
+            data.parse(source, format=util.guess_format(source))
+            runs = split.run_local(compiled, data, sink, workers)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        exit(1)
+
+    failed = [run for run in runs if run.error is not None]
+    for run in failed:
+        print(f'{run.shape_name.n3()} failed after {run.attempts} attempts: {run.error}', file=sys.stderr)
+    exit(1 if failed else 0)
+
+
+def _cmd_extract():
+    filename = _get_filename()
+    data_filename = sys.argv[-2]
+    if not os.path.exists(data_filename):
+        print(f'Could not find file: {data_filename}')
         exit(1)
 
-    print(to_sfquery(algebra.optimize_tree(algebra.negation_normal_form(
-        algebra.expand_shape(definitions, definitions[shapename])))))
+    import fragment
+
+    compiled = _compile_file(filename, False)
+
+    if '-e' in sys.argv:
+        from encoded import EncodedGraph
+        data = EncodedGraph.from_ntriples(data_filename)
+    else:
+        from rdflib import Graph, util
+        data = Graph()
+        data.parse(data_filename, format=util.guess_format(data_filename))
+
+    # written while the fragment is collected
+    try:
+        fragment.write_ntriples(fragment.extract(compiled, data), sys.stdout)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        exit(1)
     exit(0)
 
 
-def _cmd_parser():
-    filename = sys.argv[-1]
-    prefixed_shapename = URIRef(sys.argv[-2])
+def _cmd_batch():
+    import time
+    import batch
+
+    # the options come before the files
+    arguments = sys.argv[sys.argv.index('--batch') + 1:]
+    ignore_tests = False
+    workers = None
+    output_dir = None
+    while arguments and arguments[0] in ('-i', '-j', '-o'):
+        option = arguments.pop(0)
+        if option == '-i':
+            ignore_tests = True
+        elif not arguments:
+            _cmd_help()
+        elif option == '-j':
+            value = arguments.pop(0)
+            if not value.isdigit() or int(value) < 1:
+                print(f'Not a number of processes: {value}')
+                exit(1)
+            workers = int(value)
+        else:
+            output_dir = arguments.pop(0)
+    if not arguments:
+        _cmd_help()
+
+    try:
+        files = batch.shapes_files(arguments)
+    except ValueError as e:
+        print(e)
+        exit(1)
+
+    cache_dir, cache_size = _cache_settings()
+    start = time.perf_counter()
+    results = batch.compile_batch(files, output_dir, ignore_tests, cache_dir or None,
+                                  cache_size, workers)
+    seconds = time.perf_counter() - start
+
+    failed = [result for result in results if result.error is not None]
+    for result in failed:
+        print(result.error)
+    print(batch.summary(results, seconds))
+    exit(1 if failed else 0)
+
+
+def bvg_query(definitions, shapename, filename) -> str:
+    """The shape fragment query of one shape"""
+    import algebra
+    from sfquery import to_sfquery
+
+    _check_defined(definitions, shapename, filename)
+    return to_sfquery(algebra.normalize_schema(definitions, [shapename])[shapename])
+
+
+def _cmd_bvg():
+    import algebra
+
+    filename = _get_filename()
+    prefixed_shapename = sys.argv[-2]
     shapesgraph = _get_shapesgraph(filename)
     shapename = _resolve_prefixed_shapename(shapesgraph.namespace_manager,
                                             prefixed_shapename)
 
     definitions, targets = algebra.parse(shapesgraph)
+    _print_or_exit(bvg_query, definitions, shapename, filename)
+
+
+def parser_output(definitions, shapename, filename, options=None) -> str:
+    """
+    The S-expression of a shape. options is a string containing the option
+    letters n (negation normal form), e (expanded) and o (optimized)
+    """
+    import algebra
 
     option_n = False
     option_e = False
     option_o = False
-    if len(sys.argv) == 5:
-        option_n = 'n' in sys.argv[-3]
-        option_e = 'e' in sys.argv[-3]
-        option_o = 'o' in sys.argv[-3]
+    if options is not None:
+        option_n = 'n' in options
+        option_e = 'e' in options
+        option_o = 'o' in options
         if not (option_e or option_n or option_o):
-            print(f'No valid options found in {sys.argv[-3]}')
-            exit(1)
+            raise ValueError(f'No valid options found in {options}')
 
-    if shapename not in definitions:
-        print(f'Shape {shapename} is not defined in {filename}')
-        exit(1)
+    _check_defined(definitions, shapename, filename)
 
     out = definitions[shapename]
     if option_e:
@@ -296,13 +393,29 @@ def _cmd_parser():
         out = algebra.negation_normal_form(out)
     if option_o:
         out = algebra.optimize_tree(out)
-    print(out)
-    exit(0)
+    return str(out)
+
+
+def _cmd_parser():
+    import algebra
+
+    filename = sys.argv[-1]
+    prefixed_shapename = sys.argv[-2]
+    shapesgraph = _get_shapesgraph(filename)
+    shapename = _resolve_prefixed_shapename(shapesgraph.namespace_manager,
+                                            prefixed_shapename)
+
+    definitions, targets = algebra.parse(shapesgraph)
+
+    options = sys.argv[-3] if len(sys.argv) == 5 else None
+    _print_or_exit(parser_output, definitions, shapename, filename, options)
 
 
 def _cmd_latex():
+    import algebra
+
     filename = sys.argv[-1]
-    prefixed_shapename = URIRef(sys.argv[-2])
+    prefixed_shapename = sys.argv[-2]
     shapesgraph = _get_shapesgraph(filename)
     shapename = _resolve_prefixed_shapename(shapesgraph.namespace_manager,
                                             prefixed_shapename)
@@ -320,15 +433,13 @@ def _cmd_latex():
     exit(0)
 
 
-def _cmd_info():
-    filename = sys.argv[-1]
-    shapesgraph = _get_shapesgraph(filename)
+def info_output(shapesgraph, definitions, targets) -> str:
+    """The prefixes and the shapes, with and without target, of a shapes graph"""
+    import algebra
 
-    definitions, targets = algebra.parse(shapesgraph)
-
-    print('Defined prefixes:')
+    lines = ['Defined prefixes:']
     for prefix, uri in shapesgraph.namespace_manager.namespaces():
-        print(f'{prefix}{" " * (16 - len(prefix))}{uri}')
+        lines.append(f'{prefix}{" " * (16 - len(prefix))}{uri}')
 
     shapes_with_target = []
     shapes_rest = []
@@ -340,22 +451,37 @@ def _cmd_info():
         else:
             shapes_rest.append(shapename.n3(shapesgraph.namespace_manager))
 
-    print('\nShapes with target(s):')
-    for shape in shapes_with_target:
-        print(shape)
+    lines.append('\nShapes with target(s):')
+    lines += shapes_with_target
 
-    print('\nShapes without target:')
-    for shape in shapes_rest:
-        print(shape)
+    lines.append('\nShapes without target:')
+    lines += shapes_rest
+    return '\n'.join(lines)
 
-    exit(0)
+
+def _cmd_info():
+    import algebra
+
+    filename = sys.argv[-1]
+    shapesgraph = _get_shapesgraph(filename)
+
+    definitions, targets = algebra.parse(shapesgraph)
+    _print_or_exit(info_output, shapesgraph, definitions, targets)
 
 
 if __name__ == '__main__':
     argc = len(sys.argv)
 
+    if '--help' in sys.argv or '-h' in sys.argv:
+        _cmd_help()
+    elif '--batch' in sys.argv:
+        _cmd_batch()
+    elif '--extract' in sys.argv and 4 <= argc <= 5:
+        _cmd_extract()
+    elif '--frag' in sys.argv and '-r' in sys.argv:
+        _cmd_frag_run()
     # if only a file name or frag
-    if argc == 2 or ('--frag' in sys.argv and 3 <= argc <= 4):
+    elif argc == 2 or ('--frag' in sys.argv and 3 <= argc <= 6):
         _cmd_frag()
     elif '--bvg' in sys.argv and argc == 4:
         _cmd_bvg()
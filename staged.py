@@ -0,0 +1,108 @@
+from typing import List, Tuple
+
+from rdflib import URIRef
+
+import compiler
+import plan
+import unaryquery
+from algebra import SANode
+from emit import Rope, template
+from sfquery import to_sfquery_rope
+
+'''
+Staged fragment queries
+
+A fragment query inlines the conformance query of a node everywhere it is
+used: in the conformance queries of its ancestors, in the fragment query of
+the node itself and, for GEQ, LEQ and FORALL, in both branches. The text
+grows exponentially with the nesting depth of the shapes.
+
+A staged fragment query translates every distinct node (nodes are
+hash-consed, equal subtrees are one node) once. Its conformance query is a
+stage: the conforming nodes are inserted into a named graph, and the queries
+that use them read that graph. It is run as three requests:
+
+    update   SPARQL Update that fills the stage graphs, children first
+    query    the fragment query, reading the stage graphs
+    cleanup  SPARQL Update that drops the stage graphs
+
+The data must be in the default graph, the stage graphs are not part of it.
+'''
+
+STAGE_PREFIX = 'urn:ssf:stage:'
+MEMBER = URIRef('urn:ssf:member')
+
+
+class StagedConformance(unaryquery.ConformanceQueries):
+    """Conformance queries that use each other through stage graphs"""
+
+    def __init__(self, prefix: str = STAGE_PREFIX):
+        super().__init__()
+        self.prefix = prefix
+        self.stages = []  # (graph, conformance query), a stage after the stages it uses
+        self._references = {}  # (node, ignore_tests) -> plan reading the graph
+
+    def reference(self, node: SANode, ignore_tests=False):
+        # generator, see trampoline.run
+        key = (node, ignore_tests)
+        query = yield self.query(node, ignore_tests)
+        if plan.is_restriction(query):
+            # not staged, the queries using it can restrict the nodes of the graph
+            return query
+        if key not in self._references:
+            graph = URIRef(f'{self.prefix}{len(self.stages)}')
+            self.stages.append((graph, self.sparql(query)))
+            self._references[key] = plan.project(
+                plan.pattern(f'GRAPH <{graph}> {{ <{graph}> <{MEMBER}> ?v }}'), '?v')
+        return self._references[key]
+
+
+class StagedQuery:
+    """A fragment query and the stages it reads"""
+
+    def __init__(self, stages: List[Tuple[URIRef, Rope]], query: Rope):
+        self.stages = stages
+        self.query = query
+
+    def update(self) -> Rope:
+        parts = []
+        for graph, query in self.stages:
+            parts.append(template(
+                'INSERT {{ GRAPH <{graph}> {{ <{graph}> <{member}> ?v }} }}\n'
+                'WHERE {{ {{ {query} }} }} ;\n',
+                graph=graph, member=MEMBER, query=query))
+        return Rope(parts)
+
+    def cleanup(self) -> str:
+        return ''.join(f'DROP SILENT GRAPH <{graph}> ;\n' for graph, query in self.stages)
+
+    def write(self, sink):
+        """Writes the three requests to sink, each one after a comment line"""
+        sink.write('# update\n')
+        self.update().write(sink)
+        sink.write('\n# query\n')
+        self.query.write(sink)
+        sink.write('\n\n# cleanup\n')
+        sink.write(self.cleanup())
+
+    def run(self, dataset) -> List:
+        """
+        The rows of the query on an rdflib Dataset holding the data in its
+        default graph. The stage graphs are removed afterwards.
+        """
+        try:
+            if self.stages:
+                dataset.update(str(self.update()))
+            return list(dataset.query(str(self.query)))
+        finally:
+            if self.stages:
+                dataset.update(self.cleanup())
+
+
+def staged_fragment_query(compiled: compiler.CompiledSchema,
+                          prefix: str = STAGE_PREFIX) -> StagedQuery:
+    """The fragment query of a compiled schema, with the conformance queries as stages"""
+    conformance = StagedConformance(prefix)
+    queries = {shape_name: to_sfquery_rope(compiled.shapes[shape_name], False, conformance)
+               for shape_name in compiled.targeted}
+    return StagedQuery(conformance.stages, compiler.fragment_rope(compiled, queries))
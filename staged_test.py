@@ -0,0 +1,45 @@
+from io import StringIO
+
+from rdflib import Dataset, Literal
+
+import compiler
+import sfquery
+import staged
+from algebra import SANode, Op
+from pathalg import PANode, POp
+from testsupport import EX, TARGETED_DATA, TARGETED_FRAGMENT, TARGETED_SHAPES, graph
+
+
+def test_staged_fragment_query():
+    compiled = compiler.compile_schema(graph(TARGETED_SHAPES))
+    staged_query = staged.staged_fragment_query(compiled)
+
+    data = graph(TARGETED_DATA)
+    dataset = Dataset()
+    dataset.default_graph.parse(data=TARGETED_DATA, format='ttl')
+
+    rows = set(staged_query.run(dataset))
+    assert {row for row in rows if row[1] is not None} == TARGETED_FRAGMENT
+    assert {row[0] for row in rows} == {EX.a1, EX.b2}
+    assert len(dataset) == len(data)  # the stage graphs are dropped
+
+    # ex:a and ex:c share the conformance query of ex:b
+    sink = StringIO()
+    staged_query.write(sink)
+    stages = [str(query) for _, query in staged_query.stages]
+    assert len(set(stages)) == len(stages)
+    assert sink.getvalue().count('INSERT') == len(stages)
+
+
+def test_linear_size():
+    shape = SANode(Op.HASVALUE, [EX.v])
+    sizes = []
+    for i in range(12):
+        shape = SANode(Op.GEQ, [Literal(2), PANode(POp.PROP, [EX[f'p{i}']]), shape])
+        conformance = staged.StagedConformance()
+        query = sfquery.to_sfquery_rope(shape, False, conformance)
+        sink = StringIO()
+        staged.StagedQuery(conformance.stages, query).write(sink)
+        sizes.append(len(sink.getvalue()))
+    growth = [second - first for first, second in zip(sizes, sizes[1:])]
+    assert max(growth) - min(growth) < 100
@@ -0,0 +1,335 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from typing import Tuple
+from urllib.parse import parse_qs
+
+from rdflib import RDF, Graph, Literal, Namespace, URIRef
+from rdflib.namespace import SH, XSD
+
+from algebra import SANode, Op
+from fragment import ntriples_term
+from pathalg import PANode, POp
+
+'''
+Data and helpers shared by the tests
+
+The tests import what they share from here, or take it from the fixtures of
+conftest.py, not from each other; benchmark.py takes its rectangles from
+here too. StandIn is a SPARQL endpoint answering with an rdflib Graph, for
+the tests of endpoint.py.
+'''
+
+EX = Namespace('http://ex.tt/')
+
+# values of every kind, blank nodes, literals with and without a language
+DATA = '''
+    @prefix ex: <http://ex.tt/> .
+    @prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+    ex:a ex:p ex:b, ex:c, "Bob", 5 ; ex:q ex:b, 3 ; ex:r "x"@en, "y"@en ; ex:s 7 .
+    ex:b ex:p ex:c, "bee"@nl ; ex:q ex:c ; ex:r "x"@en, "y"@nl ; ex:s 2 .
+    ex:c ex:p ex:a, 12 ; ex:q ex:a, 12 ; ex:s "2020-01-01"^^xsd:date .
+    ex:d ex:q _:x ; ex:s 1.5 .
+    _:x ex:p "Bart" .
+'''
+
+P = PANode(POp.PROP, [EX.p])
+Q = PANode(POp.PROP, [EX.q])
+R = PANode(POp.PROP, [EX.r])
+S = PANode(POp.PROP, [EX.s])
+TOP = SANode(Op.TOP, [])
+IRI = SANode(Op.TEST, ['nodekind', SH.IRI])
+STRING = SANode(Op.TEST, ['datatype', XSD.string])
+SMALL = SANode(Op.TEST, ['max_exclusive', Literal(10)])
+SHORT = SANode(Op.TEST, ['max_length', Literal(3)])
+B = SANode(Op.TEST, ['pattern', '^b', ('i',)])
+
+# shapes of every construct, to evaluate on DATA
+SHAPES = [
+    TOP,
+    SANode(Op.HASVALUE, [EX.a]),
+    SANode(Op.HASVALUE, [Literal(5)]),
+    SANode(Op.AND, []),
+    IRI, STRING, SMALL, SHORT, B,
+    SANode(Op.NOT, [SMALL]),
+    SANode(Op.NOT, [SANode(Op.HASVALUE, [EX.a])]),
+    SANode(Op.AND, [SANode(Op.GEQ, [Literal(1), P, TOP]), SANode(Op.NOT, [SANode(Op.HASVALUE, [EX.a])])]),
+    SANode(Op.OR, [SANode(Op.HASVALUE, [EX.a]), SMALL]),
+    SANode(Op.GEQ, [Literal(1), P, IRI]),
+    SANode(Op.GEQ, [Literal(2), P, SANode(Op.AND, [IRI, SANode(Op.NOT, [B])])]),
+    SANode(Op.GEQ, [Literal(2), PANode(POp.INV, [P]), TOP]),
+    SANode(Op.GEQ, [Literal(1), PANode(POp.COMP, [P, Q]), SANode(Op.HASVALUE, [EX.c])]),
+    SANode(Op.GEQ, [Literal(3), PANode(POp.KLEENE, [P]), TOP]),
+    SANode(Op.GEQ, [Literal(3), PANode(POp.ZEROORONE, [P]), TOP]),
+    SANode(Op.GEQ, [Literal(4), PANode(POp.ALT, [P, Q]), TOP]),
+    SANode(Op.LEQ, [Literal(1), Q, TOP]),
+    SANode(Op.LEQ, [Literal(1), P, IRI]),
+    SANode(Op.LEQ, [Literal(0), P, SANode(Op.GEQ, [Literal(1), Q, TOP])]),
+    SANode(Op.EXACTLY1, [Q]),
+    SANode(Op.FORALL, [P, IRI]),
+    SANode(Op.FORALL, [P, SANode(Op.NOT, [SHORT])]),
+    SANode(Op.FORALL, [Q, SANode(Op.GEQ, [Literal(1), P, TOP])]),
+    SANode(Op.FORALL, [P, TOP]),
+    SANode(Op.FORALL, [P, SANode(Op.AND, [SANode(Op.AND, []), TOP])]),
+    SANode(Op.EQ, [P, Q]),
+    SANode(Op.DISJ, [P, Q]),
+    SANode(Op.CLOSED, [P, Q, S]),
+    SANode(Op.LESSTHAN, [Q, S]),
+    SANode(Op.LESSTHANEQ, [Q, P]),
+    SANode(Op.UNIQUELANG, [R]),
+    # without conforming nodes
+    SANode(Op.LEQ, [Literal(0), P, SANode(Op.NOT, [TOP])]),
+    SANode(Op.AND, [SANode(Op.OR, [SANode(Op.NOT, [TOP]), SANode(Op.NOT, [SMALL])]),
+                    SANode(Op.LEQ, [Literal(1), Q, TOP])]),
+    SANode(Op.LEQ, [Literal(0), Q, SANode(Op.OR, [])]),
+    SANode(Op.GEQ, [Literal(1), PANode(POp.COMP, [PANode(POp.ALT, [Q, P]), R]), TOP]),
+]
+
+# shapes with targets, the conformance of ex:b is shared by ex:a and ex:c
+TARGETED_SHAPES = '''
+@prefix sh: <http://www.w3.org/ns/shacl#> .
+@prefix ex: <http://ex.tt/> .
+
+ex:a a sh:NodeShape ;
+    sh:targetClass ex:A ;
+    sh:property [ sh:path ex:p ; sh:minCount 2 ; sh:node ex:b ] .
+
+ex:b a sh:NodeShape ;
+    sh:property [ sh:path ex:q ; sh:maxCount 1 ] ;
+    sh:property [ sh:path ex:r ; sh:qualifiedValueShape [ sh:hasValue ex:z ] ;
+                  sh:qualifiedMinCount 1 ] .
+
+ex:c a sh:NodeShape ;
+    sh:targetNode ex:b2 ;
+    sh:node ex:b .
+'''
+
+TARGETED_DATA = '''
+@prefix ex: <http://ex.tt/> .
+
+ex:a1 a ex:A ; ex:p ex:b1, ex:b2 .
+ex:a2 a ex:A ; ex:p ex:b1, ex:b3 .
+ex:a3 a ex:A ; ex:p ex:b1 .
+ex:b1 ex:q 1 ; ex:r ex:z .
+ex:b2 ex:q 2 ; ex:r ex:z, ex:y .
+ex:b3 ex:q 1, 2 ; ex:r ex:z .
+'''
+
+# the fragment of ex:a1 for ex:a and of ex:b2 for ex:c, the only conforming
+# targets, as rows (?v ?s ?p ?o)
+TARGETED_FRAGMENT = {
+    (EX.a1, EX.a1, EX.p, EX.b1),
+    (EX.a1, EX.a1, EX.p, EX.b2),
+    (EX.a1, EX.a1, RDF.type, EX.A),
+    (EX.a1, EX.b1, EX.r, EX.z),
+    (EX.a1, EX.b2, EX.r, EX.z),
+    (EX.b2, EX.b2, EX.r, EX.z),
+}
+
+# shapes of the constructs that give a fragment, to extract from DATA
+FRAGMENT_SHAPES = '''
+@prefix sh: <http://www.w3.org/ns/shacl#> .
+@prefix ex: <http://ex.tt/> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+ex:Geq a sh:NodeShape ;
+    sh:targetSubjectsOf ex:p ;
+    sh:property [ sh:path ex:p ; sh:qualifiedValueShape [ sh:property [ sh:path ex:q ; sh:minCount 1 ] ] ;
+                  sh:qualifiedMinCount 1 ] .
+
+ex:Forall a sh:NodeShape ;
+    sh:targetSubjectsOf ex:s ;
+    sh:property [ sh:path ex:q ; sh:node [ sh:property [ sh:path ex:p ; sh:minCount 1 ] ] ] ;
+    sh:property [ sh:path ex:s ; sh:datatype xsd:integer ] .
+
+ex:Paths a sh:NodeShape ;
+    sh:targetSubjectsOf ex:q ;
+    sh:property [ sh:path [ sh:alternativePath ( ex:p [ sh:inversePath ex:q ] ) ] ; sh:minCount 2 ] .
+
+ex:Or a sh:NodeShape ;
+    sh:targetSubjectsOf ex:s ;
+    sh:or ( [ sh:property [ sh:path ex:s ; sh:minInclusive 3 ] ] [ sh:property [ sh:path ex:p ; sh:minCount 2 ] ] ) .
+'''
+
+# the shapes of the rectangles of rectangles()
+RECTANGLE_SHAPES = '''
+@prefix ex: <http://EX.tt/> .
+@prefix sh: <http://www.w3.org/ns/shacl#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+ex:Rectangle a sh:NodeShape ;
+    sh:targetClass ex:Rectangle ;
+    sh:property [ sh:path ex:width ; sh:minCount 1 ; sh:maxCount 1 ; sh:datatype xsd:integer ] ;
+    sh:property [ sh:path ex:height ; sh:minCount 1 ; sh:minInclusive 1 ] ;
+    sh:property [ sh:path ex:name ; sh:maxLength 8 ; sh:pattern "^r" ] ;
+    sh:property [ sh:path ex:next ; sh:node ex:Linked ] ;
+    sh:not [ sh:property [ sh:path ex:width ; sh:hasValue 0 ] ] .
+
+ex:Linked a sh:NodeShape ;
+    sh:property [ sh:path ex:next ; sh:class ex:Rectangle ] .
+'''
+
+
+# the rectangles of rectangles() in shapes of one property each
+SPLIT_SHAPES = '''
+@prefix ex: <http://ex.tt/> .
+@prefix sh: <http://www.w3.org/ns/shacl#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+ex:Width a sh:NodeShape ;
+    sh:targetClass ex:Rectangle ;
+    sh:property [ sh:path ex:width ; sh:minCount 1 ; sh:datatype xsd:integer ] .
+
+ex:Height a sh:NodeShape ;
+    sh:targetClass ex:Rectangle ;
+    sh:property [ sh:path ex:height ; sh:minCount 1 ; sh:minInclusive 1 ] .
+
+ex:Named a sh:NodeShape ;
+    sh:targetClass ex:Rectangle ;
+    sh:property [ sh:path ex:name ; sh:maxLength 8 ; sh:pattern "^r" ] .
+
+ex:Next a sh:NodeShape ;
+    sh:targetSubjectsOf ex:next ;
+    sh:property [ sh:path ex:next ; sh:class ex:Rectangle ; sh:node ex:Named ] .
+'''
+
+
+def rectangles(size: int) -> Graph:
+    """size rectangles in a chain, some of them without a height or with a long name"""
+    g = Graph()
+    for i in range(size):
+        rectangle = EX[f'r{i}']
+        g.add((rectangle, RDF.type, EX.Rectangle))
+        g.add((rectangle, EX.width, Literal(i % 7)))
+        if i % 5:
+            g.add((rectangle, EX.height, Literal(i % 11)))
+        g.add((rectangle, EX.name, Literal(f'r{i}' if i % 13 else f'rectangle{i}')))
+        g.add((rectangle, EX.next, EX[f'r{(i + 1) % size}']))
+    return g
+
+
+def graph(text: str) -> Graph:
+    """The graph of a Turtle text"""
+    parsed = Graph()
+    parsed.parse(data=text, format='ttl')
+    return parsed
+
+
+def conformance_files(name: str) -> Tuple[Graph, Graph]:
+    """The data and shapes graphs of a test of conformance_testfiles"""
+    data = Graph()
+    data.parse(f'./conformance_testfiles/{name}_data.ttl')
+    shapes = Graph()
+    shapes.parse(f'./conformance_testfiles/{name}_shape.ttl')
+    return data, shapes
+
+
+# the data and shapes graphs of the cases of the tests, built when a test needs them
+CASES = {
+    'and-001': lambda: conformance_files('and-001'),
+    'rectangles': lambda: (rectangles(30), graph(RECTANGLE_SHAPES)),
+    'targeted': lambda: (graph(TARGETED_DATA), graph(TARGETED_SHAPES)),
+    'fragment': lambda: (graph(DATA), graph(FRAGMENT_SHAPES)),
+    'split': lambda: (rectangles(10), graph(SPLIT_SHAPES)),
+}
+
+
+class StandIn(ThreadingHTTPServer):
+    """A SPARQL endpoint answering the queries on an rdflib Graph"""
+
+    daemon_threads = True
+
+    def __init__(self, graph: Graph):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.graph = graph
+        self.lock = Lock()
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.failures = 0  # the next queries answered with 503
+        self.delay = 0.0  # seconds before answering
+        self.gate = None  # an Event awaited after the first row
+        self.json = False
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/sparql'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        query = parse_qs(body)['query'][0]
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failing = server.failures > 0
+            server.failures -= failing
+        try:
+            time.sleep(server.delay)
+            if failing:
+                self._answer(503, 'text/plain', b'busy')
+                return
+            try:
+                result = server.graph.query(query)
+            except Exception as e:
+                self._answer(400, 'text/plain', str(e).encode())
+                return
+            if server.json:
+                bindings = [{str(name): _json_term(row[name]) for name in result.vars if row[name] is not None}
+                            for row in result]
+                answer = {'head': {'vars': [str(name) for name in result.vars]},
+                          'results': {'bindings': bindings}}
+                self._answer(200, 'application/sparql-results+json', json.dumps(answer).encode())
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/tab-separated-values')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self._chunk('\t'.join(f'?{name}' for name in result.vars) + '\n')
+            for i, row in enumerate(result):
+                self._chunk('\t'.join('' if term is None else ntriples_term(term).replace('\t', '\\t')
+                                      for term in row) + '\n')
+                if i == 0 and server.gate is not None:
+                    server.gate.wait(5)
+            self.wfile.write(b'0\r\n\r\n')
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _answer(self, status, content_type, content):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _chunk(self, text):
+        data = text.encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def _json_term(term):
+    if isinstance(term, URIRef):
+        return {'type': 'uri', 'value': str(term)}
+    if isinstance(term, Literal):
+        value = {'type': 'literal', 'value': str(term)}
+        if term.language:
+            value['xml:lang'] = term.language
+        elif term.datatype is not None:
+            value['datatype'] = str(term.datatype)
+        return value
+    return {'type': 'bnode', 'value': str(term)}
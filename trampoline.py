@@ -0,0 +1,48 @@
+from typing import Generator
+
+'''
+Recursion without Python recursion
+
+The tree passes are written as generator functions: where a recursive
+function would call itself, the generator yields the generator of the
+recursive call and receives its result back,
+
+    def _depth(node):
+        depths = []
+        for child in node.children:
+            depths.append((yield _depth(child)))
+        return 1 + max(depths, default=0)
+
+    depth = run(_depth(tree))
+
+run keeps the pending calls on an explicit stack, so trees of any depth are
+handled in constant Python stack space.
+'''
+
+
+def run(call: Generator):
+    """Runs a generator based recursive call to completion"""
+    stack = [call]
+    value = None
+    error = None  # an exception raised by a call is raised in its caller
+    while True:
+        try:
+            if error is None:
+                call = stack[-1].send(value)
+            else:
+                call = stack[-1].throw(error)
+        except StopIteration as stop:
+            stack.pop()
+            if not stack:
+                return stop.value
+            value = stop.value
+            error = None
+        except Exception as exception:
+            stack.pop()
+            if not stack:
+                raise
+            error = exception
+        else:
+            stack.append(call)
+            value = None
+            error = None
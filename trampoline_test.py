@@ -0,0 +1,36 @@
+import pytest
+
+import trampoline
+
+
+def _depth(node):
+    depths = []
+    for child in node:
+        depths.append((yield _depth(child)))
+    return 1 + max(depths, default=0)
+
+
+def _fail(depth):
+    if depth == 0:
+        raise ValueError('bottom')
+    yield _fail(depth - 1)
+
+
+def _catch(depth):
+    try:
+        yield _fail(depth)
+    except ValueError as error:
+        return str(error)
+
+
+def test_deep_recursion():
+    tree = []
+    for _ in range(100000):
+        tree = [tree, []]
+    assert trampoline.run(_depth(tree)) == 100001
+
+
+def test_exceptions():
+    with pytest.raises(ValueError):
+        trampoline.run(_fail(10000))
+    assert trampoline.run(_catch(10000)) == 'bottom'
@@ -1,164 +1,151 @@
+from typing import Iterable, Optional
+
 from algebra import SANode, Op
 from pathalg import PANode, POp
 from rdflib.namespace import SH
+from rdflib.term import Node
+
+import plan
+import trampoline
+from emit import Rope
 
 
 def _build_query(body):
-    return f'SELECT ?v WHERE {{ {body} }}'
+    return plan.project(body, '?v')
 
 
-def _build_all_query():
-    return _build_query('{ ?v ?_a ?_b. } UNION { ?_c ?_d ?v }')
+def _build_all_query(construct):
+    return _build_query(plan.nodes('?v', construct))
 
 
 def _build_join(queries):
-    out = ''
-    for query in queries:
-        out += f'{{ {query} }} . '
-    return _build_query(out[:-2])
+    return _build_query(plan.join(*queries))
 
 
 def _build_union(queries):
-    out = ''
-    for query in queries:
-        out += f'{{ {query} }} UNION '
-    return _build_query(out[:-6])
+    return _build_query(plan.union(*queries))
 
 
-def _build_negate(shape):
-    return _build_difference_query(_build_all_query(), shape)
+def _build_negate(shape, construct):
+    return _build_difference_query(_build_all_query(construct), shape)
 
 
 def _build_difference_query(superquery, subquery):
-    return _build_query(f'{{ {superquery} }} MINUS {{ {subquery} }}')
+    return _build_query(plan.minus(superquery, subquery))
+
+
+def _build_empty_query():
+    return plan.empty('?v')
 
 
 def _build_exists_query(path):
-    return _build_query(f'?v {path} ?_o .')
+    return _build_query(plan.scan('?v', path, '?_o'))
 
 
 def _build_closed_query(properties):
-    propstr = ''
-    for prop in properties:
-        propstr += prop + ', '
-    return _build_query(f'''
-    ?s ?p ?o FILTER ?p NOT IN ( {propstr[:-2]} )
-''')
+    # the nodes without a property that is not in properties
+    properties = ', '.join(properties)
+    return _build_negate(_build_query(
+        plan.filtered(f'(?p NOT IN ( {properties} ))', plan.scan('?v', '?p', '?o'))), 'CLOSED')
 
 
 def _build_disjoint_query(path1, path2):
     '''N_G minus v {p1} o . v {p2} o'''
     return _build_negate(
-        _build_query(f'''
-    ?v {path1} ?o .
-    ?v {path2} ?o
-'''))
+        _build_query(plan.join(plan.scan('?v', path1, '?o'), plan.scan('?v', path2, '?o'))), 'DISJ')
 
 
 def _build_equality_query(path1, path2):
     return _build_negate(
-        _build_query(f'''
-    {{
-      ?v {path1} ?o 
-      FILTER NOT EXISTS {{ ?v {path2} ?o }}
-    }} UNION {{
-      ?v {path2} ?o 
-      FILTER NOT EXISTS {{ ?v {path1} ?o }}
-    }}
-'''))
+        _build_query(plan.union(
+            plan.filtered(f'NOT EXISTS {{ ?v {path2} ?o }}', plan.scan('?v', path1, '?o')),
+            plan.filtered(f'NOT EXISTS {{ ?v {path1} ?o }}', plan.scan('?v', path2, '?o')))), 'EQ')
 
 
 def _build_forall_query(path, shape):
     return _build_negate(
-        _build_query(f'''
-        ?v {path} ?o.
-        {{
-          SELECT (?v AS ?o)
-          WHERE {{ {_build_negate(shape)} }}
-        }}'''))
+        _build_query(plan.join(plan.scan('?v', path, '?o'),
+                               plan.project(_build_negate(shape, 'FORALL'), '(?v AS ?o)'))), 'FORALL')
 
 
 def _build_forall_test_query(path, neg_filter_condition):
     return _build_negate(
-        _build_query(f' ?v {path} ?o FILTER {neg_filter_condition} '))
+        _build_query(plan.filtered(neg_filter_condition, plan.scan('?v', path, '?o'))), 'FORALL')
+
+
+def _build_count_query(path, comparison, shape=None, filter_condition=None):
+    # the nodes with a number of (distinct) values for path that satisfies comparison
+    values = plan.scan('?v', path, '?o')
+    if shape is not None:
+        values = plan.join(values, plan.project(shape, '(?v AS ?o)'))
+    if filter_condition is not None:
+        values = plan.filtered(filter_condition, values)
+    return plan.group('?v', f'COUNT(DISTINCT ?o) {comparison}', values)
 
 
 def _build_exactly1_query(path):
-    return _build_query(f'?v {path} ?o') + f' GROUP BY ?v HAVING (COUNT(?o) = 1 )'
+    return _build_count_query(path, '= 1')
 
 
 def _build_geq_query(num, path, shape):
-    return _build_query(f'''
-    ?v {path} ?o .
-    {{ SELECT (?v AS ?o) WHERE {{ {shape} }} }}
-    ''') + f' GROUP BY ?v HAVING (COUNT(?o) >= {str(num)} )'
+    return _build_count_query(path, f'>= {str(num)}', shape=shape)
 
 
 def _build_geq1_top_query(path):
-    return _build_query(f'?v {path} ?o')
+    return _build_query(plan.scan('?v', path, '?o'))
 
 
 def _build_geq1_query(path, shape):
-    return _build_query(f'''
-    ?v {path} ?o .
-    {{ SELECT (?v AS ?o) WHERE {{ {shape} }} }}''')
+    return _build_query(plan.join(plan.scan('?v', path, '?o'),
+                                  plan.project(shape, '(?v AS ?o)')))
 
 
 def _build_geq1_hasvalue_query(path, value):
-    return _build_query(f'?v {path} <{str(value)}>')
+    return _build_query(plan.scan('?v', path, value.n3()))
 
 
 def _build_geq_top_query(num, path):
-    return _build_query(f'?v {path} ?o') + f' GROUP BY ?v HAVING (COUNT(?o) >= {str(num)} )'
+    return _build_count_query(path, f'>= {str(num)}')
 
 
 def _build_geq_test_query(num, path, filter_condition):
-    return _build_query(f'?v {path} ?o FILTER {filter_condition}') + f' GROUP BY ?v HAVING (COUNT(?o) >= {str(num)} )'
+    return _build_count_query(path, f'>= {str(num)}', filter_condition=filter_condition)
 
 
 def _build_leq_query(num, path, shape):
-    return _build_negate(
-        _build_query(f'''
-?v {path} ?o .
-{{ SELECT (?v AS ?o) WHERE {{ {shape} }} }}
-''') + f' GROUP BY ?v HAVING (COUNT(?o) > {str(num)} )')
+    return _build_negate(_build_count_query(path, f'> {str(num)}', shape=shape), 'LEQ')
 
 
 def _build_leq_top_query(num, path):
-    return _build_negate(
-        _build_query(f'?v {path} ?o') + f' GROUP BY ?v HAVING (COUNT(?o) > {str(num)} )')
+    return _build_negate(_build_count_query(path, f'> {str(num)}'), 'LEQ')
 
 
 def _build_leq_test_query(num, path, filter_condition):
-    return _build_negate(
-        _build_query(f'?v {path} ?o FILTER {filter_condition}') + f' GROUP BY ?v HAVING (COUNT(?o) > {str(num)} )')
+    return _build_negate(_build_count_query(path, f'> {str(num)}', filter_condition=filter_condition),
+                         'LEQ')
 
 
 def _build_lt_query(path, prop):
-    return _build_query(f'''
-?v {path} ?e FILTER NOT EXISTS {{ ?v {prop} ?p FILTER ( ?p >= ?e )}}
-''')
+    return _build_query(plan.filtered(f'NOT EXISTS {{ ?v {prop} ?p FILTER ( ?p >= ?e ) }}',
+                                      plan.scan('?v', path, '?e')))
 
 
 def _build_lte_query(path, prop):
-    return _build_query(f'''
-    ?v {path} ?e FILTER NOT EXISTS {{ ?v {prop} ?p FILTER ( ?p > ?e )}}''')
+    return _build_query(plan.filtered(f'NOT EXISTS {{ ?v {prop} ?p FILTER ( ?p > ?e ) }}',
+                                      plan.scan('?v', path, '?e')))
 
 
 def _build_hasvalue_query(value):
-    return _build_query(f'BIND ( <{str(value)}> AS ?v )')
+    # DISTINCT, the block is not inlined in a group that binds ?v already,
+    # see pipeline.EvaluatedConformance._values
+    return plan.project(plan.pattern(f'VALUES ?v {{ {value.n3()} }}'), '?v', distinct=True)
 
 
 def _build_uniquelang_query(path):
     return _build_negate(
-        _build_query(f'''
-        SELECT ?v
-        WHERE {{
-            ?v {path} ?o1 .
-            ?v {path} ?o2 
-            FILTER ( ?o1 != ?o2 && lang(?o1) = lang(?o2) && lang(?o1) != "" )
-        }}
-        '''))
+        _build_query(plan.filtered(
+            '( ?o1 != ?o2 && lang(?o1) = lang(?o2) && lang(?o1) != "" )',
+            plan.join(plan.scan('?v', path, '?o1'), plan.scan('?v', path, '?o2')))), 'UNIQUELANG')
 
 
 def build_filter_condition(test_type, parameter, pattern_flags=[], negate=False, var='?v'):
@@ -200,73 +187,178 @@ def build_filter_condition(test_type, parameter, pattern_flags=[], negate=False,
         return f'({neg}( strlen({var}) <= {str(parameter)} ))'
 
 
+def test_condition(node: SANode, negate=False, var='?v') -> Optional[str]:
+    """
+    The filter condition on var of a TEST, a negated TEST, or a conjunction
+    of those, as built by build_filter_condition. None for other shapes, and
+    for tests without a condition.
+    """
+    tests = node.children if node.op == Op.AND else [node]
+    conditions = []
+    for test in tests:
+        negated = test.op == Op.NOT
+        if negated:
+            test = test.children[0]
+        if test.op != Op.TEST:
+            return None
+        if test.children[0] == 'pattern':
+            conditions.append(build_filter_condition('pattern', test.children[1],
+                                                     pattern_flags=test.children[2],
+                                                     negate=negated, var=var))
+        else:
+            conditions.append(build_filter_condition(test.children[0], test.children[1],
+                                                     negate=negated, var=var))
+    if not conditions or None in conditions:
+        return None
+    condition = conditions[0] if len(conditions) == 1 else f'( {" && ".join(conditions)} )'
+    return f'(!{condition})' if negate else condition
+
+
+def _build_filter_query(condition):
+    return _build_query(plan.filtered(condition, plan.nodes('?v', 'TEST')))
+
+
 def _build_test_query(test_type, parameter, negate=False):
-    return _build_query(
-        f'{{ {_build_all_query()} }} FILTER {build_filter_condition(test_type, parameter, negate=negate)}')
+    return _build_filter_query(build_filter_condition(test_type, parameter, negate=negate))
 
 
 def _build_pattern_query(pattern, flags, negate=False):
-    return _build_query(
-        f'{{ {_build_all_query()} }} FILTER {build_filter_condition("pattern", pattern, pattern_flags=flags, negate=negate)}')
+    return _build_filter_query(
+        build_filter_condition("pattern", pattern, pattern_flags=flags, negate=negate))
 
 
 def to_path(node: PANode) -> str:
     """to sparql path"""
+    return trampoline.run(_to_path(node))
+
+
+def _to_path(node: PANode):
+    # generator, see trampoline.run
     if node.pop == POp.PROP:
         return '<' + str(node.children[0]) + '>'
 
     if node.pop == POp.INV:
-        return '^(' + to_path(node.children[0]) + ')'
+        return '^(' + (yield _to_path(node.children[0])) + ')'
 
     if node.pop == POp.ALT:
-        out = ''
+        out = []
         for child in node.children:
-            out += to_path(child) + '|'
-        return out[:-1]
+            out.append((yield _to_path(child)))
+        return '|'.join(out)
 
     if node.pop == POp.COMP:
-        out = ''
+        out = []
         for child in node.children:
-            out += to_path(child) + '/'
-        return out[:-1]
+            path = yield _to_path(child)
+            # | binds less than /
+            out.append(f'({path})' if child.pop == POp.ALT else path)
+        return '/'.join(out)
 
     if node.pop == POp.KLEENE:
-        return '(' + to_path(node.children[0]) + ')*'
+        return '(' + (yield _to_path(node.children[0])) + ')*'
 
     if node.pop == POp.ZEROORONE:
-        return '(' + to_path(node.children[0]) + ')+'
-
-
-def to_uq(node: SANode, ignore_tests=False) -> str:
-    """to unary query; assumes shape is expanded"""
+        return '(' + (yield _to_path(node.children[0])) + ')?'
+
+
+class ConformanceQueries:
+    """
+    The conformance queries of the nodes of shapes, each node is translated
+    once (nodes are hash-consed, equal subtrees are the same node). A query
+    uses the conformance query of a child through reference, which inlines
+    it. Subclasses use the queries in other ways, see staged.py.
+
+    The queries are plans (plan.py), simplified when they are translated.
+    sparql prints them, sharing the text of the subplans they have in common.
+    """
+
+    def __init__(self):
+        self._queries = {}  # (node, ignore_tests) -> simplified plan
+        self._simplified = {}  # memo of plan.simplify
+        self._printed = {}  # memo of plan.to_sparql
+
+    def query(self, node: SANode, ignore_tests=False):
+        # generator, see trampoline.run
+        key = (node, ignore_tests)
+        if key not in self._queries:
+            self._queries[key] = self.simplify((yield _to_uq(node, ignore_tests, self)))
+        return self._queries[key]
+
+    def reference(self, node: SANode, ignore_tests=False):
+        # generator, see trampoline.run
+        return (yield self.query(node, ignore_tests))
+
+    def simplify(self, query: plan.Plan) -> plan.Plan:
+        return plan.simplify(query, self._simplified)
+
+    def sparql(self, query: plan.Plan) -> Rope:
+        return plan.to_sparql(query, self._printed)
+
+
+def to_uq(node: SANode, ignore_tests=False, focus: Optional[Iterable[Node]] = None) -> str:
+    """
+    to unary query; assumes shape is expanded. With focus, the query of the
+    nodes of focus that conform, see focus_plan
+    """
+    return str(to_uq_rope(node, ignore_tests, focus=focus))
+
+
+def to_uq_rope(node: SANode, ignore_tests=False, queries: ConformanceQueries = None,
+               focus: Optional[Iterable[Node]] = None) -> Rope:
+    """to_uq, as an emit.Rope"""
+    queries = queries if queries is not None else ConformanceQueries()
+    query = to_uq_plan(node, ignore_tests, queries)
+    if focus is not None:
+        query = queries.simplify(focus_plan(query, focus))
+    return queries.sparql(query)
+
+
+def focus_plan(query: plan.Plan, focus: Iterable[Node]) -> plan.Plan:
+    """
+    The results of query (a plan binding ?v) among the nodes of focus, bound
+    first by a VALUES block, so the patterns of query are evaluated with ?v
+    bound to them
+    """
+    values = ' '.join(sorted(node.n3() for node in focus))
+    if not values:
+        # rdflib does not accept an empty VALUES block
+        return _build_empty_query()
+    # DISTINCT, rdflib pushes the bindings of the VALUES block into a query
+    # without a modifier, also into its subqueries that rename ?v
+    return plan.project(plan.join(plan.pattern(f'VALUES ?v {{ {values} }}'),
+                                  plan.project(query, '?v', distinct=True)), '?v')
+
+
+def to_uq_plan(node: SANode, ignore_tests=False, queries: ConformanceQueries = None) -> plan.Plan:
+    """to_uq, as a simplified plan.Plan"""
+    queries = queries if queries is not None else ConformanceQueries()
+    return trampoline.run(queries.query(node, ignore_tests))
+
+
+def _to_uq(node: SANode, ignore_tests, queries: ConformanceQueries):
+    # generator, see trampoline.run
     if node.op == Op.HASSHAPE:
         raise ValueError('node must be expanded')
 
     if node.op == Op.TOP:
-        return _build_all_query()
+        return _build_all_query('TOP')
 
     if node.op == Op.AND:
         others = [child for child in node.children if child.op != Op.TEST]
         subqueries = []
 
-        forall_e_top = False
         for child in others:
             # Optimization: if NOT TOP in conjunction, return empty
             if child.op == Op.NOT and child.children[0].op == Op.TOP:
-                return _build_query('')  # the empty query
+                return _build_empty_query()  # the empty query
 
             # Optimization:
             # We often encounter forall E.top when ignoring tests,
             # if we get to such a shape for conformance, we ignore it in the
             # conjunction
             if child.op == Op.FORALL and child.children[1].op == Op.TOP:
-                forall_e_top = True
                 continue
-            subqueries.append(to_uq(child))
-        # because of the ignoring of the tests, we may end up without subqueries
-        # then the conformance query should be TOP
-        if not subqueries and forall_e_top:
-            return _build_all_query()
+            subqueries.append((yield queries.reference(child)))
 
         # Optimization: an and of tests is a test of ands
         tests = [child for child in node.children if child.op == Op.TEST]
@@ -280,8 +372,12 @@ def to_uq(node: SANode, ignore_tests=False) -> str:
                     conj_tests += build_filter_condition(test.children[0], test.children[1]) + ' && '
             conj_tests = conj_tests[:-4] + ' )'
 
-            subqueries.append(_build_query(f'{{ {_build_all_query()} }} FILTER {conj_tests}'))
+            subqueries.append(_build_filter_query(conj_tests))
 
+        # because of the ignoring of the tests (or an empty conjunction), we may
+        # end up without subqueries, then the conformance query should be TOP
+        if not subqueries:
+            return _build_all_query('TOP')
         return _build_join(subqueries)
 
     if node.op == Op.OR:
@@ -290,8 +386,8 @@ def to_uq(node: SANode, ignore_tests=False) -> str:
         for child in others:
             # Optimization: If TOP occurs in the disjunction, the conformance query is TOP
             if child.op == Op.TOP:
-                return _build_all_query()
-            subqueries.append(to_uq(child))
+                return _build_all_query('TOP')
+            subqueries.append((yield queries.reference(child)))
 
         # Optimization: an or of tests is a test of ors
         tests = [child for child in node.children if child.op == Op.TEST]
@@ -305,28 +401,30 @@ def to_uq(node: SANode, ignore_tests=False) -> str:
                     disj_tests += build_filter_condition(test.children[0], test.children[1]) + ' || '
             disj_tests = disj_tests[:-4] + ' )'
 
-            subqueries.append(_build_query(f'{{ {_build_all_query()} }} FILTER {disj_tests}'))
+            subqueries.append(_build_filter_query(disj_tests))
 
+        # an empty disjunction (or one of ignored tests) has no conforming nodes
+        if not subqueries:
+            return _build_empty_query()
         return _build_union(subqueries)
 
     if node.op == Op.NOT:
         child = node.children[0]
         # Optimization: not TOP is empty conformance
         if child.op == Op.TOP:
-            return _build_query('')  # the empty query
+            return _build_empty_query()  # the empty query
 
         # Optimization: if the shape is of the form: NOT TEST,
         # then we alter the test itself instead of ALL minus TEST
         if child.op == Op.TEST and ignore_tests:
-            return _build_query('')  # the empty query
+            return _build_empty_query()  # the empty query
 
         if child.op == Op.TEST:
             if child.children[0] == 'pattern':
-                return _build_pattern_query(child.children[1], child.children[2])
-            return _build_test_query(child.children[0], child.children[1])
+                return _build_pattern_query(child.children[1], child.children[2], negate=True)
+            return _build_test_query(child.children[0], child.children[1], negate=True)
         # For all other cases:
-        return _build_difference_query(_build_all_query(),
-                                       to_uq(node.children[0]))
+        return _build_negate((yield queries.reference(node.children[0])), 'NOT')
 
     if node.op == Op.CLOSED:
         properties = []
@@ -346,21 +444,19 @@ def to_uq(node: SANode, ignore_tests=False) -> str:
         child = node.children[1]
 
         if child.op == Op.TEST and ignore_tests:
-            return _build_query('')  # empty query
+            return _build_empty_query()  # empty query
 
-        if child.op == Op.TEST:
-            cond = build_filter_condition(
-                child.children[0], child.children[1], negate=True) if child.children[0] != 'pattern' \
-                else build_filter_condition('pattern', child.children[1],
-                                            pattern_flags=child.children[2], negate=True)
+        # Optimization: the values that fail the tests, without a conformance query
+        cond = test_condition(child, negate=True, var='?o')
+        if cond is not None:
             return _build_forall_test_query(to_path(node.children[0]), cond)
 
         # This often occurs when we "ignore tests"
         if child.op == Op.TOP:
-            return _build_all_query()
+            return _build_all_query('TOP')
 
         return _build_forall_query(to_path(node.children[0]),
-                                   to_uq(child))
+                                   (yield queries.reference(child)))
 
     if node.op == Op.EXACTLY1:
         path = to_path(node.children[0])
@@ -375,23 +471,19 @@ def to_uq(node: SANode, ignore_tests=False) -> str:
                 return _build_geq1_top_query(path)
             elif node.children[2].op == Op.HASVALUE:
                 return _build_geq1_hasvalue_query(path, node.children[2].children[0])
-            return _build_geq1_query(path, node.children[2])
+            return _build_geq1_query(path, (yield queries.reference(node.children[2])))
 
         # Optimization
         if node.children[2].op == Op.TOP or \
                 node.children[2].op == Op.TEST and ignore_tests:
             return _build_geq_top_query(node.children[0], path)
 
-        # Optimization
-        if node.children[2].op == Op.TEST:
-            child = node.children[1]
-            cond = build_filter_condition(
-                child.children[0], child.children[1]) if child.children[0] != 'pattern' \
-                else build_filter_condition('pattern', child.children[1],
-                                            pattern_flags=child.children[2])
+        # Optimization: the values are tested while they are counted
+        cond = test_condition(node.children[2], var='?o')
+        if cond is not None:
             return _build_geq_test_query(node.children[0], path, cond)
         return _build_geq_query(node.children[0], path,
-                                to_uq(node.children[2]))
+                                (yield queries.reference(node.children[2])))
 
     if node.op == Op.LEQ:
         path = to_path(node.children[1])
@@ -399,16 +491,12 @@ def to_uq(node: SANode, ignore_tests=False) -> str:
         if node.children[2].op == Op.TOP or \
                 node.children[2].op == Op.TEST and ignore_tests:
             return _build_leq_top_query(node.children[0], path)
-        # Optimization
-        if node.children[2].op == Op.TEST:
-            child = node.children[1]
-            cond = build_filter_condition(
-                child.children[0], child.children[1]) if child.children[0] != 'pattern' \
-                else build_filter_condition('pattern', child.children[1],
-                                            pattern_flags=child.children[2])
+        # Optimization: the values are tested while they are counted
+        cond = test_condition(node.children[2], var='?o')
+        if cond is not None:
             return _build_leq_test_query(node.children[0], path, cond)
         return _build_leq_query(node.children[0], path,
-                                to_uq(node.children[2]))
+                                (yield queries.reference(node.children[2])))
 
     if node.op == Op.LESSTHAN:
         return _build_lt_query(to_path(node.children[0]),
@@ -429,4 +517,4 @@ def to_uq(node: SANode, ignore_tests=False) -> str:
             return _build_pattern_query(node.children[1], node.children[2])
         return _build_test_query(node.children[0], node.children[1])
 
-    return _build_query('')  # empty query
+    return _build_empty_query()  # empty query
@@ -4,8 +4,9 @@ from rdflib.namespace import RDF
 from pytest import mark
 from rdflib import Graph, Namespace
 
-from algebra import parse, optimize_tree, expand_shape
-from unaryquery import to_uq
+from algebra import parse, optimize_tree, expand_shape, SANode, Op
+from pathalg import PANode, POp
+from unaryquery import to_uq, to_path
 
 EX = Namespace('http://ex.tt/')
 
@@ -36,3 +37,13 @@ def test_shape_validation(graph_file):
     print('-----UNARY QUERY-----')
     print(to_uq(exp))
     assert True
+
+
+def test_deep_shape():
+    shape = SANode(Op.HASVALUE, [EX.v])
+    path = PANode(POp.PROP, [EX.p])
+    for _ in range(5000):
+        shape = SANode(Op.FORALL, [PANode(POp.PROP, [EX.p]), shape])
+        path = PANode(POp.INV, [path])
+    assert to_uq(shape).count('SELECT') > 5000
+    assert to_path(path) == '^(' * 5000 + f'<{EX.p}>' + ')' * 5000